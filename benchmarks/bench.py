@@ -0,0 +1,182 @@
+"""Run the jobs against local stand-ins of the Twitter and Airtable APIs, and report the calls
+they make per endpoint, their wall time and their peak memory.
+
+    python benchmarks/bench.py --collections 50 --tweets 200 --latency 0.05
+    python benchmarks/bench.py fetch_tweets --error-rate 0.05 --rate-limit search_recent_tweets=30
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Optional
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+
+# The stand-ins do not care about the real field IDs, but the jobs need some
+for _name in ["COLLECTION_ID", "NAME", "DESCRIPTION", "SEARCH", "TWEETS", "URL", "CREATED_DATE"]:
+    os.environ.setdefault(f"AIRTABLE_FIELD_ID_{_name}", f"fld{_name.title().replace('_', '')}")
+
+from stand_ins import AirtableStandIn, ServerConfig, TwitterStandIn, generate_dataset  # noqa: E402
+
+SCENARIOS = ["fetch_tweets", "fetch_quote_tweets", "clean_old_collections"]
+
+
+@dataclass
+class Result:
+    scenario: str
+    elapsed_seconds: float
+    peak_memory_bytes: int
+    calls: Dict[str, int] = field(default_factory=dict)
+
+
+@contextlib.contextmanager
+def job_settings(module, **settings):
+    """Temporarily replace the settings a module read from the environment at import."""
+    previous = {name: getattr(module, name) for name in settings if hasattr(module, name)}
+    for name, value in settings.items():
+        if hasattr(module, name):
+            setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(module, name, value)
+
+
+def run_scenario(scenario: str, collections: int = 20, tweets: int = 100,
+                 twitter_config: Optional[ServerConfig] = None,
+                 airtable_config: Optional[ServerConfig] = None,
+                 calls_per_run: int = 1000, concurrency: int = 4, seed: int = 0,
+                 verbose: bool = False) -> Result:
+    """Run one job's main() against fresh stand-ins and a fresh state directory.
+
+    Args:
+        scenario: Name of the job module to run
+        collections: Number of synthetic collections
+        tweets: Number of tweets per collection, half of which are already stored
+        twitter_config: Behaviour of the Twitter stand-in
+        airtable_config: Behaviour of the Airtable stand-in
+        calls_per_run: The job's quota of search or quote tweet calls
+        concurrency: TWITTER_MAX_CONCURRENCY of the job
+        seed: Seed of the synthetic data
+        verbose: Show the job's own output
+    """
+    dataset = generate_dataset(collections, tweets, seed=seed)
+    config = importlib.import_module("config")
+    module = importlib.import_module(scenario)
+
+    with TwitterStandIn(dataset, twitter_config) as twitter_server, \
+            AirtableStandIn(dataset.records, airtable_config) as airtable_server, \
+            tempfile.TemporaryDirectory() as state_dir:
+        overrides = f"api.twitter.com={twitter_server.url},api.airtable.com={airtable_server.url}"
+        settings = dict(
+            AIRTABLE_API_KEY="key",
+            AIRTABLE_BASE_ID="appBenchmark",
+            AIRTABLE_TABLE_ID="tblBenchmark",
+            TWITTER_BEARER_TOKEN="token",
+            TWITTER_MAX_CONCURRENCY=concurrency,
+            TWITTER_SEARCH_CALLS_PER_RUN=calls_per_run,
+            TWITTER_QUOTE_CALLS_PER_RUN=calls_per_run,
+            TWITTER_CACHE=False,
+            STATE_PATH=os.path.join(state_dir, "state.sqlite3"),
+            TWEET_STORE_PATH=os.path.join(state_dir, "tweets.sqlite3"),
+            METRICS_DIR=os.path.join(state_dir, "metrics"),
+        )
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        previous_overrides = os.environ.get("API_HOST_OVERRIDES")
+        os.environ["API_HOST_OVERRIDES"] = overrides
+        try:
+            # The shared settings are read from config, a job's own from its module
+            with job_settings(config, **settings), job_settings(module, **settings), output:
+                tracemalloc.start()
+                started = time.perf_counter()
+                module.main()
+                elapsed = time.perf_counter() - started
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        finally:
+            if previous_overrides is None:
+                del os.environ["API_HOST_OVERRIDES"]
+            else:
+                os.environ["API_HOST_OVERRIDES"] = previous_overrides
+
+        calls = {f"twitter.{endpoint}": count for endpoint, count in twitter_server.calls.items()}
+        calls.update({f"airtable.{endpoint}": count for endpoint, count in airtable_server.calls.items()})
+
+    return Result(scenario, elapsed, peak, dict(sorted(calls.items())))
+
+
+def format_results(results) -> str:
+    lines = []
+    for result in results:
+        lines.append(f"{result.scenario}: {result.elapsed_seconds:.2f}s, "
+                     f"peak memory {result.peak_memory_bytes / 1024 / 1024:.1f} MiB")
+        for endpoint, count in result.calls.items():
+            lines.append(f"    {endpoint}: {count}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the jobs against local API stand-ins.")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help=f"The jobs to run, any of {', '.join(SCENARIOS)}. All of them by default.")
+    parser.add_argument("--collections", type=int, default=20)
+    parser.add_argument("--tweets", type=int, default=100, help="Tweets per collection")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 5xx responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of 429 responses")
+    parser.add_argument("--page-size", type=int, default=100, help="Largest page the stand-ins return")
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="ENDPOINT=CALLS",
+                        help="Calls per 15-minute window of a Twitter endpoint, e.g. get_quote_tweets=75")
+    parser.add_argument("--calls-per-run", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="Also write the results to a JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the jobs")
+    args = parser.parse_args(argv)
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}")
+
+    rate_limits = {}
+    for pair in args.rate_limit:
+        endpoint, calls = pair.split("=", 1)
+        rate_limits[endpoint] = int(calls)
+
+    def server_config(**overrides):
+        return ServerConfig(latency=args.latency, error_rate=args.error_rate,
+                            throttle_rate=args.throttle_rate, max_page_size=args.page_size,
+                            seed=args.seed, **overrides)
+
+    results = [
+        run_scenario(
+            scenario,
+            collections=args.collections,
+            tweets=args.tweets,
+            twitter_config=server_config(rate_limits=rate_limits),
+            airtable_config=server_config(),
+            calls_per_run=args.calls_per_run,
+            concurrency=args.concurrency,
+            seed=args.seed,
+            verbose=args.verbose,
+        )
+        for scenario in args.scenarios or SCENARIOS
+    ]
+
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
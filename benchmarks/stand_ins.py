@@ -0,0 +1,418 @@
+"""Local stand-ins for the Twitter v2 and Airtable APIs, for benchmarking the jobs offline.
+
+The servers implement just enough of each API for the jobs: Twitter recent search, quote tweets
+and tweet lookup, and Airtable's list, get and update records. Both count the calls they serve
+per endpoint and can add latency and inject 429 and 5xx responses.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from field_constants import Fields
+from utils import TWITTER_EPOCH_MS, RETWEET_STRING
+
+
+@dataclass
+class ServerConfig:
+    """How a stand-in server behaves.
+
+    Args:
+        latency: Seconds to wait before answering each request
+        error_rate: Fraction of requests answered with a random 500, 502 or 503
+        throttle_rate: Fraction of requests answered with a 429
+        rate_limits: Calls per window for each endpoint. Exhausted endpoints answer with a 429
+            until the window resets.
+        rate_limit_window: Length of a rate-limit window, in seconds
+        max_page_size: The largest page the server returns, regardless of what is asked for
+        seed: Seed of the error injection
+    """
+    latency: float = 0.0
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    rate_limits: Dict[str, int] = field(default_factory=dict)
+    rate_limit_window: int = 15 * 60
+    max_page_size: int = 100
+    seed: int = 0
+
+
+@dataclass
+class Dataset:
+    """Synthetic collections and the tweets the stand-ins know about.
+
+    records: Airtable records of the collections
+    tweets: Every tweet by ID, including the ones that are not in a collection yet
+    tweets_by_url: The IDs of the tweets that link to each search URL, newest first
+    quotes: The quote tweet IDs of each tweet, newest first
+    deleted: IDs of tweets that lookups report as not found
+    """
+    records: List[Dict]
+    tweets: Dict[int, Dict]
+    tweets_by_url: Dict[str, List[int]]
+    quotes: Dict[int, List[int]]
+    deleted: set
+
+
+def tweet_id_at(timestamp: datetime, sequence: int) -> int:
+    """A Snowflake ID for a tweet created at the given time."""
+    return ((int(timestamp.timestamp() * 1000) - TWITTER_EPOCH_MS) << 22) | (sequence & 0x3FFFFF)
+
+
+def generate_dataset(collections: int, tweets_per_collection: int, known_fraction: float = 0.5,
+                     retweet_fraction: float = 0.05, deleted_fraction: float = 0.02,
+                     max_quotes: int = 3, seed: int = 0) -> Dataset:
+    """Generate N collections with M tweets each, spread over the last six days.
+
+    Args:
+        collections: Number of collections
+        tweets_per_collection: Number of tweets that link to each collection's pub
+        known_fraction: The oldest fraction of each collection's tweets that is already stored
+            in the collection. Searches find the rest.
+        retweet_fraction: Fraction of tweets that are retweets
+        deleted_fraction: Fraction of stored tweets that lookups report as deleted
+        max_quotes: Each tweet has between 0 and this many quote tweets
+        seed: Seed of the generator, so runs are comparable
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    sequence = 0
+    records, tweets, tweets_by_url, quotes, deleted = [], {}, {}, {}, set()
+
+    def new_tweet(created_at, text, url=None):
+        nonlocal sequence
+        sequence += 1
+        tweet_id = tweet_id_at(created_at, sequence)
+        entities = {"urls": [{"expanded_url": url, "unwound_url": url}]} if url else {}
+        tweets[tweet_id] = {"id": str(tweet_id), "text": text, "entities": entities,
+                            "edit_history_tweet_ids": [str(tweet_id)]}
+        return tweet_id
+
+    for i in range(collections):
+        pub_url = f"https://research.example.com/pub/pub-{i}"
+        created_at = now - timedelta(days=rng.randint(0, 700))
+        ids = []
+        for j in range(tweets_per_collection):
+            tweeted_at = now - timedelta(days=6) + timedelta(days=6) * (j + 1) / (tweets_per_collection + 1)
+            retweet = rng.random() < retweet_fraction
+            text = f"{RETWEET_STRING}someone: {pub_url}" if retweet else f"Reading {pub_url}"
+            tweet_id = new_tweet(tweeted_at, text, pub_url)
+            ids.append(tweet_id)
+            quotes[tweet_id] = sorted(
+                (new_tweet(tweeted_at + timedelta(minutes=q + 1), f"Quoting {tweet_id}")
+                 for q in range(rng.randint(0, max_quotes))),
+                reverse=True,
+            )
+        tweets_by_url[pub_url] = sorted(ids, reverse=True)
+
+        known = ids[:int(len(ids) * known_fraction)]
+        deleted.update(tweet_id for tweet_id in known if rng.random() < deleted_fraction)
+        records.append({
+            "id": f"rec{i:08d}",
+            "createdTime": created_at.isoformat().replace("+00:00", ".000Z"),
+            "fields": {
+                Fields.ID: f"custom-{i:018d}",
+                Fields.NAME: f"Pub {i}",
+                Fields.DESCRIPTION: f"Pub number {i}",
+                Fields.SEARCH: pub_url,
+                Fields.TWEETS: ",".join(map(str, known)),
+                Fields.CREATED_DATE: created_at.isoformat(),
+            },
+        })
+
+    return Dataset(records, tweets, tweets_by_url, quotes, deleted)
+
+
+class StandInServer:
+    """Base of the stand-in servers. Runs a threaded HTTP server on a free local port."""
+
+    def __init__(self, config: Optional[ServerConfig] = None):
+        self.config = config or ServerConfig()
+        self.calls = Counter()
+        self._rng = random.Random(self.config.seed)
+        self._windows: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self) -> "StandInServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def route(self, method: str, path: str, query: Dict, body: Optional[Dict]):
+        """Returns (status, payload). Implemented by each server."""
+        raise NotImplementedError
+
+    def endpoint_for(self, method: str, path: str) -> str:
+        raise NotImplementedError
+
+    def _inject(self, endpoint: str):
+        """Decide whether to answer with an error. Returns (status, headers) or None."""
+        with self._lock:
+            roll = self._rng.random()
+            if roll < self.config.error_rate:
+                return self._rng.choice([500, 502, 503]), {}
+            if roll < self.config.error_rate + self.config.throttle_rate:
+                return 429, {"Retry-After": "0"}
+        return None
+
+    def _rate_limit_headers(self, endpoint: str):
+        """Count a call against the endpoint's window. Returns (exhausted, headers)."""
+        limit = self.config.rate_limits.get(endpoint)
+        if limit is None:
+            return False, {}
+        with self._lock:
+            now = time.time()
+            window = self._windows.get(endpoint)
+            if window is None or window["reset"] <= now:
+                window = self._windows[endpoint] = {"remaining": limit,
+                                                    "reset": int(now) + self.config.rate_limit_window}
+            exhausted = window["remaining"] <= 0
+            if not exhausted:
+                window["remaining"] -= 1
+            return exhausted, {
+                "x-rate-limit-limit": str(limit),
+                "x-rate-limit-remaining": str(window["remaining"]),
+                "x-rate-limit-reset": str(window["reset"]),
+            }
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                endpoint = server.endpoint_for(method, url.path)
+                with server._lock:
+                    server.calls[endpoint] += 1
+
+                if server.config.latency:
+                    time.sleep(server.config.latency)
+
+                exhausted, headers = server._rate_limit_headers(endpoint)
+                injected = server._inject(endpoint)
+                if exhausted:
+                    status, payload = 429, {"title": "Too Many Requests"}
+                elif injected is not None:
+                    status, extra_headers = injected
+                    headers.update(extra_headers)
+                    payload = {"title": "Injected error"}
+                else:
+                    status, payload = server.route(method, url.path, parse_qs(url.query), body)
+
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PATCH(self):
+                self._handle("PATCH")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class TwitterStandIn(StandInServer):
+    """Serves recent search, quote tweets and tweet lookup from a Dataset."""
+
+    SEARCH_PATH = re.compile(r"^/2/tweets/search/recent$")
+    QUOTES_PATH = re.compile(r"^/2/tweets/(\d+)/quote_tweets$")
+    LOOKUP_PATH = re.compile(r"^/2/tweets$")
+
+    def __init__(self, dataset: Dataset, config: Optional[ServerConfig] = None):
+        super().__init__(config)
+        self.dataset = dataset
+
+    def endpoint_for(self, method, path):
+        if self.SEARCH_PATH.match(path):
+            return "search_recent_tweets"
+        if self.QUOTES_PATH.match(path):
+            return "get_quote_tweets"
+        if self.LOOKUP_PATH.match(path):
+            return "get_tweets"
+        return "unknown"
+
+    def route(self, method, path, query, body):
+        endpoint = self.endpoint_for(method, path)
+        if endpoint == "search_recent_tweets":
+            return 200, self._search(query)
+        if endpoint == "get_quote_tweets":
+            tweet_id = int(self.QUOTES_PATH.match(path).group(1))
+            return 200, self._page(self.dataset.quotes.get(tweet_id, []), query, "pagination_token")
+        if endpoint == "get_tweets":
+            return 200, self._lookup(query)
+        return 404, {"title": "Not Found"}
+
+    def _search(self, query):
+        urls = re.findall(r'url:"([^"]+)"', query["query"][0])
+        since_id = int(query.get("since_id", ["0"])[0])
+        matches = set()
+        for url in urls:
+            for prefix, tweet_ids in self.dataset.tweets_by_url.items():
+                if prefix.startswith(url.rstrip("/")):
+                    matches.update(tweet_id for tweet_id in tweet_ids if tweet_id > since_id)
+        return self._page(sorted(matches, reverse=True), query, "next_token")
+
+    def _page(self, tweet_ids, query, token_param):
+        page_size = min(int(query.get("max_results", ["10"])[0]), self.config.max_page_size)
+        offset = int(query.get(token_param, ["0"])[0])
+        page = tweet_ids[offset:offset + page_size]
+        meta = {"result_count": len(page)}
+        if offset + page_size < len(tweet_ids):
+            meta["next_token"] = str(offset + page_size)
+        if not page:
+            return {"meta": meta}
+        return {"data": [self.dataset.tweets[tweet_id] for tweet_id in page], "meta": meta}
+
+    def _lookup(self, query):
+        data, errors = [], []
+        for tweet_id in map(int, query["ids"][0].split(",")):
+            if tweet_id in self.dataset.deleted or tweet_id not in self.dataset.tweets:
+                errors.append({
+                    "value": str(tweet_id), "resource_id": str(tweet_id), "parameter": "ids",
+                    "resource_type": "tweet", "title": "Not Found Error",
+                    "detail": f"Could not find tweet with ids: [{tweet_id}].",
+                    "type": "https://api.twitter.com/2/problems/resource-not-found",
+                })
+            else:
+                data.append(self.dataset.tweets[tweet_id])
+        payload = {"data": data} if data else {}
+        if errors:
+            payload["errors"] = errors
+        return payload
+
+
+class AirtableStandIn(StandInServer):
+    """Serves list, get and update of the records of a single table, keyed by field ID.
+
+    Formulas are limited to what the jobs send: a field reference, NOT() and AND() of those.
+    """
+
+    RECORDS_PATH = re.compile(r"^/v0/[^/]+/[^/]+$")
+    LIST_POST_PATH = re.compile(r"^/v0/[^/]+/[^/]+/listRecords$")
+    RECORD_PATH = re.compile(r"^/v0/[^/]+/[^/]+/(rec[^/]+)$")
+    PAGE_SIZE = 100
+
+    def __init__(self, records: List[Dict], config: Optional[ServerConfig] = None):
+        super().__init__(config)
+        self.records = {record["id"]: json.loads(json.dumps(record)) for record in records}
+        self._offsets: Dict[str, List[str]] = {}
+
+    def endpoint_for(self, method, path):
+        if self.LIST_POST_PATH.match(path) or (method == "GET" and self.RECORDS_PATH.match(path)):
+            return "list_records"
+        if self.RECORD_PATH.match(path):
+            return "get_record" if method == "GET" else "update_record"
+        if self.RECORDS_PATH.match(path):
+            return "update_records"
+        return "unknown"
+
+    def route(self, method, path, query, body):
+        endpoint = self.endpoint_for(method, path)
+        if endpoint == "list_records":
+            options = body if body is not None else {
+                "fields": query.get("fields[]"),
+                "filterByFormula": (query.get("filterByFormula") or [None])[0],
+                "offset": (query.get("offset") or [None])[0],
+            }
+            return 200, self._list(options)
+        if endpoint == "get_record":
+            record = self.records.get(self.RECORD_PATH.match(path).group(1))
+            return (200 if record else 404), record or {"error": "NOT_FOUND"}
+        if endpoint == "update_record":
+            record_id = self.RECORD_PATH.match(path).group(1)
+            return 200, self._update(record_id, body["fields"])
+        if endpoint == "update_records":
+            return 200, {"records": [self._update(r["id"], r["fields"]) for r in body["records"]]}
+        return 404, {"error": "NOT_FOUND"}
+
+    def _list(self, options):
+        offset = options.get("offset")
+        if offset:
+            record_ids = self._offsets.pop(offset)
+        else:
+            formula = options.get("filterByFormula")
+            record_ids = [record_id for record_id, record in self.records.items()
+                          if not formula or _evaluate(formula, record["fields"])]
+
+        page, rest = record_ids[:self.PAGE_SIZE], record_ids[self.PAGE_SIZE:]
+        fields = options.get("fields")
+        payload = {"records": [
+            {**self.records[record_id], "fields": {
+                name: value for name, value in self.records[record_id]["fields"].items()
+                if not fields or name in fields
+            }}
+            for record_id in page
+        ]}
+        if rest:
+            token = f"itr{len(self._offsets)}{time.monotonic_ns()}"
+            self._offsets[token] = rest
+            payload["offset"] = token
+        return payload
+
+    def _update(self, record_id, fields):
+        record = self.records[record_id]
+        record["fields"].update(fields)
+        return record
+
+
+def _evaluate(formula: str, fields: Dict) -> bool:
+    """Evaluate a formula made of {field} references, NOT() and AND() for truthiness."""
+    formula = formula.strip()
+    if formula.startswith("AND(") and formula.endswith(")"):
+        return all(_evaluate(part, fields) for part in _split_arguments(formula[4:-1]))
+    if formula.startswith("NOT(") and formula.endswith(")"):
+        return not _evaluate(formula[4:-1], fields)
+    if formula.startswith("{") and formula.endswith("}"):
+        return bool(fields.get(unquote(formula[1:-1])))
+    raise ValueError(f"Unsupported formula: {formula}")
+
+
+def _split_arguments(arguments: str) -> List[str]:
+    parts, depth, current = [], 0, ""
+    for char in arguments:
+        if char == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        depth += char == "("
+        depth -= char == ")"
+        current += char
+    return parts + [current]
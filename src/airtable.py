@@ -1,34 +1,270 @@
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from pyairtable import Table
-from typing import List, Dict, Optional
+from pyairtable.formulas import CREATED_TIME, IS_AFTER, LAST_MODIFIED_TIME, OR
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Sequence, Set
+from urllib.parse import urlsplit
+
+from field_constants import Fields, TweetsFields
+from metrics import RunMetrics
+from transport import build_retry, is_retryable, mount_transport
+from tweet_ids import TweetIdSet
+from tweets_table_mirror import TweetsTableMirror
+
+# Airtable allows 5 requests per second per base and at most 10 records per batch request.
+REQUESTS_PER_SECOND = 5
+MAX_RECORDS_PER_REQUEST = 10
+
+# A page of records that still fails after the transport's retries is requested again from its
+# own offset this many times in all, this many seconds apart (times the attempt), before the read fails
+PAGE_ATTEMPTS = 3
+PAGE_RETRY_SECONDS = 2.0
+
+# The tweets table is read whole this often, to notice records deleted by anyone but the jobs
+TWEETS_TABLE_FULL_SYNC = timedelta(days=7)
+# A sync of the tweets table reads the records changed since this long before the previous sync
+# started, so records written while it ran, or stamped by a clock that is a little off, are not missed
+TWEETS_TABLE_SYNC_MARGIN = timedelta(minutes=5)
+
+# Marks the end of a read on the page queue of iter_database_entries
+_END_OF_READ = object()
 
 
 class AirtableAPI:
-    def __init__(self, api_key: str, base_id: str, table_name: str):
+    def __init__(self, api_key: str, base_id: str, table_name: str, batch_writes: bool = False,
+                 max_pending_records: int = 50, max_pending_seconds: float = 30.0,
+                 pool_size: int = REQUESTS_PER_SECOND, metrics: Optional[RunMetrics] = None,
+                 tweets_table: Optional[str] = None, tweets_table_mirror: Optional[str] = None,
+                 tweets_table_full_sync: timedelta = TWEETS_TABLE_FULL_SYNC):
         """Initialize Airtable client with credentials.
 
         Args:
             api_key: Airtable API key
             base_id: Airtable base ID
             table_name: Name of the table to interact with
+            batch_writes: Buffer updates and send them through the batch endpoint instead of
+                one request per update. Pending updates are flushed at exit at the latest.
+            max_pending_records: Flush once this many records have pending updates
+            max_pending_seconds: Flush once the oldest pending update is this old
+            pool_size: Number of connections to keep alive. Airtable serves at most 5 requests
+                per second per base, so more rarely help.
+            metrics: RunMetrics that requests, writes and pacing sleeps are recorded in
+            tweets_table: Name or ID of a table to store the collections' tweet IDs in, one record
+                per tweet, see TweetsTable. Records read with the tweets field then have all their
+                tweets in it, and updates of the field only send the tweets that changed.
+            tweets_table_mirror: Location of a SQLite copy of the tweets table that is kept
+                between runs, see TweetsTableMirror. Without it the whole table is read every run.
+            tweets_table_full_sync: How often the tweets table is read whole, even with a mirror
+
+        Transient errors (rate limiting, 5xx, dropped connections) are retried with backoff by the
+        transport. If they persist, reads and writes raise instead of skipping the rest of the run.
+        Updates are idempotent, so PATCH requests are retried as well.
         """
         self.table = Table(api_key, base_id, table_name)
+        mount_transport(self.table.api.session, pool_size=pool_size,
+                        retry=build_retry(methods=("GET", "PATCH")))
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.table.api.session.hooks["response"].append(self._record_response)
 
-    def get_database_entries(self) -> List[Dict]:
-        """Get all entries from the database.
-        Maintains same interface as original notion.py.
+        # A snapshot of the table, loaded once per run and kept up-to-date after our own writes.
+        self._records_by_id: Optional[Dict[str, Dict]] = None
+        self._record_ids_by_collection_id: Dict[str, str] = {}
+        # The record IDs returned by each (fields, formula) read, so repeated reads are not resent
+        self._record_ids_by_query: Dict[tuple, List[str]] = {}
+
+        self.batch_writes = batch_writes
+        self.max_pending_records = max_pending_records
+        self.max_pending_seconds = max_pending_seconds
+        self._pending_updates: Dict[str, Dict] = {}
+        self._pending_since: Optional[float] = None
+        self._last_write_at = 0.0
+        # Callbacks of after_write, each with the records it still waits for
+        self._write_callbacks: List[tuple] = []
+        self._failed_record_ids: Set[str] = set()
+
+        self.tweets_table = (
+            TweetsTable(
+                self,
+                tweets_table,
+                mirror=TweetsTableMirror(tweets_table_mirror) if tweets_table_mirror else None,
+                full_sync=tweets_table_full_sync,
+            )
+            if tweets_table else None
+        )
+        # The tweets field of each record as Airtable has it, which TweetsTable adds to
+        self._legacy_tweets: Dict[str, str] = {}
+
+        # Jobs may share one instance between threads, so snapshot and buffer access is serialized
+        self._lock = threading.RLock()
+        if batch_writes:
+            atexit.register(self.flush)
+
+    def get_database_entries(self, fields: Optional[Sequence[str]] = None, formula: Optional[str] = None,
+                             refresh: bool = False) -> List[Dict]:
+        """Get entries from the database.
+        Each distinct read is sent to Airtable on its first call only; later calls return the
+        matching records from the snapshot.
+
+        Args:
+            fields: IDs of the fields to download. All fields by default. The other fields of the
+                returned records are whatever an earlier read loaded, if anything, so a job has to
+                ask for every field it reads.
+            formula: An Airtable formula that records must match, evaluated by Airtable
+            refresh: Re-read from Airtable even if this read was made before
 
         Returns:
             List of record dictionaries containing fields and metadata
         """
+        with self._lock:
+            return [
+                record for page in self.iter_database_entries(fields, formula, refresh=refresh) for record in page
+            ]
+
+    def iter_database_entries(self, fields: Optional[Sequence[str]] = None, formula: Optional[str] = None,
+                              refresh: bool = False, prefetch: int = 1) -> Iterator[List[Dict]]:
+        """Get entries from the database one page of up to 100 records at a time, so a job can
+        start on the first page while the next ones load in a background thread.
+
+        Each page is merged into the snapshot before it is yielded. A page that fails is
+        requested again from its own offset, without reading the earlier pages again. Once a read
+        has run to the end, it is answered from the snapshot like get_database_entries.
+
+        Args:
+            fields: IDs of the fields to download, see get_database_entries
+            formula: An Airtable formula that records must match
+            refresh: Re-read from Airtable even if this read was made before
+            prefetch: Number of pages to load ahead of the one being worked on
+
+        Yields:
+            Lists of record dictionaries
+        """
+        query = (tuple(fields) if fields is not None else None, formula)
+        with self._lock:
+            if query in self._record_ids_by_query and not refresh:
+                yield [
+                    self._records_by_id[record_id]
+                    for record_id in self._record_ids_by_query[query]
+                    if record_id in self._records_by_id
+                ]
+                return
+
+        options = {"use_field_ids": True}
+        if fields is not None:
+            options["fields"] = list(fields)
+        if formula:
+            options["formula"] = formula
+
+        pages = queue.Queue(maxsize=max(prefetch, 1))
+        stopped = threading.Event()
+
+        def put(item):
+            # Give up once the caller has stopped reading, instead of blocking on a full queue
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def load():
+            try:
+                for page in self._iter_pages(options):
+                    if not put(page):
+                        return
+                put(_END_OF_READ)
+            except Exception as e:
+                put(e)
+
+        threading.Thread(target=load, daemon=True).start()
+        record_ids = []
         try:
-            return self.table.all(use_field_ids=True)
+            while True:
+                page = pages.get()
+                if page is _END_OF_READ:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+
+                with self._lock:
+                    if self._records_by_id is None:
+                        self._load_snapshot([])
+                    for record in page:
+                        if self.tweets_table is not None and (fields is None or Fields.TWEETS in fields):
+                            record = self._with_stored_tweets(record)
+                        self._merge_record(record, fields)
+                    records = [self._records_by_id[record["id"]] for record in page]
+                record_ids.extend(record["id"] for record in page)
+                yield records
+
+            with self._lock:
+                if fields is None and not formula:
+                    # A full read replaces the snapshot, dropping records deleted since an earlier read
+                    self._load_snapshot([self._records_by_id[record_id] for record_id in record_ids])
+                self._record_ids_by_query[query] = record_ids
+        finally:
+            stopped.set()
+
+    def get_entry_by_record_id(self, record_id: str) -> Optional[Dict]:
+        """Get an entry from the snapshot by its Airtable record ID.
+
+        Args:
+            record_id: Airtable's internal record ID
+
+        Returns:
+            Record dictionary or None if there is no such record
+        """
+        with self._lock:
+            if self._records_by_id is None:
+                self.get_database_entries()
+            return self._records_by_id.get(record_id)
+
+    def get_entry_by_collection_id(self, collection_id: str) -> Optional[Dict]:
+        """Get an entry from the snapshot by its collection ID.
+
+        Args:
+            collection_id: The value of the collection ID field
+
+        Returns:
+            Record dictionary or None if there is no such record
+        """
+        with self._lock:
+            if self._records_by_id is None:
+                self.get_database_entries()
+            record_id = self._record_ids_by_collection_id.get(collection_id)
+            return self._records_by_id.get(record_id) if record_id else None
+
+    def refresh_entry(self, record_id: str) -> Optional[Dict]:
+        """Re-read a single record from Airtable and replace it in the snapshot.
+
+        Args:
+            record_id: Airtable's internal record ID
+
+        Returns:
+            The fresh record dictionary or None if the record could not be read
+        """
+        try:
+            record = self.table.get(record_id, use_field_ids=True)
         except Exception as e:
-            print(f"Error fetching entries from Airtable: {e}")
-            return []
+            if is_retryable(e):
+                raise
+            print(f"Error fetching record {record_id} from Airtable: {e}")
+            return None
+
+        with self._lock:
+            if self.tweets_table is not None:
+                record = self._with_stored_tweets(record)
+            if self._records_by_id is not None:
+                self._index_record(record)
+        return record
 
     def update_page(self, record_id: str, properties: Dict) -> Optional[Dict]:
         """Update a record in Airtable.
         Maintains same interface as original notion.py.
+        With batch_writes enabled the update is queued and the snapshot is updated right away.
 
         Args:
             record_id: ID of record to update
@@ -37,8 +273,454 @@ class AirtableAPI:
         Returns:
             Updated record dictionary or None if update failed
         """
+        with self._lock:
+            if self.tweets_table is not None and Fields.TWEETS in properties:
+                return self._update_tweets(record_id, properties)
+            return self._update_page(record_id, properties)
+
+    def after_write(self, record_ids: Iterable[str], callback: Callable[[], None]) -> None:
+        """Call callback once the updates of the given records have reached Airtable: right away
+        if none of them has an update pending, or else after the flush that sends the last one.
+        If an update of any of them failed during this run, callback is never called, so state
+        that depends on the updates, like watermarks, never gets ahead of them.
+
+        Args:
+            record_ids: Airtable's internal record IDs
+            callback: Function to call without arguments
+        """
+        with self._lock:
+            record_ids = set(record_ids)
+            if record_ids & self._failed_record_ids:
+                return
+            waiting = record_ids & self._pending_updates.keys()
+            if waiting:
+                self._write_callbacks.append((waiting, callback))
+                return
+        callback()
+
+    def move_tweets_to_table(self, record_id: str, clear_field: bool = False) -> int:
+        """Copy the tweet IDs in a record's tweets field to the tweets table. The record must have
+        been read with the tweets field first.
+
+        Args:
+            record_id: Airtable's internal record ID
+            clear_field: Empty the tweets field once its tweets are in the table
+
+        Returns:
+            Number of tweet IDs that were not in the table yet
+        """
+        with self._lock:
+            legacy = self._legacy_tweets.get(record_id, "")
+            added = self.tweets_table.append(record_id, TweetIdSet.from_field(legacy))
+            if clear_field and legacy:
+                tweets = self._snapshot_tweets(record_id)
+                if self._update_page(record_id, {Fields.TWEETS: ""}) is not None:
+                    self._legacy_tweets[record_id] = ""
+                    self._set_snapshot_tweets(record_id, tweets)
+            return added
+
+    def _update_page(self, record_id: str, properties: Dict) -> Optional[Dict]:
+        with self._lock:
+            if self.batch_writes:
+                return self._queue_update(record_id, properties)
+
+            self._pace_write()
+            try:
+                record = self.table.update(record_id, properties, use_field_ids=True)
+            except Exception as e:
+                if is_retryable(e):
+                    raise
+                print(f"Error updating record in Airtable: {e}")
+                self._write_failed(record_id)
+                return None
+            self.metrics.record_writes("airtable", "update_record", 1)
+
+            if self.tweets_table is not None:
+                record = self._with_written_tweets(record, properties)
+            if self._records_by_id is not None:
+                self._index_record(record)
+            return record
+
+    def _update_tweets(self, record_id: str, properties: Dict) -> Optional[Dict]:
+        """Update a record's tweets through the tweets table: tweets that are new are appended to
+        it and tweets that were dropped are deleted from it. Tweets that were dropped from those
+        still in the tweets field are removed from the field, which is only ever shortened."""
+        tweets = TweetIdSet.from_field(properties[Fields.TWEETS])
+        legacy = TweetIdSet.from_field(self._legacy_tweets.get(record_id))
+        stored = self.tweets_table.get(record_id)
+        self.tweets_table.append(record_id, tweets - legacy - stored)
+        self.tweets_table.remove(record_id, stored - tweets)
+
+        properties = {field: value for field, value in properties.items() if field != Fields.TWEETS}
+        dropped = legacy - tweets
+        if dropped:
+            properties[Fields.TWEETS] = (legacy - dropped).to_field()
+            self._legacy_tweets[record_id] = properties[Fields.TWEETS]
+        record = self._update_page(record_id, properties) if properties else {"id": record_id, "fields": {}}
+        self._set_snapshot_tweets(record_id, tweets)
+        if self._records_by_id is not None and record_id in self._records_by_id:
+            return self._records_by_id[record_id]
+        return record
+
+    def _with_stored_tweets(self, record: Dict) -> Dict:
+        """A record as read from Airtable, with the tweets of the tweets table added to its tweets field."""
+        legacy = record.get("fields", {}).get(Fields.TWEETS, "")
+        self._legacy_tweets[record["id"]] = legacy
+        stored = self.tweets_table.get(record["id"])
+        if not stored:
+            return record
+        tweets = TweetIdSet.from_field(legacy) | stored
+        return {**record, "fields": {**record.get("fields", {}), Fields.TWEETS: tweets.to_field()}}
+
+    def _with_written_tweets(self, record: Dict, fields: Dict) -> Dict:
+        """A record as Airtable returned it after an update of the given fields. Its tweets field
+        only gets the tweets of the tweets table if the update wrote it or the snapshot has it, so
+        updates of other fields never read the tweets table. Otherwise the field is left out, as
+        it would only hold the tweets that were never moved to the tweets table."""
+        previous = (self._records_by_id or {}).get(record["id"])
+        if Fields.TWEETS in fields or (previous is not None and Fields.TWEETS in previous.get("fields", {})):
+            return self._with_stored_tweets(record)
+        self._legacy_tweets[record["id"]] = record.get("fields", {}).get(Fields.TWEETS, "")
+        return {**record, "fields": {field: value for field, value in record.get("fields", {}).items()
+                                     if field != Fields.TWEETS}}
+
+    def _snapshot_tweets(self, record_id: str) -> TweetIdSet:
+        record = (self._records_by_id or {}).get(record_id)
+        return TweetIdSet.from_field((record or {}).get("fields", {}).get(Fields.TWEETS))
+
+    def _set_snapshot_tweets(self, record_id: str, tweets: TweetIdSet) -> None:
+        record = (self._records_by_id or {}).get(record_id)
+        if record is not None:
+            self._index_record({**record, "fields": {**record.get("fields", {}), Fields.TWEETS: tweets.to_field()}})
+
+    def flush(self) -> Dict[str, Exception]:
+        """Send all pending updates to Airtable, 10 records per request.
+        If a batch is rejected, its records are retried one by one so that a single bad record
+        does not fail the others. If Airtable keeps failing with a transient error, the updates
+        that were not sent stay pending and the error is raised.
+
+        Returns:
+            Dictionary of record IDs whose update failed, mapped to the error
+
+        The after_write callbacks of the records that were sent are called at the end, even if
+        the flush raises.
+        """
+        ready = []
         try:
-            return self.table.update(record_id, properties)
-        except Exception as e:
-            print(f"Error updating record in Airtable: {e}")
-            return None
+            with self._lock:
+                pending = list(self._pending_updates.items())
+                self._pending_updates = {}
+                self._pending_since = None
+
+                failures = {}
+                for start in range(0, len(pending), MAX_RECORDS_PER_REQUEST):
+                    chunk = pending[start:start + MAX_RECORDS_PER_REQUEST]
+                    self._pace_write()
+                    try:
+                        records = self.table.batch_update(
+                            [{"id": record_id, "fields": fields} for record_id, fields in chunk],
+                            use_field_ids=True,
+                        )
+                        self.metrics.record_writes("airtable", "update_records", len(records))
+                        self._written([record["id"] for record in records], ready)
+                    except Exception as e:
+                        if is_retryable(e):
+                            self._requeue(pending[start:])
+                            raise
+                        records = []
+                        for index, (record_id, fields) in enumerate(chunk):
+                            self._pace_write()
+                            try:
+                                records.append(self.table.update(record_id, fields, use_field_ids=True))
+                                self.metrics.record_writes("airtable", "update_record", 1)
+                                self._written([record_id], ready)
+                            except Exception as e:
+                                if is_retryable(e):
+                                    self._requeue(chunk[index:] + pending[start + len(chunk):])
+                                    raise
+                                failures[record_id] = e
+                                self._write_failed(record_id)
+
+                    if self.tweets_table is not None:
+                        written = dict(chunk)
+                        records = [self._with_written_tweets(record, written[record["id"]]) for record in records]
+                    if self._records_by_id is not None:
+                        for record in records:
+                            self._index_record(record)
+        finally:
+            for callback in ready:
+                callback()
+
+        for record_id, error in failures.items():
+            print(f"Error updating record {record_id} in Airtable: {error}")
+        return failures
+
+    def _written(self, record_ids: List[str], ready: List[Callable[[], None]]) -> None:
+        """Take records that reached Airtable off the after_write callbacks, and add the callbacks
+        that no longer wait for any record to ready."""
+        for waiting, callback in self._write_callbacks:
+            waiting.difference_update(record_ids)
+        ready.extend(callback for waiting, callback in self._write_callbacks if not waiting)
+        self._write_callbacks = [(waiting, callback) for waiting, callback in self._write_callbacks if waiting]
+
+    def _write_failed(self, record_id: str) -> None:
+        """Drop the after_write callbacks of a record whose update failed."""
+        self._failed_record_ids.add(record_id)
+        self._write_callbacks = [
+            (waiting, callback) for waiting, callback in self._write_callbacks if record_id not in waiting
+        ]
+
+    def _queue_update(self, record_id: str, properties: Dict) -> Dict:
+        self._pending_updates.setdefault(record_id, {}).update(properties)
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+        record = {"id": record_id, "fields": dict(properties)}
+        if self._records_by_id is not None:
+            previous = self._records_by_id.get(record_id)
+            if previous is not None:
+                record = {**previous, "fields": {**previous.get("fields", {}), **properties}}
+            self._index_record(record)
+
+        if (
+            len(self._pending_updates) >= self.max_pending_records
+            or time.monotonic() - self._pending_since >= self.max_pending_seconds
+        ):
+            self.flush()
+        return record
+
+    def _requeue(self, updates: List) -> None:
+        """Put updates that could not be sent back in front of any that were queued since."""
+        requeued = dict(updates)
+        for record_id, fields in self._pending_updates.items():
+            requeued[record_id] = {**requeued.get(record_id, {}), **fields}
+        self._pending_updates = requeued
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+    def _pace_write(self) -> None:
+        """Sleep just long enough to stay under Airtable's per-base request limit."""
+        wait = self._last_write_at + 1 / REQUESTS_PER_SECOND - time.monotonic()
+        if wait > 0:
+            self.metrics.record_sleep("airtable", "update_records", wait, "pacing")
+            time.sleep(wait)
+        self._last_write_at = time.monotonic()
+
+    def _iter_pages(self, options: Dict, table: Optional[Table] = None) -> Iterator[List[Dict]]:
+        """Request the pages of a list records read one after the other. If a page fails, the
+        read is continued from that page's offset."""
+        table = table if table is not None else self.table
+        offset = None
+        attempt = 1
+        while True:
+            try:
+                for response in table.api.iterate_requests(
+                    method="get",
+                    url=table.urls.records,
+                    fallback=("post", table.urls.records_post),
+                    options={**options, "offset": offset} if offset else options,
+                ):
+                    yield response.get("records", [])
+                    offset = response.get("offset")
+                    attempt = 1
+                return
+            except Exception as e:
+                if attempt >= PAGE_ATTEMPTS or not is_retryable(e):
+                    raise
+                print(f"Error reading a page of records from Airtable, trying again: {e}")
+                time.sleep(PAGE_RETRY_SECONDS * attempt)
+                attempt += 1
+
+    def _record_response(self, response, *args, **kwargs):
+        self.metrics.record_request("airtable", _endpoint_for_request(response.request),
+                                    response.elapsed.total_seconds(), len(response.content or b""),
+                                    response.status_code)
+
+    def _load_snapshot(self, records: List[Dict]) -> None:
+        self._records_by_id = {}
+        self._record_ids_by_collection_id = {}
+        for record in records:
+            self._index_record(record)
+
+    def _merge_record(self, record: Dict, fields: Optional[Sequence[str]]) -> None:
+        """Add the fields of a partially read record to the snapshot. Airtable leaves empty fields
+        out, so requested fields that are missing from the record are empty now."""
+        previous = self._records_by_id.get(record["id"])
+        if previous is not None and fields is not None:
+            kept = {
+                field: value for field, value in previous.get("fields", {}).items() if field not in fields
+            }
+            record = {**record, "fields": {**kept, **record.get("fields", {})}}
+        self._index_record(record)
+
+    def _index_record(self, record: Dict) -> None:
+        """Add a record to the snapshot, replacing any previous version of it."""
+        previous = self._records_by_id.get(record["id"])
+        if previous is not None:
+            previous_collection_id = _collection_id(previous)
+            if self._record_ids_by_collection_id.get(previous_collection_id) == record["id"]:
+                del self._record_ids_by_collection_id[previous_collection_id]
+
+        self._records_by_id[record["id"]] = record
+        collection_id = _collection_id(record)
+        if collection_id:
+            self._record_ids_by_collection_id[collection_id] = record["id"]
+
+
+class TweetsTable:
+    """The tweet IDs of the collections kept in a table of their own, one record per tweet
+    linked to its collection's record, instead of in the collection's comma-separated tweets field.
+
+    The field is rewritten whole on every update, so writes cost more as a collection grows and
+    large collections run into Airtable's limit on the length of long text. Here new tweets are
+    appended as new records, 10 per request, and nothing else is written.
+
+    The table is read the first time it is needed and kept up-to-date after our own writes.
+    With a mirror only the records created or changed since the last run are read, and the
+    whole table once every full_sync. Only AirtableAPI uses it, under its lock.
+    """
+
+    def __init__(self, airtable: AirtableAPI, table_name: str, mirror: Optional[TweetsTableMirror] = None,
+                 full_sync: timedelta = TWEETS_TABLE_FULL_SYNC):
+        self.airtable = airtable
+        self.table = airtable.table.api.table(airtable.table.base.id, table_name)
+        self.mirror = mirror
+        self.full_sync = full_sync
+        self._tweets_by_record_id: Optional[Dict[str, TweetIdSet]] = None
+        # The IDs of the records of each (collection record ID, tweet ID), to delete them by
+        self._row_ids: Dict[tuple, List[str]] = {}
+
+    def get(self, record_id: str) -> TweetIdSet:
+        """The tweet IDs of a collection, oldest first.
+
+        Args:
+            record_id: Airtable's internal record ID of the collection
+        """
+        if self._tweets_by_record_id is None:
+            self._load()
+        return self._tweets_by_record_id.get(record_id, TweetIdSet())
+
+    def append(self, record_id: str, tweet_ids: Iterable) -> int:
+        """Add tweets to a collection. Tweets it already has are skipped.
+
+        Returns:
+            Number of tweets added
+        """
+        new = TweetIdSet(tweet_ids) - self.get(record_id)
+        rows = [{TweetsFields.TWEET_ID: str(tweet_id), TweetsFields.COLLECTION: [record_id]} for tweet_id in new]
+        for start in range(0, len(rows), MAX_RECORDS_PER_REQUEST):
+            chunk = rows[start:start + MAX_RECORDS_PER_REQUEST]
+            self.airtable._pace_write()
+            created = self.table.batch_create(chunk, use_field_ids=True)
+            self.airtable.metrics.record_writes("airtable", "create_records", len(created))
+            self._add_rows(created)
+            if self.mirror is not None:
+                self.mirror.upsert(created)
+        return len(new)
+
+    def remove(self, record_id: str, tweet_ids: Iterable) -> int:
+        """Delete tweets from a collection. Tweets it does not have are skipped.
+
+        Returns:
+            Number of tweets removed
+        """
+        tweet_ids = [int(tweet_id) for tweet_id in tweet_ids if tweet_id in self.get(record_id)]
+        row_ids = [row_id for tweet_id in tweet_ids for row_id in self._row_ids.get((record_id, tweet_id), [])]
+        for start in range(0, len(row_ids), MAX_RECORDS_PER_REQUEST):
+            chunk = row_ids[start:start + MAX_RECORDS_PER_REQUEST]
+            self.airtable._pace_write()
+            try:
+                self.table.batch_delete(chunk)
+                self.airtable.metrics.record_writes("airtable", "delete_records", len(chunk))
+            except Exception as e:
+                if is_retryable(e):
+                    raise
+                # A record deleted in Airtable since the last full read fails the whole request
+                self._delete_one_by_one(chunk)
+            if self.mirror is not None:
+                self.mirror.delete(chunk)
+        for tweet_id in tweet_ids:
+            self._row_ids.pop((record_id, tweet_id), None)
+        if tweet_ids:
+            self._tweets_by_record_id[record_id] = self._tweets_by_record_id[record_id] - tweet_ids
+        return len(tweet_ids)
+
+    def _delete_one_by_one(self, row_ids: List[str]) -> None:
+        for row_id in row_ids:
+            self.airtable._pace_write()
+            try:
+                self.table.delete(row_id)
+            except Exception as e:
+                if is_retryable(e):
+                    raise
+                print(f"Could not delete {row_id} from the tweets table, it is likely deleted already: {e}")
+                continue
+            self.airtable.metrics.record_writes("airtable", "delete_records", 1)
+
+    def _read_rows(self) -> List[Dict]:
+        """Every record of the table, from the mirror brought up to date or else from Airtable."""
+        options = {"use_field_ids": True, "fields": [TweetsFields.TWEET_ID, TweetsFields.COLLECTION]}
+        started = datetime.now(timezone.utc)
+        sync_times = self.mirror.sync_times() if self.mirror is not None else None
+        if sync_times is None or started - sync_times[1] >= self.full_sync:
+            rows = [row for page in self.airtable._iter_pages(options, table=self.table) for row in page]
+            if self.mirror is not None:
+                self.mirror.replace(rows, started)
+            return rows
+
+        since = sync_times[0] - TWEETS_TABLE_SYNC_MARGIN
+        formula = OR(IS_AFTER(CREATED_TIME(), since), IS_AFTER(LAST_MODIFIED_TIME(), since))
+        changed = [
+            row for page in self.airtable._iter_pages({**options, "formula": str(formula)}, table=self.table)
+            for row in page
+        ]
+        self.mirror.upsert(changed, synced_at=started)
+        return self.mirror.get_rows()
+
+    def _load(self) -> None:
+        tweet_ids_by_record_id = {}
+        self._row_ids = {}
+        for row in self._read_rows():
+            for record_id, tweet_id in self._row_keys(row):
+                tweet_ids_by_record_id.setdefault(record_id, []).append(tweet_id)
+                self._row_ids.setdefault((record_id, tweet_id), []).append(row["id"])
+        self._tweets_by_record_id = {
+            record_id: TweetIdSet(tweet_ids) for record_id, tweet_ids in tweet_ids_by_record_id.items()
+        }
+
+    def _add_rows(self, rows: List[Dict]) -> None:
+        tweet_ids_by_record_id = {}
+        for row in rows:
+            for record_id, tweet_id in self._row_keys(row):
+                tweet_ids_by_record_id.setdefault(record_id, []).append(tweet_id)
+                self._row_ids.setdefault((record_id, tweet_id), []).append(row["id"])
+        for record_id, tweet_ids in tweet_ids_by_record_id.items():
+            self._tweets_by_record_id[record_id] = self.get(record_id).union(tweet_ids)
+
+    @staticmethod
+    def _row_keys(row: Dict) -> List[tuple]:
+        """The (collection record ID, tweet ID) pairs of a record of the table. Records without a
+        valid tweet ID are ignored, and a record linked to several collections counts for each."""
+        fields = row.get("fields", {})
+        tweet_id = str(fields.get(TweetsFields.TWEET_ID, "")).strip()
+        if not tweet_id.isdigit():
+            return []
+        return [(record_id, int(tweet_id)) for record_id in fields.get(TweetsFields.COLLECTION) or []]
+
+
+def _endpoint_for_request(request) -> str:
+    """Name the Airtable endpoint a request was sent to, e.g. list_records for GET /v0/base/table."""
+    segments = urlsplit(request.url).path.strip("/").split("/")
+    if segments[-1] == "listRecords" or (request.method == "GET" and len(segments) == 3):
+        return "list_records"
+    if request.method == "GET":
+        return "get_record"
+    if request.method == "POST":
+        return "create_records"
+    if request.method == "DELETE":
+        return "delete_records"
+    return "update_record" if len(segments) == 4 else "update_records"
+
+
+def _collection_id(record: Dict) -> str:
+    return str(record.get("fields", {}).get(Fields.ID, "")).strip()
@@ -0,0 +1,177 @@
+from dotenv import load_dotenv
+from pyairtable.formulas import AND, Field
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from field_constants import Fields
+
+
+from clients import run_twitter_job
+from config import PAGES_PER_COMMIT, TWITTER_MAX_CONCURRENCY
+from twitter import BudgetExhausted, SEARCH_BACKENDS, SEARCH_ENDPOINT
+from utils import (
+    get_field_value,
+    run_concurrently,
+    search_params_to_query,
+    TweetCommitter,
+)
+
+load_dotenv()
+
+TWITTER_BACKFILL_BACKEND = os.getenv("TWITTER_BACKFILL_BACKEND") or "recent"
+BACKFILL_DAYS = float(os.getenv("BACKFILL_DAYS") or 30)
+BACKFILL_WINDOW_HOURS = float(os.getenv("BACKFILL_WINDOW_HOURS") or 24)
+BACKFILL_MAX_WINDOWS_PER_RUN = int(os.getenv("BACKFILL_MAX_WINDOWS_PER_RUN") or 0) or None
+
+# Only the collections that have search terms, with the fields the search uses
+ENTRY_FIELDS = [Fields.ID, Fields.SEARCH, Fields.TWEETS, Fields.DESCRIPTION]
+ENTRY_FORMULA = str(AND(Field(Fields.ID), Field(Fields.SEARCH)))
+
+# How far back recent search reaches, with a margin for the time between planning and searching
+RECENT_SEARCH_REACH = timedelta(days=7) - timedelta(minutes=5)
+# Search requires end_time to be at least 10 seconds before the request
+END_TIME_MARGIN = timedelta(seconds=30)
+
+
+def search_hash(search_params):
+    """A hash of a collection's search terms that does not depend on their order or spacing."""
+    terms = sorted(term.strip() for term in search_params.split(",") if term.strip())
+    return hashlib.sha256(",".join(terms).encode()).hexdigest()[:16]
+
+
+def time_windows(start_time, end_time, window):
+    """Cut [start_time, end_time) into windows of the given timedelta, newest first. The oldest
+    window is shorter if the range does not divide evenly."""
+    windows = []
+    window_end = end_time
+    while window_end > start_time:
+        window_start = max(window_end - window, start_time)
+        windows.append((window_start, window_end))
+        window_end = window_start
+    return windows
+
+
+def plan_backfill(state, collection_id, search_params, now, days=BACKFILL_DAYS):
+    """
+    The backfill of a collection. A new one is planned, reaching `days` back from now, for
+    collections that were never backfilled and for collections whose search terms changed since,
+    which also forgets the windows searched with the old terms.
+    """
+    digest = search_hash(search_params)
+    backfill = state.get_backfill(collection_id)
+    if backfill is None or backfill["search_hash"] != digest:
+        end_time = now - END_TIME_MARGIN
+        state.plan_backfill(collection_id, digest, end_time - timedelta(days=days), end_time)
+        backfill = state.get_backfill(collection_id)
+    return backfill
+
+
+def pending_windows(state, collection_id, backfill, window, reach=None):
+    """
+    The windows of a backfill that are still to be searched, newest first.
+
+    Args:
+        reach: The oldest time the search backend can search from. Windows that end before it
+            are skipped and windows that start before it are cut at it.
+    """
+    completed = state.get_completed_backfill_windows(collection_id)
+    windows = []
+    for window_start, window_end in time_windows(backfill["start_time"], backfill["end_time"], window):
+        if window_start in completed or (reach is not None and window_end <= reach):
+            continue
+        windows.append((window_start, window_end))
+    return windows
+
+
+def backfill_window(twitter, committer, state, collection_id, query, window_start, window_end,
+                    endpoint=SEARCH_ENDPOINT, reach=None):
+    """
+    Search one window of a collection's backfill to the end, commit what was found and mark the
+    window as done once it is written to Airtable. A window that is cut short is not marked, so
+    it is searched again.
+
+    Returns:
+        Number of tweets found in the window
+    """
+    start_time = max(window_start, reach) if reach is not None else window_start
+    found = 0
+    for page in twitter.iter_search_pages(query, start_time=start_time, end_time=window_end, endpoint=endpoint):
+        committer.add_page(page.tweets)
+        found += len(page.tweets)
+    committer.commit(then=lambda: state.complete_backfill_window(collection_id, window_start, found))
+    return found
+
+
+def run(twitter, airtable, state):
+    """
+    Searches the past of new collections and of collections whose search terms changed, which the
+    regular fetch never reaches. Each backfill is cut into time windows that are searched in
+    parallel and checkpointed one by one, so a backfill carries on over as many runs as it takes.
+    """
+    endpoint = SEARCH_BACKENDS[TWITTER_BACKFILL_BACKEND]
+    now = datetime.now(timezone.utc)
+    reach = now - RECENT_SEARCH_REACH if endpoint == SEARCH_ENDPOINT else None
+
+    entries = [
+        entry for entry in airtable.get_database_entries(fields=ENTRY_FIELDS, formula=ENTRY_FORMULA)
+        if get_field_value(entry, Fields.ID) and get_field_value(entry, Fields.SEARCH)
+    ]
+
+    # Each window is a (collection ID, query, start, end) tuple. Windows are taken from every
+    # collection in turn, newest first, so all backfills move forward at once.
+    windows_by_collection = []
+    for entry in entries:
+        collection_id = get_field_value(entry, Fields.ID)
+        search_params = get_field_value(entry, Fields.SEARCH)
+        backfill = plan_backfill(state, collection_id, search_params, now)
+        query = search_params_to_query(search_params.split(","))
+        windows_by_collection.append([
+            (collection_id, query, window_start, window_end)
+            for window_start, window_end in pending_windows(
+                state, collection_id, backfill, timedelta(hours=BACKFILL_WINDOW_HOURS), reach
+            )
+        ])
+    windows = []
+    for index in range(max(map(len, windows_by_collection), default=0)):
+        windows.extend(
+            collection_windows[index]
+            for collection_windows in windows_by_collection if index < len(collection_windows)
+        )
+    if BACKFILL_MAX_WINDOWS_PER_RUN:
+        windows = windows[:BACKFILL_MAX_WINDOWS_PER_RUN]
+    print(f"Backfilling {len(windows)} windows of {sum(1 for w in windows_by_collection if w)} collections "
+          f"with {endpoint}")
+
+    # Windows of the same collection share a committer, so their merges never overwrite each other
+    committers = {
+        collection_id: TweetCommitter(airtable, collection_id, PAGES_PER_COMMIT)
+        for collection_id in {window[0] for window in windows}
+    }
+
+    def search_window(window):
+        collection_id, query, window_start, window_end = window
+        with twitter.metrics.collection(collection_id):
+            return backfill_window(twitter, committers[collection_id], state, collection_id, query,
+                                   window_start, window_end, endpoint=endpoint, reach=reach)
+
+    results = run_concurrently(search_window, windows, max_workers=TWITTER_MAX_CONCURRENCY)
+    for (collection_id, _, window_start, window_end), found, error in results:
+        window = f"{window_start:%Y-%m-%d %H:%M} to {window_end:%Y-%m-%d %H:%M}"
+        if isinstance(error, BudgetExhausted):
+            print(f"Stopped backfilling {collection_id} from {window}: {error}")
+        elif error is not None:
+            print(f"Error backfilling {collection_id} from {window}: {error}")
+        elif found:
+            print(f"Found {found} tweets for {collection_id} from {window}")
+
+    # Keep what windows that were cut short found, even though they are searched again
+    for committer in committers.values():
+        committer.commit()
+
+
+def main():
+    run_twitter_job("backfill", run)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,76 +1,131 @@
-import os
+import itertools
 from field_constants import Fields
 
-from dotenv import load_dotenv
-
-from airtable import AirtableAPI
-from twitter import TwitterAPI
-from utils import get_field_value, RETWEET_STRING
-
-load_dotenv()
-
-ENVIRONMENT = os.getenv("ENVIRONMENT")
-AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
-AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
-AIRTABLE_TABLE_ID = os.getenv("AIRTABLE_TABLE_ID")
-TWITTER_BEARER_TOKEN = os.getenv("TWITTER_BEARER_TOKEN")
+from pyairtable.formulas import AND, Field
+
+from clients import run_twitter_job
+from config import AIRTABLE_TWEETS_TABLE_ID
+from twitter import BudgetExhausted
+from utils import get_entry_tweets, get_field_value, RETWEET_STRING
+
+# How a looked-up tweet is classified. Everything but OK is removed from collections.
+OK = "ok"
+RETWEET = "retweet"
+DELETED = "deleted"
+# The author's account is suspended or protected
+UNAVAILABLE = "unavailable"
+REMOVED_STATUSES = {RETWEET, DELETED, UNAVAILABLE}
+
+# Only the collections that have tweets, and only their tweets
+ENTRY_FIELDS = [Fields.ID, Fields.TWEETS]
+# Collections whose tweets are all in the tweets table have an empty tweets field
+ENTRY_FORMULA = (
+    str(Field(Fields.ID)) if AIRTABLE_TWEETS_TABLE_ID else str(AND(Field(Fields.ID), Field(Fields.TWEETS)))
+)
+
+
+def classify_tweet(tweet):
+    """Classify a tweet that could be read, given as the dictionary the API returns."""
+    if tweet.get("text", "").startswith(RETWEET_STRING):
+        return RETWEET
+    if any(reference.get("type") == "retweeted" for reference in tweet.get("referenced_tweets") or []):
+        return RETWEET
+    return OK
+
+
+def classify_tweets(response):
+    """Classify the tweets of a lookup response by their data and errors.
+    Tweets that failed for any other reason are left out, so they are looked up again next time."""
+    classifications = {}
+    for tweet in response.data or []:
+        classifications[str(tweet.id)] = classify_tweet(tweet.data)
+
+    for error in response.errors or []:
+        tweet_id = error.get("resource_id") or error.get("value")
+        if not tweet_id:
+            continue
+        if error.get("type", "").endswith("/resource-not-found"):
+            classifications[str(tweet_id)] = DELETED
+        elif error.get("type", "").endswith("/not-authorized-for-resource"):
+            classifications[str(tweet_id)] = UNAVAILABLE
+    return classifications
 
 
-def main():
+def clean_entry(twitter, airtable, entry, state=None, tweet_store=None):
+    """
+    Remove retweets and deleted or unavailable tweets from a collection.
+    With a StateStore, tweets that were classified before are not looked up again. With a
+    TweetStore, tweets that were stored when they were fetched are classified from the store.
     """
-    This script cleans up old collections by removing retweets from the list of tweets.
+    entry_tweets = get_entry_tweets(entry)
+    if not entry_tweets:
+        return
+
+    # Classifications are keyed by the tweet IDs as strings, like the API returns them
+    tweet_ids = [str(tweet_id) for tweet_id in entry_tweets]
+    classifications = state.get_tweet_classifications(tweet_ids) if state is not None else {}
+    unknown_tweets = [tweet_id for tweet_id in tweet_ids if tweet_id not in classifications]
+
+    if unknown_tweets and tweet_store is not None:
+        stored_classifications = {
+            tweet_id: classify_tweet(tweet) for tweet_id, tweet in tweet_store.get_tweets(unknown_tweets).items()
+        }
+        if state is not None:
+            state.record_tweet_classifications(stored_classifications)
+        classifications.update(stored_classifications)
+        unknown_tweets = [tweet_id for tweet_id in unknown_tweets if tweet_id not in stored_classifications]
+
+    if unknown_tweets:
+        # Fetch tweet content to check for retweets
+        new_classifications = classify_tweets(twitter.get_tweets(unknown_tweets))
+        if state is not None:
+            state.record_tweet_classifications(new_classifications)
+        classifications.update(new_classifications)
+
+    tweets_to_remove = [
+        tweet_id for tweet_id in tweet_ids if classifications.get(tweet_id) in REMOVED_STATUSES
+    ]
+
+    if tweets_to_remove:
+        # Remove retweets and unavailable tweets from the list
+        cleaned_tweets = entry_tweets.difference(tweets_to_remove)
+        print(f"Removing {len(tweets_to_remove)} tweets from collection {get_field_value(entry, Fields.ID)}")
+
+        # Update the entry with cleaned tweet list
+        airtable.update_page(
+            entry["id"],
+            {Fields.TWEETS: cleaned_tweets.to_field()}
+        )
+
+
+def run(twitter, airtable, state):
     """
-    # Initialize API clients
-    twitter = TwitterAPI(TWITTER_BEARER_TOKEN, cache=ENVIRONMENT == "local")
-    airtable = AirtableAPI(
-        api_key=AIRTABLE_API_KEY,
-        base_id=AIRTABLE_BASE_ID,
-        table_name=AIRTABLE_TABLE_ID
+    This script cleans up old collections by removing retweets and tweets that were deleted
+    or became unavailable from the list of tweets.
+    """
+    # Collections are cleaned page by page, while the next page of records loads
+    entries = itertools.chain.from_iterable(
+        airtable.iter_database_entries(fields=ENTRY_FIELDS, formula=ENTRY_FORMULA)
     )
-
-    # Get all entries
-    entries = airtable.get_database_entries()
     for entry in entries:
         collection_id = get_field_value(entry, Fields.ID)
         if not collection_id:
             continue
 
-        # Get current tweets
-        entry_tweets = [
-            tweet.strip()
-            for tweet in get_field_value(entry, Fields.TWEETS).split(",")
-            if tweet.strip()
-        ]
-
-        if not entry_tweets:
-            continue
-
         try:
-            # Fetch tweet content to check for retweets
-            tweets = twitter.get_tweets(entry_tweets)
-            if not tweets.data:
-                continue
-
-            tweets_to_remove = []
-            for tweet in tweets.data:
-                if tweet.text.startswith(RETWEET_STRING):
-                    tweets_to_remove.append(str(tweet.id))
-
-            if tweets_to_remove:
-                # Remove retweets from the list
-                cleaned_tweets = [t for t in entry_tweets if t not in tweets_to_remove]
-                print(f"Removing {len(tweets_to_remove)} retweets from collection {collection_id}")
-
-                # Update the entry with cleaned tweet list
-                airtable.update_page(
-                    entry["id"],
-                    {Fields.TWEETS: ",".join(cleaned_tweets)}
-                )
-
+            with twitter.metrics.collection(collection_id):
+                clean_entry(twitter, airtable, entry, state=state, tweet_store=twitter.tweet_store)
+        except BudgetExhausted as e:
+            print(f"Stopping at collection {collection_id}: {e}")
+            break
         except Exception as e:
             print(f"Error processing collection {collection_id}: {e}")
             continue
 
 
+def main():
+    run_twitter_job("clean_old_collections", run, wait_on_rate_limit=True)
+
+
 if __name__ == "__main__":
     main()
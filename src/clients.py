@@ -0,0 +1,74 @@
+import time
+from datetime import timedelta
+
+import config
+from airtable import AirtableAPI
+from metrics import RunMetrics
+from state_store import StateStore
+from tweet_store import TweetStore
+
+
+def make_airtable(metrics):
+    """The Airtable client of a run, which writes in batches on flush() and keeps a mirror of the
+    tweets table in the state directory."""
+    return AirtableAPI(
+        api_key=config.AIRTABLE_API_KEY,
+        base_id=config.AIRTABLE_BASE_ID,
+        table_name=config.AIRTABLE_TABLE_ID,
+        tweets_table=config.AIRTABLE_TWEETS_TABLE_ID,
+        tweets_table_mirror=config.TWEETS_TABLE_MIRROR_PATH,
+        tweets_table_full_sync=timedelta(hours=config.AIRTABLE_TWEETS_FULL_SYNC_HOURS),
+        batch_writes=True,
+        metrics=metrics,
+    )
+
+
+def make_twitter(metrics, state, tweet_store, wait_on_rate_limit=False):
+    """
+    The Twitter client of a run. Its rate limits and unfinished pagination are kept in the state
+    store, and it stops making requests at the run's deadline.
+
+    Args:
+        metrics: RunMetrics of the run
+        state: StateStore of the run
+        tweet_store: TweetStore the tweets fetched are kept in
+        wait_on_rate_limit: Sleep until an exhausted rate limit resets instead of skipping the work,
+            unless TWITTER_NEVER_SLEEP is set
+    """
+    # Imported here, so that a run without Twitter jobs never loads tweepy
+    from twitter import TwitterAPI
+
+    return TwitterAPI(
+        config.TWITTER_BEARER_TOKEN,
+        cache=config.TWITTER_CACHE,
+        cache_path=config.TWITTER_CACHE_PATH,
+        cache_max_entries=config.TWITTER_CACHE_MAX_ENTRIES,
+        max_concurrency=config.TWITTER_MAX_CONCURRENCY,
+        wait_on_rate_limit=wait_on_rate_limit and not config.TWITTER_NEVER_SLEEP,
+        state=state,
+        metrics=metrics,
+        deadline=time.time() + config.RUN_DEADLINE_MINUTES * 60 if config.RUN_DEADLINE_MINUTES else None,
+        tweet_store=tweet_store,
+    )
+
+
+def run_twitter_job(name, run, wait_on_rate_limit=False):
+    """
+    The main() of a job that uses the Twitter client: build the clients and stores, call
+    run(twitter, airtable, state), flush its updates and write the run metrics. The stores are
+    closed and the metrics written even if the job fails.
+    """
+    state = StateStore(config.STATE_PATH)
+    tweet_store = TweetStore(config.TWEET_STORE_PATH)
+    metrics = RunMetrics(name)
+    twitter = make_twitter(metrics, state, tweet_store, wait_on_rate_limit=wait_on_rate_limit)
+    airtable = make_airtable(metrics)
+    try:
+        with metrics.profiling(config.PROFILE, config.METRICS_DIR):
+            run(twitter, airtable, state)
+            airtable.flush()
+    finally:
+        state.close()
+        tweet_store.close()
+        print(f"Twitter cache: {twitter.cache_summary()}")
+        metrics.write(config.METRICS_DIR)
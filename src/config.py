@@ -0,0 +1,30 @@
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+# The settings every job shares. Settings of a single job are read by that job's module.
+ENVIRONMENT = os.getenv("ENVIRONMENT")
+AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
+AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
+AIRTABLE_TABLE_ID = os.getenv("AIRTABLE_TABLE_ID")
+AIRTABLE_TWEETS_TABLE_ID = os.getenv("AIRTABLE_TWEETS_TABLE_ID")
+TWITTER_BEARER_TOKEN = os.getenv("TWITTER_BEARER_TOKEN")
+TWITTER_MAX_CONCURRENCY = int(os.getenv("TWITTER_MAX_CONCURRENCY", "4"))
+PAGES_PER_COMMIT = int(os.getenv("PAGES_PER_COMMIT", "5"))
+STATE_DIR = os.getenv("STATE_DIR", ".state")
+STATE_PATH = os.path.join(STATE_DIR, "state.sqlite3")
+TWEET_STORE_PATH = os.path.join(STATE_DIR, "tweets.sqlite3")
+TWEETS_TABLE_MIRROR_PATH = os.path.join(STATE_DIR, "tweets_table.sqlite3")
+# How often the tweets table is read whole instead of only its records changed since the last run
+AIRTABLE_TWEETS_FULL_SYNC_HOURS = float(os.getenv("AIRTABLE_TWEETS_FULL_SYNC_HOURS") or 24 * 7)
+TWITTER_CACHE = os.getenv("TWITTER_CACHE", "true" if ENVIRONMENT == "local" else "").lower() in ("1", "true", "yes")
+TWITTER_CACHE_PATH = os.path.join(STATE_DIR, "twitter_cache")
+TWITTER_CACHE_MAX_ENTRIES = int(os.getenv("TWITTER_CACHE_MAX_ENTRIES") or 0) or None
+METRICS_DIR = os.getenv("METRICS_DIR") or os.path.join(STATE_DIR, "metrics")
+PROFILE = os.getenv("PROFILE") or None
+# Stop making Twitter requests this many minutes into the run. Unfinished pagination is saved and
+# continued by the next run. No deadline if unset.
+RUN_DEADLINE_MINUTES = float(os.getenv("RUN_DEADLINE_MINUTES") or 0) or None
+# Never sleep on a rate limit, not even in the jobs that otherwise wait for it to reset
+TWITTER_NEVER_SLEEP = os.getenv("TWITTER_NEVER_SLEEP", "").lower() in ("1", "true", "yes")
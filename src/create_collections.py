@@ -1,9 +1,15 @@
 from dotenv import load_dotenv
+from pyairtable.formulas import AND, EQ, Field, NOT, OR, RECORD_ID
+import argparse
+import itertools
+import json
 import os
 from field_constants import Fields
 
 
-from airtable import AirtableAPI
+from clients import make_airtable
+from config import METRICS_DIR, PROFILE
+from metrics import RunMetrics
 from utils import (
     get_field_value,
     generate_collection_id,
@@ -13,23 +19,47 @@ from utils import (
 load_dotenv()
 
 COLLECTION_URL_PREFIX = os.getenv("COLLECTION_URL_PREFIX")
-AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
-AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
-AIRTABLE_TABLE_ID = os.getenv("AIRTABLE_TABLE_ID")
 
+# Only the records that have no collection yet, and only the fields a collection is made from
+ENTRY_FIELDS = [Fields.ID, Fields.NAME, Fields.DESCRIPTION, Fields.SEARCH]
+ENTRY_FORMULA = str(NOT(Field(Fields.ID)))
 
-def main():
+
+def records_formula(record_ids):
+    """A formula that matches the given records, if they have no collection yet."""
+    return str(AND(OR(*[EQ(RECORD_ID(), record_id) for record_id in record_ids]), NOT(Field(Fields.ID))))
+
+
+def dispatch_record_ids(event_path=None):
+    """
+    The record IDs in the payload of the repository_dispatch event that started this workflow
+    run, as "record_ids" (a list) or "record_id". Empty outside such a run.
+
+    Args:
+        event_path: The event payload file. GITHUB_EVENT_PATH by default.
+    """
+    event_path = event_path or os.getenv("GITHUB_EVENT_PATH")
+    if not event_path or not os.path.exists(event_path):
+        return []
+    with open(event_path) as f:
+        payload = json.load(f).get("client_payload") or {}
+    record_ids = payload.get("record_ids") or []
+    if isinstance(record_ids, str):
+        record_ids = record_ids.split(",")
+    if payload.get("record_id"):
+        record_ids = [*record_ids, payload["record_id"]]
+    return [record_id.strip() for record_id in record_ids if record_id.strip()]
+
+
+def run(airtable, record_ids=None):
     """
     Creates new collections for entries that don't have an ID yet.
     Each collection gets a unique ID and URL based on the collection URL prefix.
+    With record_ids, only those records are read; otherwise the whole table is scanned.
     """
-    airtable = AirtableAPI(
-        api_key=AIRTABLE_API_KEY,
-        base_id=AIRTABLE_BASE_ID,
-        table_name=AIRTABLE_TABLE_ID
-    )
-
-    entries = airtable.get_database_entries()
+    formula = records_formula(record_ids) if record_ids else ENTRY_FORMULA
+    # Collections are created page by page, while the next page of records loads
+    entries = itertools.chain.from_iterable(airtable.iter_database_entries(fields=ENTRY_FIELDS, formula=formula))
     for entry in entries:
         collection_id = get_field_value(entry, Fields.ID)
         if not collection_id:
@@ -42,5 +72,27 @@ def main():
                 print(f"Error creating collection: {e}")
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create collections for Airtable records that have none.")
+    parser.add_argument(
+        "record_ids",
+        nargs="*",
+        metavar="RECORD_ID",
+        help="Only create collections for these records. By default, the records in the payload of the "
+             "repository_dispatch event that started the run, or else every record in the table.",
+    )
+    args = parser.parse_args(argv)
+    record_ids = args.record_ids or dispatch_record_ids()
+
+    metrics = RunMetrics("create_collections")
+    airtable = make_airtable(metrics)
+    try:
+        with metrics.profiling(PROFILE, METRICS_DIR):
+            run(airtable, record_ids)
+            airtable.flush()
+    finally:
+        metrics.write(METRICS_DIR)
+
+
 if __name__ == "__main__":
     main()
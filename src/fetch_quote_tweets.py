@@ -1,89 +1,322 @@
 from dotenv import load_dotenv
+from pyairtable.formulas import AND, Field
 import os
-import random
 from field_constants import Fields
 
 
-from airtable import AirtableAPI
-from twitter import TwitterAPI
+from clients import run_twitter_job
+from config import AIRTABLE_TWEETS_TABLE_ID, PAGES_PER_COMMIT, TWITTER_MAX_CONCURRENCY
+from scheduler import CallBudgetScheduler
+from twitter import BudgetExhausted, QUOTES_ENDPOINT
 from utils import (
-    calculate_priority,
     get_entry,
     get_entry_tweets,
     get_field_value,
-    update_entry_tweets,
+    run_concurrently,
+    TweetCommitter,
 )
 
 load_dotenv()
 
-ENVIRONMENT = os.getenv("ENVIRONMENT")
-AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
-AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
-AIRTABLE_TABLE_ID = os.getenv("AIRTABLE_TABLE_ID")
-TWITTER_BEARER_TOKEN = os.getenv("TWITTER_BEARER_TOKEN")
+TWITTER_QUOTE_CALLS_PER_RUN = int(os.getenv("TWITTER_QUOTE_CALLS_PER_RUN") or 0) or None
+TWITTER_QUOTE_MAX_PAGES_PER_TWEET = int(os.getenv("TWITTER_QUOTE_MAX_PAGES_PER_TWEET") or 0) or None
+TWITTER_QUOTE_ENGAGEMENT = os.getenv("TWITTER_QUOTE_ENGAGEMENT", "").lower() in ("1", "true", "yes")
+TWITTER_QUOTE_MAX_DEPTH = int(os.getenv("TWITTER_QUOTE_MAX_DEPTH") or 0) or None
+
+# Only the collections that have tweets, without the fields quote tweets do not depend on
+ENTRY_FIELDS = [Fields.ID, Fields.TWEETS, Fields.CREATED_DATE, Fields.DESCRIPTION]
+# Collections whose tweets are all in the tweets table have an empty tweets field
+ENTRY_FORMULA = (
+    str(Field(Fields.ID)) if AIRTABLE_TWEETS_TABLE_ID else str(AND(Field(Fields.ID), Field(Fields.TWEETS)))
+)
+
+
+def quote_cursor_key(collection_id, tweet_id):
+    """The key a collection's quote tweet cursor of one of its tweets is saved under. A tweet in
+    several collections is paginated by each of them on its own."""
+    return f"{collection_id}:{tweet_id}"
+
+
+def saved_quote_cursors(state, collection_id):
+    """The quote tweet cursors an earlier run saved for a collection, by tweet ID."""
+    prefix = quote_cursor_key(collection_id, "")
+    return {
+        key[len(prefix):]: cursor for key, cursor in state.get_cursors(QUOTES_ENDPOINT).items()
+        if key.startswith(prefix) and collection_id in cursor["collection_ids"]
+    }
 
 
-def get_quote_tweets(twitter, airtable, collection_id):
+def get_quote_tweets(twitter, airtable, collection_id, max_workers=1, max_calls=None, state=None,
+                     max_pages_per_tweet=None, pages_per_commit=None, tweet_ids=None, quote_counts=None):
     """
-    Fetch quote tweets for all tweets in a collection.
+    Fetch quote tweets for all tweets in a collection, or the given ones.
 
     Args:
         twitter: TwitterAPI instance
         airtable: AirtableAPI instance
         collection_id: ID of the collection to fetch quote tweets for
+        max_workers: Number of tweets to fetch quote tweets for at once
+        max_calls: Maximum number of quote tweet calls to make. If there are fewer calls than
+            tweets, the tweets checked longest ago are checked, never checked ones first.
+        state: StateStore with the highest quote tweet ID the collection has seen for each of its
+            tweets. Pagination stops
+            once it reaches that ID, and the IDs are moved forward afterwards.
+        max_pages_per_tweet: Maximum number of pages to read for a single tweet
+        pages_per_commit: Commit the quote tweets found every this many pages, across all tweets.
+            By default everything is committed at the end.
+        tweet_ids: IDs of the collection's tweets to check, newest first. All of them by default.
+        quote_counts: The current quote count of the tweets, saved in the state store for every
+            tweet whose quote tweets are fetched to the end
     """
     if not collection_id:
         return
 
-    # Re-fetch the entry to make sure it's up-to-date
+    # Look the entry up in the run snapshot, which already reflects our own earlier writes
     entry = get_entry(airtable, collection_id)
 
     if entry is None:
         return
 
     og_tweets = get_entry_tweets(entry)
-    new_tweets = []
+    committer = TweetCommitter(airtable, collection_id, pages_per_commit)
 
-    for tweet_id in og_tweets:
-        try:
-            quote_tweets = twitter.get_quote_tweets_for_tweet(tweet_id)
-            if quote_tweets:
-                new_tweets.extend(quote_tweets)
-                print(f"Found {len(quote_tweets)} quote tweets for tweet {tweet_id}")
-        except Exception as e:
-            print(f"Error fetching quote tweets for {tweet_id}: {e}")
+    # The tweets are checked with their IDs as strings like the API returns them. Tweets whose
+    # pagination an earlier run left unfinished are continued first, then the tweets never checked,
+    # newest first, then the ones checked longest ago, so a budget smaller than the collection
+    # still gets round to every tweet over the next runs.
+    saved = saved_quote_cursors(state, collection_id) if state is not None else {}
+    if tweet_ids is None:
+        tweet_ids = [str(tweet_id) for tweet_id in og_tweets.newest(len(og_tweets))]
+    checked_at = state.get_quote_check_times(collection_id, tweet_ids) if state is not None else {}
+    tweets_to_check = sorted(tweet_ids, key=lambda tweet_id: (tweet_id not in saved, checked_at.get(tweet_id, "")))
+    max_pages = max_pages_per_tweet
+    if max_calls is not None:
+        tweets_to_check = tweets_to_check[:max_calls]
+        budget_pages = max(max_calls // max(len(tweets_to_check), 1), 1)
+        max_pages = min(budget_pages, max_pages) if max_pages is not None else budget_pages
+
+    # Where the pagination of every tweet got to, kept up to date after every page
+    cursors = {}
+
+    def fetch_quote_tweets(tweet_id):
+        """Stream the quote tweets of one tweet into the committer, continuing from the saved
+        cursor if there is one. Returns the number of quote tweets found."""
+        options = {}
+        if max_pages is not None:
+            options["max_pages"] = max_pages
+        cursor = saved.get(tweet_id)
+        if cursor is not None:
+            options["pagination_token"] = cursor["next_token"]
+            options["stop_at_id"] = cursor["since_id"]
+        else:
+            cursor = {"next_token": None, "newest_id": None, "collection_ids": [collection_id]}
+            if state is not None:
+                options["stop_at_id"] = state.get_quote_watermark(collection_id, tweet_id)
+            cursor["since_id"] = options.get("stop_at_id")
+        cursors[tweet_id] = cursor
+
+        found = 0
+        pages = 0
+        for page in twitter.iter_quote_tweet_pages(tweet_id, **options):
+            committer.add_page(page.tweets)
+            found += len(page.tweets)
+            pages += 1
+            cursor["newest_id"] = max([int(tweet["id"]) for tweet in page.tweets] + [cursor["newest_id"] or 0]) or None
+            cursor["next_token"] = page.next_token
+        # Fewer pages than allowed means the quote tweets ran out, even if the last page was empty
+        if max_pages is None or pages < max_pages:
+            cursor["next_token"] = None
+        return found
+
+    results = run_concurrently(fetch_quote_tweets, tweets_to_check, max_workers=max_workers)
+    errors = {tweet_id: error for tweet_id, _, error in results if error is not None}
+    for tweet_id, found, error in results:
+        if isinstance(error, BudgetExhausted):
             continue
+        if error is not None:
+            print(f"Error fetching quote tweets for {tweet_id}: {error}")
+        elif found:
+            print(f"Found {found} quote tweets for tweet {tweet_id}")
 
-    if new_tweets:
-        update_entry_tweets(airtable, entry, og_tweets, new_tweets)
+    # Only move the watermarks once the quote tweets have been written to Airtable. Tweets whose
+    # pagination was cut short keep their old watermark and save a cursor instead, so the next run
+    # picks up the quotes we did not reach. A cursor that failed for another reason is dropped,
+    # and the next run starts that tweet over from its watermark.
+    def save():
+        for tweet_id, cursor in cursors.items():
+            error = errors.get(tweet_id)
+            key = quote_cursor_key(collection_id, tweet_id)
+            if error is not None and not isinstance(error, BudgetExhausted):
+                state.delete_cursor(QUOTES_ENDPOINT, key)
+            elif cursor["next_token"] is not None:
+                state.save_cursor(QUOTES_ENDPOINT, key, cursor)
+            elif error is None:
+                state.record_quote_watermark(collection_id, tweet_id, cursor["newest_id"])
+                state.delete_cursor(QUOTES_ENDPOINT, key)
+                if quote_counts and tweet_id in quote_counts:
+                    state.record_quote_counts(collection_id, {tweet_id: quote_counts[tweet_id]})
+        state.record_quote_check(collection_id)
 
+    committer.commit(then=save if state is not None else None)
 
-def main():
-    # Initialize API clients
-    twitter = TwitterAPI(TWITTER_BEARER_TOKEN, cache=ENVIRONMENT == "local")
-    airtable = AirtableAPI(
-        api_key=AIRTABLE_API_KEY,
-        base_id=AIRTABLE_BASE_ID,
-        table_name=AIRTABLE_TABLE_ID
+    # Let the run know it has to stop
+    for error in errors.values():
+        if isinstance(error, BudgetExhausted):
+            raise error
+
+
+def find_tweets_with_new_quotes(twitter, entries, state=None, max_depth=None):
+    """
+    Look up the current quote counts of the tweets of several collections, 100 tweets per call,
+    and pick the tweets whose quote tweets are worth fetching for each collection: the ones quoted
+    more often than when the collection last fetched their quote tweets to the end, and the ones
+    whose pagination an earlier run left unfinished for the collection.
+
+    Args:
+        twitter: TwitterAPI instance
+        entries: Airtable records of the collections
+        state: StateStore with the quote counts of the tweets checked before
+        max_depth: How many levels of quotes to collect. With 1, only the quotes of tweets that do
+            not themselves quote a tweet in the collections are fetched. Unlimited by default.
+
+    Returns:
+        Tuple of the IDs of the tweets to check per collection ID, newest first, and the current
+        quote count of every tweet that could be looked up
+    """
+    tweet_ids_by_collection = {}
+    for entry in entries:
+        tweets = get_entry_tweets(entry)
+        tweet_ids_by_collection[get_field_value(entry, Fields.ID)] = [
+            str(tweet_id) for tweet_id in tweets.newest(len(tweets))
+        ]
+    tweet_ids = sorted({tweet_id for ids in tweet_ids_by_collection.values() for tweet_id in ids}, key=int)
+
+    # Quote counts change all the time, so cached lookups are no good here
+    response = twitter.get_tweets(tweet_ids, refresh=True)
+    tweets = {str(tweet.id): tweet.data for tweet in response.data or []}
+    quote_counts = {
+        tweet_id: (tweet.get("public_metrics") or {}).get("quote_count", 0) for tweet_id, tweet in tweets.items()
+    }
+    depths = quote_depths(tweets)
+
+    tweets_to_check = {}
+    for collection_id, ids in tweet_ids_by_collection.items():
+        known_counts = state.get_quote_counts(collection_id, ids) if state is not None else {}
+        unfinished = saved_quote_cursors(state, collection_id) if state is not None else {}
+        tweets_to_check[collection_id] = [
+            tweet_id for tweet_id in ids
+            if tweet_id in unfinished or (
+                quote_counts.get(tweet_id, 0) > known_counts.get(tweet_id, 0)
+                and (max_depth is None or depths[tweet_id] < max_depth)
+            )
+        ]
+    return tweets_to_check, quote_counts
+
+
+def quote_depths(tweets):
+    """
+    How deep in a chain of quotes each tweet is: 0 for a tweet that quotes none of the others,
+    1 for a tweet that quotes one of those, and so on.
+
+    Args:
+        tweets: Dictionary of tweet IDs to the tweets as the API returns them, with referenced_tweets
+    """
+    def quoted(tweet_id):
+        for reference in tweets[tweet_id].get("referenced_tweets") or []:
+            if reference.get("type") == "quoted" and str(reference.get("id")) in tweets:
+                return str(reference["id"])
+        return None
+
+    depths = {}
+    for tweet_id in tweets:
+        chain = []
+        current = tweet_id
+        while current is not None and current not in depths and current not in chain:
+            chain.append(current)
+            current = quoted(current)
+        # A chain that loops back on itself is counted from where it loops
+        depth = depths[current] if current in depths else -1
+        for chained_id in reversed(chain):
+            depth += 1
+            depths[chained_id] = depth
+    return depths
+
+
+def run(twitter, airtable, state):
+    scheduler = CallBudgetScheduler(
+        QUOTES_ENDPOINT,
+        quota=TWITTER_QUOTE_CALLS_PER_RUN,
+        state=state,
     )
 
-    # Get all entries and calculate their priorities
-    entries = airtable.get_database_entries()
-    entries_with_priority = [
-        (entry, calculate_priority(get_field_value(entry, Fields.CREATED_DATE))) for entry in entries
+    # Split this run's quote tweet calls across collections. Checking a collection takes at
+    # least one call per tweet checked.
+    entries = [
+        entry for entry in airtable.get_database_entries(fields=ENTRY_FIELDS, formula=ENTRY_FORMULA)
+        if get_field_value(entry, Fields.ID) and get_entry_tweets(entry)
     ]
-    entries_with_priority.sort(key=lambda x: x[1], reverse=True)
-
-    # Process entries based on priority
-    for entry, priority in entries_with_priority:
-        collection_id = get_field_value(entry, Fields.ID)
-        if collection_id:
-            # Skip based on priority (newer entries have higher chance of being processed)
-            if random.random() > priority:
-                continue
-
-            print(f"Fetching quote tweets for: {get_field_value(entry, Fields.DESCRIPTION)} (priority: {priority:.2f})")
-            get_quote_tweets(twitter, airtable, collection_id)
+    # Only check the tweets that have been quoted since they were last checked
+    tweets_to_check, quote_counts = None, None
+    if TWITTER_QUOTE_ENGAGEMENT:
+        try:
+            tweets_to_check, quote_counts = find_tweets_with_new_quotes(
+                twitter, entries, state=state, max_depth=TWITTER_QUOTE_MAX_DEPTH
+            )
+        except BudgetExhausted as e:
+            print(f"Stopped looking up quote counts: {e}")
+            return
+        entries = [entry for entry in entries if tweets_to_check[get_field_value(entry, Fields.ID)]]
+        print(f"{sum(len(ids) for ids in tweets_to_check.values())} tweets in {len(entries)} collections "
+              f"have new quote tweets")
+
+    def cost(entry):
+        if tweets_to_check is not None:
+            return len(tweets_to_check[get_field_value(entry, Fields.ID)])
+        return len(get_entry_tweets(entry))
+
+    # Collections with quote tweet pagination that an earlier run left unfinished come first
+    unfinished = {
+        collection_id
+        for cursor in state.get_cursors(QUOTES_ENDPOINT).values()
+        for collection_id in cursor["collection_ids"]
+    }
+    available_calls = scheduler.available_calls(twitter)
+    allocations = scheduler.allocate(entries, available_calls, cost=cost, first=unfinished)
+    print(f"Spending {available_calls} quote tweet calls on {len(allocations)} of {len(entries)} collections")
+
+    for collection_id, calls in allocations.items():
+        entry = get_entry(airtable, collection_id)
+        print(f"Fetching quote tweets for: {get_field_value(entry, Fields.DESCRIPTION)} (calls: {calls})")
+
+    def fetch_collection(collection_id):
+        with twitter.metrics.collection(collection_id):
+            return get_quote_tweets(
+                twitter,
+                airtable,
+                collection_id,
+                max_workers=TWITTER_MAX_CONCURRENCY,
+                max_calls=allocations[collection_id],
+                state=state,
+                max_pages_per_tweet=TWITTER_QUOTE_MAX_PAGES_PER_TWEET,
+                pages_per_commit=PAGES_PER_COMMIT,
+                tweet_ids=tweets_to_check[collection_id] if tweets_to_check is not None else None,
+                quote_counts=quote_counts,
+            )
+
+    # Fetch several collections at once; each collection's results are merged on their own.
+    # TwitterAPI bounds the total number of requests in flight across both levels.
+    results = run_concurrently(fetch_collection, list(allocations), max_workers=TWITTER_MAX_CONCURRENCY)
+    for collection_id, _, error in results:
+        if isinstance(error, BudgetExhausted):
+            print(f"Stopped fetching quote tweets for collection {collection_id}: {error}")
+        elif error is not None:
+            print(f"Error fetching quote tweets for collection {collection_id}: {error}")
+
+    scheduler.save()
+
+
+def main():
+    run_twitter_job("fetch_quote_tweets", run)
 
 
 if __name__ == "__main__":
@@ -1,32 +1,47 @@
 from dotenv import load_dotenv
+from pyairtable.formulas import AND, Field
 import os
-import random
+from datetime import datetime, timedelta, timezone
 from field_constants import Fields
 
 
-from airtable import AirtableAPI
-from twitter import TwitterAPI
+from clients import run_twitter_job
+from config import PAGES_PER_COMMIT, TWITTER_MAX_CONCURRENCY
+from scheduler import CallBudgetScheduler
+from search_planner import build_url_prefix_index, is_batchable, plan_batches, route_tweet
+from twitter import BudgetExhausted, SEARCH_ENDPOINT
 from utils import (
-    calculate_priority,
+    after_write,
     get_entry,
     get_entry_tweets,
     get_field_value,
+    run_concurrently,
     search_params_to_query,
-    update_entry_tweets,
+    TweetCommitter,
 )
 
 load_dotenv()
 
-ENVIRONMENT = os.getenv("ENVIRONMENT")
-AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
-AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
-AIRTABLE_TABLE_ID = os.getenv("AIRTABLE_TABLE_ID")
-TWITTER_BEARER_TOKEN = os.getenv("TWITTER_BEARER_TOKEN")
+TWITTER_SEARCH_CALLS_PER_RUN = int(os.getenv("TWITTER_SEARCH_CALLS_PER_RUN") or 0) or None
+TWITTER_MAX_PAGES_PER_CALL = int(os.getenv("TWITTER_MAX_PAGES_PER_CALL") or 0) or None
+TWITTER_BATCH_SEARCH = os.getenv("TWITTER_BATCH_SEARCH", "").lower() in ("1", "true", "yes")
 
+# Only the collections that have search terms, without the fields the search does not use
+ENTRY_FIELDS = [Fields.ID, Fields.SEARCH, Fields.TWEETS, Fields.CREATED_DATE, Fields.DESCRIPTION]
+ENTRY_FORMULA = str(AND(Field(Fields.ID), Field(Fields.SEARCH)))
 
-def get_tweets_for_entry(twitter, airtable, collection_id):
+# Recent search only reaches back 7 days, so older unfinished searches cannot be continued
+SEARCH_CURSOR_MAX_AGE = timedelta(days=6)
+
+
+def get_tweets_for_entry(twitter, airtable, collection_id, max_pages=None, state=None,
+                         pages_per_commit=None):
     """
     Fetch tweets for a specific collection based on its search parameters.
+    At most max_pages search calls are made, and the tweets found are committed every
+    pages_per_commit pages (or all at the end by default). If a StateStore is given, the search starts from the newest tweet ID
+    recorded there and the watermark is moved forward once the search has run to the end.
+    A search that an earlier run left unfinished is continued first.
     """
     if not collection_id:
         return
@@ -41,58 +56,333 @@ def get_tweets_for_entry(twitter, airtable, collection_id):
     og_tweets = get_entry_tweets(entry)
     print(f"Found {len(og_tweets)} existing tweets")
 
-    last_tweet_id = max(og_tweets) if og_tweets else None
+    last_tweet_id = get_last_tweet_id(entry, state)
+    committer = TweetCommitter(airtable, collection_id, pages_per_commit)
+
+    print("Trying search with last_tweet_id...")
+    found = search_with_cursor(
+        twitter, committer.add_page, committer.commit, [collection_id], query=search_query,
+        last_tweet_id=last_tweet_id, max_pages=max_pages, state=state,
+    )
+
+    if found:
+        print(f"Found {found} new tweets")
+    else:
+        print("No new tweets found")
+
+
+def get_tweets_for_batch(twitter, airtable, batch, url_index, max_pages=None, state=None,
+                         pages_per_commit=None):
+    """
+    Run one search that covers several collections and route the tweets it finds back to their
+    collections by their expanded URLs.
+    """
+    committers = {
+        collection_id: TweetCommitter(airtable, collection_id, pages_per_commit)
+        for collection_id in batch.collection_ids
+    }
+    unrouted = 0
+
+    def route_page(tweets):
+        nonlocal unrouted
+        tweets_by_collection = {}
+        for tweet in tweets:
+            collection_ids = route_tweet(tweet, url_index) & committers.keys()
+            if not collection_ids:
+                unrouted += 1
+            for collection_id in collection_ids:
+                tweets_by_collection.setdefault(collection_id, []).append(tweet)
+        for collection_id, committer in committers.items():
+            committer.add_page(tweets_by_collection.get(collection_id, []))
+
+    def commit(then):
+        for committer in committers.values():
+            committer.commit()
+        after_write(airtable, committers, then)
+
+    # The batch searches everything newer than the oldest watermark in it, so once it has run to
+    # the end every collection in the batch is up to date with its newest tweet
+    found = search_with_cursor(
+        twitter,
+        route_page,
+        commit,
+        batch.collection_ids,
+        query=batch.query,
+        last_tweet_id=str(batch.since_id) if batch.since_id is not None else None,
+        max_pages=max_pages,
+        state=state,
+        tweet_fields=["entities"],
+    )
+    print(f"Found {found} tweets for {len(batch.collection_ids)} collections ({unrouted} unrouted)")
+
 
+def search_with_cursor(twitter, on_page, commit, collection_ids, query, last_tweet_id=None,
+                       max_pages=None, state=None, tweet_fields=None):
+    """
+    Search for tweets and hand the tweets of every page to on_page, continuing from the cursor of
+    an earlier run that left the same search unfinished before starting a new one.
+
+    If the search stops before its last page, because it used up max_pages or the run ran out of
+    rate limit or time, its cursor is saved in the state store for the next run. Watermarks only
+    move once a search has run to its end. commit(then) commits the tweets found and calls `then`
+    once they are written to Airtable, and all of that is saved from `then`, so the state never
+    gets ahead of the tweets in Airtable.
+
+    Returns:
+        The number of tweets found
+    """
+    options = {"query": query}
+    if tweet_fields:
+        options["tweet_fields"] = tweet_fields
+    found = 0
+
+    saved = state.get_cursor(SEARCH_ENDPOINT, query) if state is not None else None
+    if saved is not None:
+        print("Resuming the search where the last run stopped...")
+        try:
+            resumed, pages = checkpointed_search(twitter, on_page, commit, saved, state, max_pages, **options)
+        except BudgetExhausted:
+            raise
+        except Exception as e:
+            print(f"Could not resume the search, starting over: {e}")
+            state.delete_cursor(SEARCH_ENDPOINT, query)
+        else:
+            found += resumed
+            if max_pages is not None:
+                max_pages -= pages
+            if saved["next_token"] is not None or max_pages == 0:
+                return found
+            # Carry on with anything newer than what the resumed search started from
+            frontier = [tweet_id for tweet_id in (saved["newest_id"], saved["since_id"]) if tweet_id is not None]
+            last_tweet_id = str(max(frontier)) if frontier else None
+
+    cursor = new_cursor(collection_ids, last_tweet_id)
     try:
-        print("Trying search with last_tweet_id...")
-        new_tweets = twitter.search_tweets(
-            query=search_query,
-            last_tweet_id=last_tweet_id
-        )
+        found += checkpointed_search(twitter, on_page, commit, cursor, state, max_pages, **options)[0]
+    except BudgetExhausted:
+        raise
     except Exception:
         print("Trying search without last_tweet_id...")
-        new_tweets = twitter.search_tweets(query=search_query, last_tweet_id=None)
+        cursor = new_cursor(collection_ids, None)
+        found += checkpointed_search(twitter, on_page, commit, cursor, state, max_pages, **options)[0]
+    return found
 
-    if new_tweets:
-        print(f"Found {len(new_tweets)} new tweets")
-        update_entry_tweets(airtable, entry, og_tweets, new_tweets)
-    else:
-        print("No new tweets found")
 
+def new_cursor(collection_ids, since_id=None):
+    """The cursor of a search that has not fetched any page yet."""
+    return {
+        "next_token": None,
+        "since_id": int(since_id) if since_id else None,
+        "newest_id": None,
+        "collection_ids": list(collection_ids),
+    }
 
-def main():
-    # Initialize API clients
-    twitter = TwitterAPI(TWITTER_BEARER_TOKEN, cache=ENVIRONMENT == "local")
-    airtable = AirtableAPI(
-        api_key=AIRTABLE_API_KEY,
-        base_id=AIRTABLE_BASE_ID,
-        table_name=AIRTABLE_TABLE_ID
+
+def checkpointed_search(twitter, on_page, commit, cursor, state, max_pages=None, **search_params):
+    """
+    Run one search from a cursor, then commit and save where it got to: the cursor if the search
+    stopped early, or the collections' watermarks if it ran to the end.
+
+    Returns:
+        Tuple of the number of tweets found and the number of pages read
+    """
+    query = search_params["query"]
+
+    def save(cursor):
+        if state is None:
+            return
+        if cursor["next_token"] is not None:
+            state.save_cursor(SEARCH_ENDPOINT, query, cursor)
+        else:
+            for collection_id in cursor["collection_ids"]:
+                record_watermark(state, collection_id, cursor["newest_id"], cursor["since_id"])
+            state.delete_cursor(SEARCH_ENDPOINT, query)
+
+    # The cursor is only saved once the tweets are written, so save a copy of where it is now
+    try:
+        found, pages = stream_search(twitter, on_page, cursor, max_pages=max_pages, **search_params)
+    except BudgetExhausted:
+        stopped = dict(cursor)
+        commit(lambda: save(stopped) if stopped["next_token"] is not None else None)
+        raise
+    finished = dict(cursor)
+    commit(lambda: save(finished))
+    return found, pages
+
+
+def stream_search(twitter, on_page, cursor, max_pages=None, **search_params):
+    """
+    Run a search from a cursor and hand the tweets of every page to on_page as soon as the page
+    arrives. The cursor's next_token and newest_id are kept up to date after every page, so that
+    wherever the search stops, the cursor says where to continue. next_token is None once the
+    search has run to its last page.
+
+    Returns:
+        Tuple of the number of tweets found and the number of pages read
+    """
+    params = dict(search_params, last_tweet_id=str(cursor["since_id"]) if cursor["since_id"] else None)
+    if cursor["next_token"] is not None:
+        params["next_token"] = cursor["next_token"]
+
+    found = 0
+    pages = 0
+    for page in twitter.iter_search_pages(max_pages=max_pages, **params):
+        on_page(page.tweets)
+        found += len(page.tweets)
+        pages += 1
+        cursor["newest_id"] = max([int(tweet["id"]) for tweet in page.tweets] + [cursor["newest_id"] or 0]) or None
+        cursor["next_token"] = page.next_token
+
+    # Fewer pages than allowed means the results ran out, even if the last page was empty
+    if max_pages is None or pages < max_pages:
+        cursor["next_token"] = None
+    return found, pages
+
+
+def get_last_tweet_id(entry, state=None):
+    """The newest tweet ID already stored for a collection, as the string since_id expects."""
+    last_tweet_id = None
+    if state is not None:
+        last_tweet_id = state.get_newest_tweet_id(get_field_value(entry, Fields.ID))
+    if last_tweet_id is None:
+        last_tweet_id = get_entry_tweets(entry).max()
+    return str(last_tweet_id) if last_tweet_id is not None else None
+
+
+def record_watermark(state, collection_id, newest_id, last_tweet_id):
+    newest_ids = [tweet_id for tweet_id in (newest_id, last_tweet_id) if tweet_id is not None]
+    state.record_fetch(collection_id, max(int(tweet_id) for tweet_id in newest_ids) if newest_ids else None)
+
+
+def drop_unplanned_cursors(state, planned_queries):
+    """
+    Delete the saved searches of collections that this run searches with a different query.
+    A cursor is saved under its exact query, so once the mix of collections in a batch changes,
+    or a collection's search terms do, it can never be resumed. Their watermarks have not moved,
+    so the new searches cover the same tweets.
+
+    Args:
+        state: StateStore
+        planned_queries: The query each collection searched in this run is searched with
+    """
+    for query, cursor in state.get_cursors(SEARCH_ENDPOINT).items():
+        if any(
+            collection_id in planned_queries and planned_queries[collection_id] != query
+            for collection_id in cursor["collection_ids"]
+        ):
+            print(f"Dropping the unfinished search for {', '.join(cursor['collection_ids'])}: its query changed")
+            state.delete_cursor(SEARCH_ENDPOINT, query)
+
+
+def run(twitter, airtable, state):
+    scheduler = CallBudgetScheduler(
+        SEARCH_ENDPOINT,
+        quota=TWITTER_SEARCH_CALLS_PER_RUN,
+        state=state,
     )
 
-    # Get all entries and calculate their priorities
-    entries = airtable.get_database_entries()
+    # Searches that an earlier run left unfinished are continued before any new ones
+    state.delete_cursors_saved_before(SEARCH_ENDPOINT, datetime.now(timezone.utc) - SEARCH_CURSOR_MAX_AGE)
+    unfinished = {
+        collection_id
+        for cursor in state.get_cursors(SEARCH_ENDPOINT).values()
+        for collection_id in cursor["collection_ids"]
+    }
 
-    # Need to use manual 'CREATED_DATE' field rather than createdTime because old entries were migrated
-    entries_with_priority = [
-        (entry, calculate_priority(get_field_value(entry, Fields.CREATED_DATE))) for entry in entries
+    # Split this run's search calls across the collections that have search terms
+    entries = [
+        entry for entry in airtable.get_database_entries(fields=ENTRY_FIELDS, formula=ENTRY_FORMULA)
+        if get_field_value(entry, Fields.ID) and get_field_value(entry, Fields.SEARCH)
     ]
-    entries_with_priority.sort(key=lambda x: x[1], reverse=True)
-
-    # Process entries based on priority
-    for entry, priority in entries_with_priority:
-        collection_id = get_field_value(entry, Fields.ID)
-        if collection_id:
-            # Skip based on priority (newer entries have higher chance of being processed)
-            if random.random() > priority:
-                continue
-
-            search_params = get_field_value(entry, Fields.SEARCH)
-            if not search_params:
-                continue
-
-            print(
-                f"Fetching tweets for: {get_field_value(entry, Fields.DESCRIPTION)} (priority: {priority:.2f})")
-            get_tweets_for_entry(twitter, airtable, collection_id)
+    available_calls = scheduler.available_calls(twitter)
+    allocations = scheduler.allocate(entries, available_calls, first=unfinished)
+    print(f"Spending {available_calls} search calls on {len(allocations)} of {len(entries)} collections")
+
+    for collection_id, calls in allocations.items():
+        entry = get_entry(airtable, collection_id)
+        print(f"Fetching tweets for: {get_field_value(entry, Fields.DESCRIPTION)} (calls: {calls})")
+
+    def page_limit(calls):
+        return min(calls, TWITTER_MAX_PAGES_PER_CALL) if TWITTER_MAX_PAGES_PER_CALL else calls
+
+    # Each task is a (collection, description, function) triple. The collection labels the
+    # task's calls in the run metrics.
+    tasks = []
+    individual_ids = list(allocations)
+    planned_queries = {}
+    if TWITTER_BATCH_SEARCH:
+        # Collections that only search for URLs share queries, and results are routed back by URL
+        batchable = [
+            entry for entry in (get_entry(airtable, collection_id) for collection_id in allocations)
+            if is_batchable(entry)
+        ]
+        url_index = build_url_prefix_index(batchable)
+        since_ids = {}
+        for entry in batchable:
+            last_tweet_id = get_last_tweet_id(entry, state)
+            since_ids[get_field_value(entry, Fields.ID)] = int(last_tweet_id) if last_tweet_id else None
+        batches = plan_batches(batchable, since_ids=since_ids)
+        print(f"Searching {len(batchable)} collections with {len(batches)} batched queries")
+        planned_queries.update({
+            collection_id: batch.query for batch in batches for collection_id in batch.collection_ids
+        })
+
+        for batch in batches:
+            tasks.append((
+                f"batch:{','.join(batch.collection_ids)}",
+                f"batch of {len(batch.collection_ids)} collections",
+                lambda batch=batch: get_tweets_for_batch(
+                    twitter,
+                    airtable,
+                    batch,
+                    url_index,
+                    max_pages=page_limit(
+                        sum(allocations[collection_id] for collection_id in batch.collection_ids)
+                    ),
+                    state=state,
+                    pages_per_commit=PAGES_PER_COMMIT,
+                ),
+            ))
+        batched_ids = {collection_id for batch in batches for collection_id in batch.collection_ids}
+        individual_ids = [collection_id for collection_id in allocations if collection_id not in batched_ids]
+
+    for collection_id in individual_ids:
+        search_params = get_field_value(get_entry(airtable, collection_id), Fields.SEARCH)
+        planned_queries[collection_id] = search_params_to_query(search_params.split(","))
+    drop_unplanned_cursors(state, planned_queries)
+
+    for collection_id in individual_ids:
+        tasks.append((
+            collection_id,
+            f"collection {collection_id}",
+            lambda collection_id=collection_id: get_tweets_for_entry(
+                twitter,
+                airtable,
+                collection_id,
+                max_pages=page_limit(allocations[collection_id]),
+                state=state,
+                pages_per_commit=PAGES_PER_COMMIT,
+            ),
+        ))
+
+    def run_task(task):
+        collection, _, fetch = task
+        with twitter.metrics.collection(collection):
+            return fetch()
+
+    # Fetch several collections at once; each collection's results are merged on their own
+    results = run_concurrently(run_task, tasks, max_workers=TWITTER_MAX_CONCURRENCY)
+    for (_, description, _), _, error in results:
+        if isinstance(error, BudgetExhausted):
+            print(f"Stopped fetching tweets for {description}: {error}")
+        elif error is not None:
+            print(f"Error fetching tweets for {description}: {error}")
+
+    scheduler.save()
+
+
+def main():
+    run_twitter_job("fetch_tweets", run)
 
 
 if __name__ == "__main__":
@@ -30,3 +30,16 @@ class Fields:
 
     # The date the collection was created, in ISO 8601 format.
     CREATED_DATE = os.getenv("AIRTABLE_FIELD_ID_CREATED_DATE")
+
+
+class TweetsFields:
+    """
+    The Airtable IDs of the fields in the optional tweets table, which stores the tweet IDs of the
+    collections one record per tweet instead of in Fields.TWEETS. See AIRTABLE_TWEETS_TABLE_ID.
+    """
+
+    # The tweet ID, as single line text. Tweet IDs do not fit in a number field without rounding.
+    TWEET_ID = os.getenv("AIRTABLE_TWEETS_FIELD_ID_TWEET_ID")
+
+    # A link to the collection's record in the collections table.
+    COLLECTION = os.getenv("AIRTABLE_TWEETS_FIELD_ID_COLLECTION")
@@ -0,0 +1,262 @@
+import contextlib
+import contextvars
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, Optional
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+PROMETHEUS_PREFIX = "twitter_collections"
+
+# The collection whose work is being done. Context variables follow the work into the threads
+# of utils.run_concurrently.
+_current_collection = contextvars.ContextVar("current_collection", default=None)
+
+
+class RunMetrics:
+    """Counts what a run does, per API endpoint and per collection.
+
+    The API clients record every request (latency, bytes, status), page, write and sleep. The jobs
+    mark the collection they are working on with collection(), so that calls made on its behalf,
+    from any thread, are attributed to it. At the end of a run, write() saves a JSON summary and
+    a Prometheus textfile.
+    """
+
+    def __init__(self, job: str = "run"):
+        self.job = job
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self.endpoints: Dict[tuple, Dict] = {}
+        self.collections: Dict[str, Dict] = {}
+        self.spans = []
+        self.profile: Optional[Dict] = None
+
+    @contextlib.contextmanager
+    def collection(self, collection_id: str):
+        """Attribute everything done inside the block to a collection, and time it."""
+        token = _current_collection.set(collection_id)
+        try:
+            with self.span("collection", collection_id=collection_id):
+                yield
+        finally:
+            _current_collection.reset(token)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **labels):
+        started_at = time.time()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            with self._lock:
+                self.spans.append({"name": name, **labels, "started_at": started_at, "seconds": duration})
+                collection_id = labels.get("collection_id")
+                if name == "collection" and collection_id:
+                    self._collection(collection_id)["seconds"] += duration
+
+    def record_request(self, service: str, endpoint: str, seconds: float, size: int, status: int,
+                       from_cache: bool = False) -> None:
+        with self._lock:
+            stats = self._endpoint(service, endpoint)
+            if from_cache:
+                stats["cache_hits"] += 1
+                return
+            stats["calls"] += 1
+            stats["bytes"] += size
+            stats["statuses"][str(status)] += 1
+            if status >= 400:
+                stats["errors"] += 1
+            stats["latency_seconds_sum"] += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["latency_buckets"][index] += 1
+                    break
+
+            collection_id = _current_collection.get()
+            if collection_id is not None:
+                collection = self._collection(collection_id)
+                collection["calls"][f"{service}.{endpoint}"] += 1
+                collection["bytes"] += size
+                collection["latency_seconds_sum"] += seconds
+
+    def record_page(self, service: str, endpoint: str, items: int) -> None:
+        with self._lock:
+            stats = self._endpoint(service, endpoint)
+            stats["pages"] += 1
+            stats["items"] += items
+            collection_id = _current_collection.get()
+            if collection_id is not None:
+                self._collection(collection_id)["items"] += items
+
+    def record_writes(self, service: str, endpoint: str, records: int) -> None:
+        with self._lock:
+            self._endpoint(service, endpoint)["records_written"] += records
+            collection_id = _current_collection.get()
+            if collection_id is not None:
+                self._collection(collection_id)["records_written"] += records
+
+    def record_sleep(self, service: str, endpoint: str, seconds: float, reason: str) -> None:
+        with self._lock:
+            self._endpoint(service, endpoint)["sleep_seconds"][reason] += seconds
+            collection_id = _current_collection.get()
+            if collection_id is not None:
+                self._collection(collection_id)["sleep_seconds"][reason] += seconds
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                "job": self.job,
+                "started_at": self.started_at,
+                "seconds": time.monotonic() - self._started,
+                "endpoints": [
+                    {
+                        "service": service,
+                        "endpoint": endpoint,
+                        **{key: dict(value) if isinstance(value, Counter) else value
+                           for key, value in stats.items() if key != "latency_buckets"},
+                        "latency_buckets": {
+                            str(bound): count for bound, count in zip(LATENCY_BUCKETS, stats["latency_buckets"])
+                        },
+                    }
+                    for (service, endpoint), stats in sorted(self.endpoints.items())
+                ],
+                "collections": {
+                    collection_id: {**stats, "calls": dict(stats["calls"]), "sleep_seconds": dict(stats["sleep_seconds"])}
+                    for collection_id, stats in sorted(self.collections.items())
+                },
+                "spans": list(self.spans),
+                "profile": self.profile,
+            }
+
+    def to_prometheus(self) -> str:
+        """The per-endpoint metrics in the Prometheus text format, for the node exporter's
+        textfile collector. Per-collection numbers are only in the JSON summary."""
+        summary = self.summary()
+        job = _label_value(self.job)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{_label_value(val)}"' for key, val in labels.items())
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{label_text}}} {value}")
+
+        endpoints = summary["endpoints"]
+
+        def per_endpoint(key):
+            return [({"job": job, "service": e["service"], "endpoint": e["endpoint"]}, e[key]) for e in endpoints]
+
+        metric("api_calls_total", "counter", "API requests sent", per_endpoint("calls"))
+        metric("api_errors_total", "counter", "API requests answered with an error status", per_endpoint("errors"))
+        metric("api_cache_hits_total", "counter", "API requests served from the cache", per_endpoint("cache_hits"))
+        metric("api_pages_total", "counter", "Result pages read", per_endpoint("pages"))
+        metric("api_items_total", "counter", "Items in the result pages read", per_endpoint("items"))
+        metric("api_response_bytes_total", "counter", "Bytes of API responses", per_endpoint("bytes"))
+        metric("api_records_written_total", "counter", "Records written", per_endpoint("records_written"))
+        metric("api_sleep_seconds_total", "counter", "Seconds spent sleeping before requests", [
+            ({"job": job, "service": e["service"], "endpoint": e["endpoint"], "reason": reason}, seconds)
+            for e in endpoints for reason, seconds in e["sleep_seconds"].items()
+        ])
+
+        histogram = []
+        for e in endpoints:
+            labels = {"job": job, "service": e["service"], "endpoint": e["endpoint"]}
+            cumulative = 0
+            for bound, count in e["latency_buckets"].items():
+                cumulative += count
+                histogram.append(({**labels, "le": "+Inf" if bound == "inf" else bound}, cumulative))
+            histogram.append(({**labels, "sum": None}, e["latency_seconds_sum"]))
+            histogram.append(({**labels, "count": None}, e["calls"]))
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_api_latency_seconds API request latency")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_api_latency_seconds histogram")
+        for labels, value in histogram:
+            suffix = "_bucket"
+            if "sum" in labels or "count" in labels:
+                suffix = "_sum" if "sum" in labels else "_count"
+                labels = {key: val for key, val in labels.items() if key not in ("sum", "count")}
+            label_text = ",".join(f'{key}="{_label_value(val)}"' for key, val in labels.items())
+            lines.append(f"{PROMETHEUS_PREFIX}_api_latency_seconds{suffix}{{{label_text}}} {value}")
+
+        metric("run_seconds", "gauge", "Duration of the run", [({"job": job}, summary["seconds"])])
+        metric("run_collections", "gauge", "Collections worked on", [({"job": job}, len(summary["collections"]))])
+        metric("last_run_timestamp_seconds", "gauge", "When the run started", [({"job": job}, self.started_at)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory: str) -> None:
+        """Write <job>.json and <job>.prom to a directory."""
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{self.job}.json"), "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        # Write the textfile atomically, so the collector never reads half of it
+        prometheus_path = os.path.join(directory, f"{self.job}.prom")
+        with open(prometheus_path + ".tmp", "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(prometheus_path + ".tmp", prometheus_path)
+
+    @contextlib.contextmanager
+    def profiling(self, kind: Optional[str], directory: str):
+        """Profile the block with cProfile or tracemalloc, if kind is "cprofile" or "tracemalloc".
+        cProfile stats are saved to <job>.prof; the tracemalloc peak and top allocations are
+        added to the summary."""
+        if kind == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, f"{self.job}.prof")
+                profiler.dump_stats(path)
+                self.profile = {"kind": kind, "path": path}
+        elif kind == "tracemalloc":
+            tracemalloc.start()
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.profile = {
+                    "kind": kind,
+                    "current_bytes": current,
+                    "peak_bytes": peak,
+                    "top_allocations": [
+                        {"location": str(stat.traceback), "bytes": stat.size, "count": stat.count}
+                        for stat in snapshot.statistics("lineno")[:20]
+                    ],
+                }
+        else:
+            yield
+
+    def _endpoint(self, service: str, endpoint: str) -> Dict:
+        key = (service, endpoint)
+        if key not in self.endpoints:
+            self.endpoints[key] = {
+                "calls": 0, "errors": 0, "cache_hits": 0, "bytes": 0, "pages": 0, "items": 0,
+                "records_written": 0, "statuses": Counter(), "sleep_seconds": Counter(),
+                "latency_seconds_sum": 0.0, "latency_buckets": [0] * len(LATENCY_BUCKETS),
+            }
+        return self.endpoints[key]
+
+    def _collection(self, collection_id: str) -> Dict:
+        if collection_id not in self.collections:
+            self.collections[collection_id] = {
+                "calls": Counter(), "items": 0, "records_written": 0, "bytes": 0, "latency_seconds_sum": 0.0,
+                "sleep_seconds": Counter(), "seconds": 0.0,
+            }
+        return self.collections[collection_id]
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
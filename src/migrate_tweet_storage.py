@@ -0,0 +1,60 @@
+from pyairtable.formulas import Field
+import argparse
+from field_constants import Fields
+
+
+from clients import make_airtable
+from config import AIRTABLE_TWEETS_TABLE_ID, METRICS_DIR
+from metrics import RunMetrics
+from utils import get_field_value
+
+# Only the collections that still have tweets in the tweets field
+ENTRY_FIELDS = [Fields.ID, Fields.TWEETS, Fields.DESCRIPTION]
+ENTRY_FORMULA = str(Field(Fields.TWEETS))
+
+
+def run(airtable, clear_field=False):
+    """
+    Copies the tweet IDs of every collection from the tweets field to the tweets table. Tweets that
+    are in the table already are skipped, so the migration can be stopped and run again at any
+    point. The jobs read both places, so they keep working while it runs.
+
+    Args:
+        airtable: AirtableAPI with a tweets table
+        clear_field: Empty the tweets field of each collection once its tweets are in the table
+
+    Returns:
+        Number of tweet IDs copied
+    """
+    entries = airtable.get_database_entries(fields=ENTRY_FIELDS, formula=ENTRY_FORMULA)
+    copied = 0
+    for entry in entries:
+        added = airtable.move_tweets_to_table(entry["id"], clear_field=clear_field)
+        if added:
+            print(f"Copied {added} tweets of {get_field_value(entry, Fields.DESCRIPTION) or entry['id']}")
+        copied += added
+    print(f"Copied {copied} tweets of {len(entries)} collections to the tweets table")
+    return copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Copy the tweet IDs of the collections from the tweets field to the tweets table."
+    )
+    parser.add_argument("--clear-field", action="store_true",
+                        help="Empty the tweets field of each collection once its tweets are in the table.")
+    args = parser.parse_args(argv)
+    if not AIRTABLE_TWEETS_TABLE_ID:
+        parser.error("AIRTABLE_TWEETS_TABLE_ID is not set")
+
+    metrics = RunMetrics("migrate_tweet_storage")
+    airtable = make_airtable(metrics)
+    try:
+        run(airtable, clear_field=args.clear_field)
+        airtable.flush()
+    finally:
+        metrics.write(METRICS_DIR)
+
+
+if __name__ == "__main__":
+    main()
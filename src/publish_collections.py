@@ -0,0 +1,189 @@
+from dotenv import load_dotenv
+from pyairtable.formulas import Field
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from field_constants import Fields
+
+
+from clients import make_airtable
+from config import METRICS_DIR, PROFILE, STATE_DIR, TWEET_STORE_PATH
+from metrics import RunMetrics
+from tweet_store import TweetStore
+from utils import (
+    get_entry_tweets,
+    get_field_value,
+)
+
+load_dotenv()
+
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR") or os.path.join(STATE_DIR, "artifacts")
+ARTIFACTS_GZIP = os.getenv("ARTIFACTS_GZIP", "").lower() in ("1", "true", "yes")
+# How long a superseded artifact is kept, for clients that still hold the manifest pointing to it
+ARTIFACTS_RETENTION_HOURS = float(os.getenv("ARTIFACTS_RETENTION_HOURS") or 24)
+
+# Bumped whenever the layout of the artifacts changes, so the embed can tell them apart
+ARTIFACT_VERSION = 1
+MANIFEST_NAME = "index.json"
+
+# Every collection, with the fields its embed shows
+ENTRY_FIELDS = [Fields.ID, Fields.NAME, Fields.DESCRIPTION, Fields.URL, Fields.TWEETS]
+ENTRY_FORMULA = str(Field(Fields.ID))
+
+
+def build_artifact(entry, tweet_store=None):
+    """
+    The static artifact of a collection: its tweet IDs, deduplicated and newest first, and the
+    fields of every tweet in the tweet store, in the same order.
+
+    Args:
+        entry: Airtable record of the collection
+        tweet_store: TweetStore to hydrate the tweets from. Without it only the IDs are included.
+    """
+    tweet_ids = get_entry_tweets(entry)
+    ids = [str(tweet_id) for tweet_id in tweet_ids.newest(len(tweet_ids))]
+    stored = tweet_store.get_tweets(ids) if tweet_store is not None else {}
+    return {
+        "version": ARTIFACT_VERSION,
+        "collection_id": get_field_value(entry, Fields.ID),
+        "name": get_field_value(entry, Fields.NAME),
+        "description": get_field_value(entry, Fields.DESCRIPTION),
+        "url": get_field_value(entry, Fields.URL),
+        "tweet_ids": ids,
+        "tweets": [stored[tweet_id] for tweet_id in ids if tweet_id in stored],
+    }
+
+
+def serialize_artifact(artifact):
+    """The artifact as compact JSON with sorted keys, so the same content always gives the same bytes."""
+    return json.dumps(artifact, sort_keys=True, separators=(",", ":")).encode()
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def read_manifest(directory):
+    """The manifest written by the last run, or an empty one."""
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"version": ARTIFACT_VERSION, "collections": {}, "superseded": {}}
+
+
+def write_artifacts(entries, directory, tweet_store=None, compress=False, retention=timedelta(hours=24)):
+    """
+    Write the artifact of every collection to collections/<collection ID>.<content hash>.json,
+    optionally gzipped, and an index.json manifest of the current file of each collection.
+
+    A file is only written when its content hash is new, and the manifest only when it changed,
+    so a run where nothing happened writes nothing. Files of earlier versions of a collection
+    and of collections that are gone are listed under "superseded" in the manifest, with when
+    the manifest stopped pointing to them, and removed once they have been superseded for longer
+    than retention. Until then a client that loaded the manifest before can still load them.
+
+    Args:
+        entries: Airtable records of the collections
+        directory: Where to write the files. Its contents are served as they are.
+        tweet_store: TweetStore to hydrate the tweets from
+        compress: Whether to gzip the artifacts
+        retention: How long to keep superseded files
+
+    Returns:
+        Number of artifacts written
+    """
+    manifest = read_manifest(directory)
+    previous = manifest.get("collections", {})
+    previous_superseded = manifest.get("superseded", {})
+    collections = {}
+    written = 0
+    for entry in entries:
+        collection_id = get_field_value(entry, Fields.ID)
+        artifact = build_artifact(entry, tweet_store)
+        data = serialize_artifact(artifact)
+        digest = content_hash(data)
+        name = f"collections/{collection_id}.{digest}.json" + (".gz" if compress else "")
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            # A fixed mtime keeps the gzipped bytes the same for the same content
+            _write_atomically(path, gzip.compress(data, mtime=0) if compress else data)
+            written += 1
+        unchanged = previous.get(collection_id, {}).get("path") == name
+        collections[collection_id] = {
+            "path": name,
+            "hash": digest,
+            "tweet_count": len(artifact["tweet_ids"]),
+            "updated_at": previous[collection_id]["updated_at"] if unchanged else _now(),
+        }
+
+    current = {item["path"] for item in collections.values()}
+    now = _now()
+    superseded = {path: at for path, at in previous_superseded.items() if path not in current}
+    for item in previous.values():
+        if item["path"] not in current:
+            superseded.setdefault(item["path"], now)
+    expired = [
+        path for path, at in superseded.items()
+        if datetime.fromisoformat(now) - datetime.fromisoformat(at) >= retention
+    ]
+    for path in expired:
+        del superseded[path]
+
+    manifest = {"version": ARTIFACT_VERSION, "collections": collections, "superseded": superseded}
+    if collections != previous or superseded != previous_superseded:
+        _write_atomically(os.path.join(directory, MANIFEST_NAME), json.dumps(manifest, indent=2).encode())
+
+    # Only once the manifest no longer lists them
+    for path in expired:
+        try:
+            os.remove(os.path.join(directory, path))
+        except FileNotFoundError:
+            pass
+    return written
+
+
+def run(airtable, tweet_store=None):
+    """
+    Publishes a static artifact of every collection, for the embed to load instead of reading
+    Airtable and Twitter.
+    """
+    entries = airtable.get_database_entries(fields=ENTRY_FIELDS, formula=ENTRY_FORMULA)
+    entries = [entry for entry in entries if get_field_value(entry, Fields.ID)]
+    written = write_artifacts(
+        entries,
+        ARTIFACTS_DIR,
+        tweet_store=tweet_store,
+        compress=ARTIFACTS_GZIP,
+        retention=timedelta(hours=ARTIFACTS_RETENTION_HOURS),
+    )
+    print(f"Published {written} changed artifacts of {len(entries)} collections to {ARTIFACTS_DIR}")
+
+
+def _write_atomically(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def main():
+    metrics = RunMetrics("publish_collections")
+    airtable = make_airtable(metrics)
+    tweet_store = TweetStore(TWEET_STORE_PATH)
+    try:
+        with metrics.profiling(PROFILE, METRICS_DIR):
+            run(airtable, tweet_store)
+    finally:
+        tweet_store.close()
+        metrics.write(METRICS_DIR)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import importlib
+import sys
+from collections import namedtuple
+
+import config
+
+# module: the job's module, which exposes run()
+# uses_twitter: whether run() takes the Twitter client and the state store
+# wait_on_rate_limit: whether the job sleeps on an exhausted rate limit instead of skipping work
+# uses_tweet_store: whether run() takes the tweet store instead of the Twitter client
+Job = namedtuple("Job", ["module", "uses_twitter", "wait_on_rate_limit", "uses_tweet_store"], defaults=[False])
+
+# In the order they run in, so collections created in this run are fetched right away, and the
+# artifacts published at the end include everything fetched
+JOBS = {
+    "create": Job("create_collections", uses_twitter=False, wait_on_rate_limit=False),
+    "fetch-tweets": Job("fetch_tweets", uses_twitter=True, wait_on_rate_limit=False),
+    "fetch-quote-tweets": Job("fetch_quote_tweets", uses_twitter=True, wait_on_rate_limit=False),
+    "clean": Job("clean_old_collections", uses_twitter=True, wait_on_rate_limit=True),
+    "backfill": Job("backfill", uses_twitter=True, wait_on_rate_limit=False),
+    "publish": Job("publish_collections", uses_twitter=False, wait_on_rate_limit=False, uses_tweet_store=True),
+}
+
+
+def run_jobs(names, airtable, twitter=None, state=None, tweet_store=None):
+    """
+    Run jobs one after the other with shared clients. The jobs share the Airtable client's
+    snapshot, but each job reads the records and fields it needs itself, once, since their
+    filter formulas differ. Each job's updates are flushed before the next one starts. A failing job does not stop
+    the ones after it. Each job is timed as a span in the Airtable client's run metrics.
+
+    Returns:
+        List of the names of the jobs that failed
+    """
+    failed = []
+    for name in sorted(set(names), key=list(JOBS).index):
+        job = JOBS[name]
+        print(f"Running {name}")
+        try:
+            # Imported here, so that a run without Twitter jobs never loads tweepy
+            module = importlib.import_module(job.module)
+            with airtable.metrics.span("job", job=name):
+                if job.uses_twitter:
+                    twitter.wait_on_rate_limit = job.wait_on_rate_limit and not config.TWITTER_NEVER_SLEEP
+                    module.run(twitter, airtable, state)
+                elif job.uses_tweet_store:
+                    module.run(airtable, tweet_store)
+                else:
+                    module.run(airtable)
+                airtable.flush()
+        except Exception as e:
+            print(f"Error running {name}: {e}")
+            failed.append(name)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run one or more collection jobs in a single process.",
+    )
+    parser.add_argument(
+        "jobs",
+        nargs="+",
+        choices=list(JOBS) + ["all"],
+        help="The jobs to run. They always run in the order create, fetch-tweets, "
+             "fetch-quote-tweets, clean, backfill, publish. 'all' runs every job.",
+    )
+    args = parser.parse_args(argv)
+    names = list(JOBS) if "all" in args.jobs else args.jobs
+
+    from clients import make_airtable, make_twitter
+    from metrics import RunMetrics
+
+    metrics = RunMetrics("run")
+    airtable = make_airtable(metrics)
+
+    twitter = state = tweet_store = None
+    if any(JOBS[name].uses_twitter or JOBS[name].uses_tweet_store for name in names):
+        from tweet_store import TweetStore
+
+        tweet_store = TweetStore(config.TWEET_STORE_PATH)
+    if any(JOBS[name].uses_twitter for name in names):
+        from state_store import StateStore
+
+        state = StateStore(config.STATE_PATH)
+        # Each job sets whether it waits on a rate limit before it runs
+        twitter = make_twitter(metrics, state, tweet_store)
+
+    try:
+        with metrics.profiling(config.PROFILE, config.METRICS_DIR):
+            failed = run_jobs(names, airtable, twitter, state, tweet_store)
+    finally:
+        if state is not None:
+            state.close()
+        if tweet_store is not None:
+            tweet_store.close()
+        if twitter is not None:
+            print(f"Twitter cache: {twitter.cache_summary()}")
+        metrics.write(config.METRICS_DIR)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+from typing import Callable, Collection, Dict, List, Optional
+
+from field_constants import Fields
+from twitter import QUOTES_ENDPOINT, SEARCH_ENDPOINT
+from utils import calculate_arrival_rate, calculate_priority, get_entry_tweets, get_field_value
+
+# Used when neither a quota is configured nor rate-limit headers have been seen yet.
+# These are the per-app limits for one 15-minute window on the Basic tier.
+DEFAULT_CALLS_PER_RUN = {
+    SEARCH_ENDPOINT: 60,
+    QUOTES_ENDPOINT: 5,
+}
+
+
+class CallBudgetScheduler:
+    """Splits the calls that one Twitter endpoint can make in this run across collections.
+
+    A collection's weight is its recency priority, scaled up by the rate at which it has been
+    receiving tweets lately, plus the weight it carried over from earlier runs that skipped it.
+    Collections are served in order of weight until the budget runs out, and whatever budget is
+    left is handed out as extra calls in proportion to weight.
+    """
+
+    def __init__(self, endpoint: str, quota: Optional[int] = None, state=None):
+        """
+        Args:
+            endpoint: Name of the TwitterAPI endpoint being budgeted, e.g. "search_recent_tweets"
+            quota: Maximum number of calls this run may make, regardless of the rate limit
+            state: StateStore that keeps carried-over weights between runs
+        """
+        self.endpoint = endpoint
+        self.quota = quota
+        self.state = state
+        self.carry_over: Dict[str, float] = state.get_carry_over(endpoint) if state is not None else {}
+
+    def available_calls(self, twitter) -> int:
+        """The number of calls this run may spend: the configured quota, capped by what is left
+        in the current rate-limit window as of the last headers we saw (in this run or the last)."""
+        remaining = twitter.remaining_calls(self.endpoint)
+        if self.quota is None:
+            return remaining if remaining is not None else DEFAULT_CALLS_PER_RUN.get(self.endpoint, 1)
+        return self.quota if remaining is None else min(self.quota, remaining)
+
+    def weight(self, entry: Dict) -> float:
+        # Need to use manual 'CREATED_DATE' field rather than createdTime because old entries were migrated
+        created_date = get_field_value(entry, Fields.CREATED_DATE)
+        priority = calculate_priority(created_date) if created_date else 1.0
+        arrival_rate = calculate_arrival_rate(get_entry_tweets(entry))
+        return priority * (1 + arrival_rate) + self.carry_over.get(get_field_value(entry, Fields.ID), 0.0)
+
+    def allocate(self, entries: List[Dict], available_calls: int,
+                 cost: Callable[[Dict], int] = lambda entry: 1,
+                 first: Collection[str] = ()) -> Dict[str, int]:
+        """Decide how many calls each collection gets in this run.
+
+        Args:
+            entries: Airtable records of the collections that want to make calls
+            available_calls: The total number of calls to hand out
+            cost: The number of calls a collection needs to be fully served
+            first: IDs of collections to serve before all others, e.g. the ones with pagination
+                that an earlier run left unfinished
+
+        Returns:
+            Dictionary of collection IDs to the number of calls they may make, ordered by weight.
+            Collections that get no calls are left out and carry their weight into the next run.
+        """
+        weights = {get_field_value(entry, Fields.ID): self.weight(entry) for entry in entries}
+        costs = {get_field_value(entry, Fields.ID): max(cost(entry), 1) for entry in entries}
+        ranked = sorted(weights, key=lambda collection_id: (collection_id in first, weights[collection_id]),
+                        reverse=True)
+
+        budget = available_calls
+        allocations = {}
+        for collection_id in ranked:
+            calls = min(costs[collection_id], budget)
+            if calls <= 0:
+                break
+            allocations[collection_id] = calls
+            budget -= calls
+
+        # Hand out the remaining budget as extra calls, largest remainders first
+        if allocations and budget > 0:
+            total_weight = sum(weights[collection_id] for collection_id in allocations) or 1.0
+            shares = {
+                collection_id: budget * weights[collection_id] / total_weight
+                for collection_id in allocations
+            }
+            for collection_id, share in shares.items():
+                allocations[collection_id] += int(share)
+            leftover = budget - sum(int(share) for share in shares.values())
+            by_remainder = sorted(shares, key=lambda c: shares[c] - int(shares[c]), reverse=True)
+            for collection_id in by_remainder[:leftover]:
+                allocations[collection_id] += 1
+
+        # Skipped or partially served collections carry the unserved part of their weight over
+        for collection_id in ranked:
+            served = min(allocations.get(collection_id, 0), costs[collection_id]) / costs[collection_id]
+            if served >= 1:
+                self.carry_over.pop(collection_id, None)
+            else:
+                self.carry_over[collection_id] = weights[collection_id] * (1 - served)
+
+        return allocations
+
+    def save(self) -> None:
+        """Persist carried-over weights for the next run."""
+        if self.state is not None:
+            self.state.set_carry_over(self.endpoint, self.carry_over)
@@ -0,0 +1,113 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+from urllib.parse import urlparse
+
+from field_constants import Fields
+from utils import get_field_value, is_valid_http_url, parse_query_params
+
+# The query length limit of the recent search endpoint on the Basic and Pro tiers
+MAX_QUERY_LENGTH = 512
+BASE_QUERY = "-is:retweet"
+
+
+@dataclass
+class SearchBatch:
+    """One search query that covers the URL terms of several collections."""
+    query: str
+    collection_ids: List[str] = field(default_factory=list)
+    since_id: Optional[int] = None
+
+
+def normalize_url(url: str) -> str:
+    """Reduce a URL to a host and path that can be compared as a prefix.
+    The scheme, a leading www., the query string, the fragment and trailing slashes are dropped."""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[len("www."):]
+    return (host + parsed.path).rstrip("/")
+
+
+def get_search_terms(entry: Dict) -> List[str]:
+    return [term.strip() for term in get_field_value(entry, Fields.SEARCH).split(",") if term.strip()]
+
+
+def is_batchable(entry: Dict) -> bool:
+    """Only collections that search for URLs alone can be demultiplexed by URL."""
+    terms = get_search_terms(entry)
+    return bool(terms) and all(is_valid_http_url(term) for term in terms)
+
+
+def build_url_prefix_index(entries: Iterable[Dict]) -> Dict[str, Set[str]]:
+    """Map the normalized URL of every search term to the collections that search for it."""
+    index = {}
+    for entry in entries:
+        collection_id = get_field_value(entry, Fields.ID)
+        for term in get_search_terms(entry):
+            if is_valid_http_url(term):
+                index.setdefault(normalize_url(term), set()).add(collection_id)
+    return index
+
+
+def route_tweet(tweet, index: Dict[str, Set[str]]) -> Set[str]:
+    """Find the collections a tweet belongs to by matching its expanded URLs against the index.
+    A URL matches a search term if the term's normalized URL is a prefix of it at a path boundary,
+    e.g. a link to /pub/my-pub/release/2 matches a search for /pub/my-pub."""
+    entities = tweet.get("entities") or {}
+    collection_ids = set()
+    for url in entities.get("urls", []):
+        for expanded_url in (url.get("unwound_url"), url.get("expanded_url")):
+            if not expanded_url:
+                continue
+            segments = normalize_url(expanded_url).split("/")
+            for end in range(len(segments), 0, -1):
+                collection_ids |= index.get("/".join(segments[:end]), set())
+    return collection_ids
+
+
+def plan_batches(entries: Iterable[Dict], since_ids: Optional[Dict[str, Optional[int]]] = None,
+                 max_query_length: int = MAX_QUERY_LENGTH) -> List[SearchBatch]:
+    """Pack the URL terms of many collections into as few OR-queries as the length limit allows.
+
+    Args:
+        entries: Airtable records of batchable collections
+        since_ids: The newest tweet ID already stored for each collection. A batch searches from
+            the oldest of its collections' watermarks; duplicates are dropped when merging.
+        max_query_length: The maximum length of a single query
+
+    Returns:
+        List of search batches covering every collection exactly once, except collections whose
+        terms alone make a query longer than max_query_length. Splitting those across batches would
+        move their watermark once any one part finishes, so they are left to be searched on their own.
+    """
+    since_ids = since_ids or {}
+    suffix = " " + BASE_QUERY
+    batches = []
+    clauses = []
+    collection_ids = []
+
+    def close_batch():
+        if not clauses:
+            return
+        query = (f"({' OR '.join(clauses)})" if len(clauses) > 1 else clauses[0]) + suffix
+        watermarks = [since_ids.get(collection_id) for collection_id in collection_ids]
+        since_id = None if None in watermarks else min(watermarks)
+        batches.append(SearchBatch(query=query, collection_ids=list(collection_ids), since_id=since_id))
+        clauses.clear()
+        collection_ids.clear()
+
+    # Collections with similar watermarks share batches, so each batch re-reads as little as possible
+    entries = sorted(entries, key=lambda entry: since_ids.get(get_field_value(entry, Fields.ID)) or 0)
+    for entry in entries:
+        clause = " OR ".join(parse_query_params(term) for term in get_search_terms(entry))
+        if len(f"({clause})" + suffix) > max_query_length:
+            print(f"Not batching {get_field_value(entry, Fields.ID)}: its query is longer than {max_query_length}")
+            continue
+        candidate = clauses + [clause]
+        if clauses and len(f"({' OR '.join(candidate)})" + suffix) > max_query_length:
+            close_batch()
+        clauses.append(clause)
+        collection_ids.append(get_field_value(entry, Fields.ID))
+    close_batch()
+
+    return batches
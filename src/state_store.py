@@ -0,0 +1,343 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional, Set
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS collections (
+    collection_id TEXT PRIMARY KEY,
+    newest_tweet_id INTEGER,
+    last_fetch_at TEXT,
+    last_quote_check_at TEXT
+);
+CREATE TABLE IF NOT EXISTS quote_watermarks (
+    collection_id TEXT NOT NULL,
+    source_tweet_id INTEGER NOT NULL,
+    highest_quote_id INTEGER,
+    last_checked_at TEXT,
+    PRIMARY KEY (collection_id, source_tweet_id)
+);
+CREATE TABLE IF NOT EXISTS quote_counts (
+    collection_id TEXT NOT NULL,
+    source_tweet_id INTEGER NOT NULL,
+    quote_count INTEGER NOT NULL,
+    checked_at TEXT NOT NULL,
+    PRIMARY KEY (collection_id, source_tweet_id)
+);
+CREATE TABLE IF NOT EXISTS tweet_classifications (
+    tweet_id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,
+    checked_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    endpoint TEXT PRIMARY KEY,
+    "limit" INTEGER NOT NULL,
+    remaining INTEGER NOT NULL,
+    reset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pagination_cursors (
+    endpoint TEXT NOT NULL,
+    cursor_key TEXT NOT NULL,
+    collection_ids TEXT NOT NULL,
+    next_token TEXT NOT NULL,
+    since_id INTEGER,
+    newest_id INTEGER,
+    saved_at TEXT NOT NULL,
+    PRIMARY KEY (endpoint, cursor_key)
+);
+CREATE TABLE IF NOT EXISTS backfills (
+    collection_id TEXT PRIMARY KEY,
+    search_hash TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    planned_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS backfill_windows (
+    collection_id TEXT NOT NULL,
+    window_start TEXT NOT NULL,
+    tweets_found INTEGER NOT NULL,
+    completed_at TEXT NOT NULL,
+    PRIMARY KEY (collection_id, window_start)
+);
+CREATE TABLE IF NOT EXISTS scheduler_carry_over (
+    endpoint TEXT NOT NULL,
+    collection_id TEXT NOT NULL,
+    weight REAL NOT NULL,
+    PRIMARY KEY (endpoint, collection_id)
+);
+"""
+
+class StateStore:
+    """A small SQLite database that keeps per-collection state between runs.
+
+    The Airtable table only holds the tweet IDs of each collection. Everything else the jobs need
+    to work incrementally (watermarks, fetch times, rate limits, pagination cursors of unfinished
+    searches, backfill progress, scheduler weights) lives here.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Location of the SQLite file. Use ":memory:" for a throwaway store.
+        """
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def get_collection_state(self, collection_id: str) -> Optional[Dict]:
+        """The stored state of a collection, or None if it has never been fetched."""
+        row = self._query_one("SELECT * FROM collections WHERE collection_id = ?", (collection_id,))
+        return dict(row) if row else None
+
+    def get_newest_tweet_id(self, collection_id: str) -> Optional[int]:
+        state = self.get_collection_state(collection_id)
+        return state["newest_tweet_id"] if state else None
+
+    def record_fetch(self, collection_id: str, newest_tweet_id: Optional[int]) -> None:
+        """Record a completed search for a collection. The watermark never moves backwards."""
+        self._execute(
+            """
+            INSERT INTO collections (collection_id, newest_tweet_id, last_fetch_at) VALUES (?, ?, ?)
+            ON CONFLICT (collection_id) DO UPDATE SET
+                newest_tweet_id = NULLIF(MAX(COALESCE(newest_tweet_id, 0), COALESCE(excluded.newest_tweet_id, 0)), 0),
+                last_fetch_at = excluded.last_fetch_at
+            """,
+            (collection_id, newest_tweet_id, _now()),
+        )
+
+    def record_quote_check(self, collection_id: str) -> None:
+        self._execute(
+            """
+            INSERT INTO collections (collection_id, last_quote_check_at) VALUES (?, ?)
+            ON CONFLICT (collection_id) DO UPDATE SET last_quote_check_at = excluded.last_quote_check_at
+            """,
+            (collection_id, _now()),
+        )
+
+    def get_quote_watermark(self, collection_id: str, source_tweet_id: int) -> Optional[int]:
+        """The highest quote tweet ID a collection has seen for one of its tweets, or None if the
+        collection never checked it. A tweet in several collections has a watermark in each."""
+        row = self._query_one(
+            "SELECT highest_quote_id FROM quote_watermarks WHERE collection_id = ? AND source_tweet_id = ?",
+            (collection_id, int(source_tweet_id)),
+        )
+        return row["highest_quote_id"] if row else None
+
+    def record_quote_watermark(self, collection_id: str, source_tweet_id: int,
+                               highest_quote_id: Optional[int]) -> None:
+        """Record that a tweet's quote tweets were checked. The watermark never moves backwards."""
+        self._execute(
+            """
+            INSERT INTO quote_watermarks (collection_id, source_tweet_id, highest_quote_id, last_checked_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (collection_id, source_tweet_id) DO UPDATE SET
+                highest_quote_id = NULLIF(MAX(COALESCE(highest_quote_id, 0), COALESCE(excluded.highest_quote_id, 0)), 0),
+                last_checked_at = excluded.last_checked_at
+            """,
+            (collection_id, int(source_tweet_id), highest_quote_id, _now()),
+        )
+
+    def get_quote_check_times(self, collection_id: str, tweet_ids: Iterable) -> Dict[str, str]:
+        """When a collection last checked the quote tweets of every given tweet to the end, keyed by
+        tweet ID as a string. Tweets the collection never checked are left out."""
+        tweet_ids = [int(tweet_id) for tweet_id in tweet_ids]
+        times = {}
+        for start in range(0, len(tweet_ids), 500):
+            chunk = tweet_ids[start:start + 500]
+            rows = self._query_all(
+                f"SELECT source_tweet_id, last_checked_at FROM quote_watermarks "
+                f"WHERE collection_id = ? AND source_tweet_id IN ({','.join('?' * len(chunk))})",
+                [collection_id] + chunk,
+            )
+            times.update({str(row["source_tweet_id"]): row["last_checked_at"] for row in rows
+                          if row["last_checked_at"] is not None})
+        return times
+
+    def get_quote_counts(self, collection_id: str, tweet_ids: Iterable) -> Dict[str, int]:
+        """The quote count every given tweet had when a collection last fetched its quote tweets to
+        the end, keyed by tweet ID as a string. Tweets that were never fetched that way are left out."""
+        tweet_ids = [int(tweet_id) for tweet_id in tweet_ids]
+        counts = {}
+        for start in range(0, len(tweet_ids), 500):
+            chunk = tweet_ids[start:start + 500]
+            rows = self._query_all(
+                f"SELECT source_tweet_id, quote_count FROM quote_counts "
+                f"WHERE collection_id = ? AND source_tweet_id IN ({','.join('?' * len(chunk))})",
+                [collection_id] + chunk,
+            )
+            counts.update({str(row["source_tweet_id"]): row["quote_count"] for row in rows})
+        return counts
+
+    def record_quote_counts(self, collection_id: str, counts: Dict[str, int]) -> None:
+        now = _now()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO quote_counts (collection_id, source_tweet_id, quote_count, checked_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(collection_id, int(tweet_id), count, now) for tweet_id, count in counts.items()],
+            )
+
+    def get_tweet_classifications(self, tweet_ids: Iterable) -> Dict[str, str]:
+        """The cached classification of every given tweet that has been looked up before,
+        keyed by tweet ID as a string."""
+        tweet_ids = [int(tweet_id) for tweet_id in tweet_ids]
+        classifications = {}
+        # Stay well under SQLite's limit on the number of query parameters
+        for start in range(0, len(tweet_ids), 500):
+            chunk = tweet_ids[start:start + 500]
+            rows = self._query_all(
+                f"SELECT tweet_id, status FROM tweet_classifications "
+                f"WHERE tweet_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            classifications.update({str(row["tweet_id"]): row["status"] for row in rows})
+        return classifications
+
+    def record_tweet_classifications(self, classifications: Dict[str, str]) -> None:
+        now = _now()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO tweet_classifications (tweet_id, status, checked_at) VALUES (?, ?, ?)",
+                [(int(tweet_id), status, now) for tweet_id, status in classifications.items()],
+            )
+
+    def get_rate_limits(self) -> Dict[str, Dict]:
+        rows = self._query_all('SELECT endpoint, "limit", remaining, reset FROM rate_limits')
+        return {row["endpoint"]: {"limit": row["limit"], "remaining": row["remaining"],
+                                  "reset": row["reset"]} for row in rows}
+
+    def record_rate_limit(self, endpoint: str, rate_limit: Dict) -> None:
+        self._execute(
+            'INSERT OR REPLACE INTO rate_limits (endpoint, "limit", remaining, reset) VALUES (?, ?, ?, ?)',
+            (endpoint, rate_limit["limit"], rate_limit["remaining"], rate_limit["reset"]),
+        )
+
+    def get_cursor(self, endpoint: str, key: str) -> Optional[Dict]:
+        """The cursor an earlier run saved when it stopped paginating, or None.
+
+        A cursor is a dictionary of the next_token to continue from, the since_id the pagination
+        started from (None if it had no lower bound), the newest tweet ID it had seen so far and
+        the IDs of the collections it was for.
+        """
+        row = self._query_one(
+            "SELECT * FROM pagination_cursors WHERE endpoint = ? AND cursor_key = ?", (endpoint, str(key))
+        )
+        return _cursor(row) if row else None
+
+    def get_cursors(self, endpoint: str) -> Dict[str, Dict]:
+        """Every saved cursor of an endpoint, by key."""
+        rows = self._query_all("SELECT * FROM pagination_cursors WHERE endpoint = ?", (endpoint,))
+        return {row["cursor_key"]: _cursor(row) for row in rows}
+
+    def save_cursor(self, endpoint: str, key: str, cursor: Dict) -> None:
+        """Save where a pagination stopped. saved_at keeps the time it was first saved, so it
+        tells how old the pagination is however many runs continue it."""
+        self._execute(
+            """
+            INSERT INTO pagination_cursors
+                (endpoint, cursor_key, collection_ids, next_token, since_id, newest_id, saved_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (endpoint, cursor_key) DO UPDATE SET
+                collection_ids = excluded.collection_ids,
+                next_token = excluded.next_token,
+                since_id = excluded.since_id,
+                newest_id = excluded.newest_id
+            """,
+            (endpoint, str(key), ",".join(cursor["collection_ids"]), cursor["next_token"],
+             cursor["since_id"], cursor["newest_id"], _now()),
+        )
+
+    def delete_cursor(self, endpoint: str, key: str) -> None:
+        self._execute("DELETE FROM pagination_cursors WHERE endpoint = ? AND cursor_key = ?", (endpoint, str(key)))
+
+    def delete_cursors_saved_before(self, endpoint: str, saved_before: datetime) -> None:
+        """Forget cursors that are too old to continue from."""
+        self._execute(
+            "DELETE FROM pagination_cursors WHERE endpoint = ? AND saved_at < ?",
+            (endpoint, saved_before.astimezone(timezone.utc).isoformat()),
+        )
+
+    def get_backfill(self, collection_id: str) -> Optional[Dict]:
+        """The backfill planned for a collection: the hash of the search terms it was planned for
+        and its start_time and end_time as datetimes. None if none was planned."""
+        row = self._query_one("SELECT * FROM backfills WHERE collection_id = ?", (collection_id,))
+        if row is None:
+            return None
+        return {
+            "search_hash": row["search_hash"],
+            "start_time": datetime.fromisoformat(row["start_time"]),
+            "end_time": datetime.fromisoformat(row["end_time"]),
+        }
+
+    def plan_backfill(self, collection_id: str, search_hash: str, start_time: datetime,
+                      end_time: datetime) -> None:
+        """Plan a collection's backfill, replacing any earlier plan and the windows it completed."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM backfill_windows WHERE collection_id = ?", (collection_id,))
+            self._connection.execute(
+                "INSERT OR REPLACE INTO backfills (collection_id, search_hash, start_time, end_time, planned_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (collection_id, search_hash, start_time.astimezone(timezone.utc).isoformat(),
+                 end_time.astimezone(timezone.utc).isoformat(), _now()),
+            )
+
+    def get_completed_backfill_windows(self, collection_id: str) -> Set[datetime]:
+        """The start times of the backfill windows of a collection that have been searched."""
+        rows = self._query_all(
+            "SELECT window_start FROM backfill_windows WHERE collection_id = ?", (collection_id,)
+        )
+        return {datetime.fromisoformat(row["window_start"]) for row in rows}
+
+    def complete_backfill_window(self, collection_id: str, window_start: datetime, tweets_found: int) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO backfill_windows (collection_id, window_start, tweets_found, completed_at) "
+            "VALUES (?, ?, ?, ?)",
+            (collection_id, window_start.astimezone(timezone.utc).isoformat(), tweets_found, _now()),
+        )
+
+    def get_carry_over(self, endpoint: str) -> Dict[str, float]:
+        rows = self._query_all(
+            "SELECT collection_id, weight FROM scheduler_carry_over WHERE endpoint = ?", (endpoint,)
+        )
+        return {row["collection_id"]: row["weight"] for row in rows}
+
+    def set_carry_over(self, endpoint: str, weights: Dict[str, float]) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM scheduler_carry_over WHERE endpoint = ?", (endpoint,))
+            self._connection.executemany(
+                "INSERT INTO scheduler_carry_over (endpoint, collection_id, weight) VALUES (?, ?, ?)",
+                [(endpoint, collection_id, weight) for collection_id, weight in weights.items()],
+            )
+
+    def _execute(self, sql: str, params=()) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(sql, params)
+
+    def _query_one(self, sql: str, params=()) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._connection.execute(sql, params).fetchone()
+
+    def _query_all(self, sql: str, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+
+def _cursor(row: sqlite3.Row) -> Dict:
+    return {
+        "next_token": row["next_token"],
+        "since_id": row["since_id"],
+        "newest_id": row["newest_id"],
+        "collection_ids": row["collection_ids"].split(","),
+    }
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
@@ -0,0 +1,96 @@
+import os
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Responses worth retrying: rate limiting and the usual transient gateway and server errors.
+# Anything else (bad request, unauthorized, not found, ...) will fail again, so it is fatal.
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Seconds to wait for a connection and for a response, unless the client sets its own timeout
+DEFAULT_TIMEOUT = (5, 60)
+
+
+def host_overrides_from_env() -> Dict[str, str]:
+    """Read API_HOST_OVERRIDES, a comma-separated list of host=base_url pairs, e.g.
+    "api.twitter.com=http://127.0.0.1:8001". Requests to those hosts are sent to the base URL
+    instead, which lets the jobs run against local stand-ins of the APIs."""
+    overrides = {}
+    for pair in os.getenv("API_HOST_OVERRIDES", "").split(","):
+        if "=" in pair:
+            host, base_url = pair.split("=", 1)
+            overrides[host.strip()] = base_url.strip().rstrip("/")
+    return overrides
+
+
+def build_retry(total: int = 5, statuses: Iterable[int] = RETRYABLE_STATUSES,
+                methods: Iterable[str] = ("GET",), backoff_factor: float = 0.5,
+                backoff_max: float = 60) -> Retry:
+    """A retry policy with jittered exponential backoff that honors Retry-After.
+
+    Args:
+        total: Maximum number of retries of a single request
+        statuses: Response statuses to retry
+        methods: HTTP methods that are safe to send more than once
+        backoff_factor: Base of the exponential backoff, in seconds. Up to as much again is
+            added as random jitter, so clients that failed together do not retry together.
+        backoff_max: Upper bound of a single backoff, in seconds
+
+    Returns:
+        urllib3 Retry. Once the retries run out, the last response is handed back to the client,
+        which raises its usual error for it.
+    """
+    return Retry(
+        total=total,
+        status_forcelist=frozenset(statuses),
+        allowed_methods=frozenset(methods),
+        backoff_factor=backoff_factor,
+        backoff_jitter=backoff_factor,
+        backoff_max=backoff_max,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+class PooledAdapter(HTTPAdapter):
+    """An HTTPAdapter that keeps up to pool_size connections alive per host, retries with the
+    given policy and applies a default timeout to requests that do not set their own.
+    Requests to a host in host_overrides are sent to the base URL it maps to."""
+
+    def __init__(self, pool_size: int = 10, retry: Optional[Retry] = None,
+                 timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+                 host_overrides: Optional[Dict[str, str]] = None):
+        self.timeout = timeout
+        self.host_overrides = host_overrides or {}
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size,
+                         max_retries=retry if retry is not None else build_retry())
+
+    def send(self, request, timeout=None, **kwargs):
+        url = urlsplit(request.url)
+        if url.netloc in self.host_overrides:
+            base_url = urlsplit(self.host_overrides[url.netloc])
+            request.url = urlunsplit((base_url.scheme, base_url.netloc, base_url.path + url.path,
+                                      url.query, url.fragment))
+        return super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+
+
+def mount_transport(session: requests.Session, pool_size: int = 10, retry: Optional[Retry] = None,
+                    timeout: Tuple[float, float] = DEFAULT_TIMEOUT) -> requests.Session:
+    """Replace the connection handling of a client's session with a PooledAdapter."""
+    adapter = PooledAdapter(pool_size=pool_size, retry=retry, timeout=timeout,
+                            host_overrides=host_overrides_from_env())
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an error raised by a client is transient, i.e. the same request may succeed later.
+    By the time a client raises, the transport has already retried it."""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) in RETRYABLE_STATUSES
@@ -0,0 +1,110 @@
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator, List, Optional, Union
+
+# Signed 64-bit integers, which every Snowflake tweet ID fits in
+TYPECODE = "q"
+
+
+class TweetIdSet:
+    """The tweet IDs of a collection, kept as a sorted array of unique 64-bit integers.
+
+    A collection's Airtable field holds thousands of comma-separated IDs. Keeping them as one
+    compact array instead of a list of strings makes merging, membership tests and finding the
+    newest tweet cheap, and the field is only parsed and serialized once per collection.
+    """
+
+    __slots__ = ("_ids",)
+
+    def __init__(self, tweet_ids: Iterable[Union[str, int]] = ()):
+        self._ids = array(TYPECODE, sorted({int(tweet_id) for tweet_id in tweet_ids}))
+
+    @classmethod
+    def _from_sorted(cls, ids: array) -> "TweetIdSet":
+        tweet_ids = cls()
+        tweet_ids._ids = ids
+        return tweet_ids
+
+    @classmethod
+    def from_field(cls, value: Optional[str]) -> "TweetIdSet":
+        """Parse the comma-separated format of the Airtable tweets field. The field can be edited
+        by hand, so blank items and items that are not tweet IDs are skipped."""
+        return cls(item for item in (value or "").split(",") if item.strip().isdigit())
+
+    def to_field(self) -> str:
+        """Serialize to the comma-separated format of the Airtable tweets field, oldest first."""
+        return ",".join(map(str, self._ids))
+
+    def union(self, other: Iterable[Union[str, int]]) -> "TweetIdSet":
+        """Merge the two sorted arrays. The runs of the larger one between the IDs of the smaller
+        one are copied as whole slices, so adding a few IDs to a large set stays cheap."""
+        larger, smaller = self._ids, _ids_of(other)
+        if len(smaller) > len(larger):
+            larger, smaller = smaller, larger
+        merged = array(TYPECODE)
+        start = 0
+        for tweet_id in smaller:
+            index = bisect_left(larger, tweet_id, start)
+            merged.extend(larger[start:index])
+            merged.append(tweet_id)
+            start = index + 1 if index < len(larger) and larger[index] == tweet_id else index
+        merged.extend(larger[start:])
+        return TweetIdSet._from_sorted(merged)
+
+    def difference(self, other: Iterable[Union[str, int]]) -> "TweetIdSet":
+        other = _ids_of(other)
+        if len(other) > len(self._ids):
+            return TweetIdSet._from_sorted(array(TYPECODE, (
+                tweet_id for tweet_id in self._ids if not _contains(other, tweet_id)
+            )))
+        remaining = array(TYPECODE)
+        start = 0
+        for tweet_id in other:
+            index = bisect_left(self._ids, tweet_id, start)
+            remaining.extend(self._ids[start:index])
+            start = index + 1 if index < len(self._ids) and self._ids[index] == tweet_id else index
+        remaining.extend(self._ids[start:])
+        return TweetIdSet._from_sorted(remaining)
+
+    def max(self) -> Optional[int]:
+        """The newest tweet ID, or None if the set is empty."""
+        return self._ids[-1] if self._ids else None
+
+    def newest(self, n: int) -> List[int]:
+        """The n newest tweet IDs, newest first."""
+        return list(reversed(self._ids[-n:])) if n > 0 else []
+
+    def count_at_least(self, tweet_id: int) -> int:
+        """The number of tweet IDs greater than or equal to tweet_id."""
+        return len(self._ids) - bisect_left(self._ids, tweet_id)
+
+    def __or__(self, other: "TweetIdSet") -> "TweetIdSet":
+        return self.union(other)
+
+    def __sub__(self, other: "TweetIdSet") -> "TweetIdSet":
+        return self.difference(other)
+
+    def __contains__(self, tweet_id) -> bool:
+        return _contains(self._ids, int(tweet_id))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, TweetIdSet) and self._ids == other._ids
+
+    def __repr__(self) -> str:
+        return f"TweetIdSet({self._ids.tolist()!r})"
+
+
+def _ids_of(tweet_ids: Iterable[Union[str, int]]) -> array:
+    """The sorted array of unique IDs of a TweetIdSet or any iterable of IDs."""
+    return tweet_ids._ids if isinstance(tweet_ids, TweetIdSet) else TweetIdSet(tweet_ids)._ids
+
+
+def _contains(ids: array, tweet_id: int) -> bool:
+    index = bisect_left(ids, tweet_id)
+    return index < len(ids) and ids[index] == tweet_id
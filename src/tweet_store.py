@@ -0,0 +1,114 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tweets (
+    tweet_id INTEGER PRIMARY KEY,
+    author_id INTEGER,
+    created_at TEXT,
+    text TEXT,
+    data TEXT NOT NULL,
+    fetched_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    data TEXT NOT NULL,
+    fetched_at TEXT NOT NULL
+);
+"""
+
+# Merges the fields of a tweet fetched again into the ones stored before, so a response that
+# asked for fewer fields does not drop any, and counts like public_metrics are kept current
+UPSERT_TWEET = """
+INSERT INTO tweets (tweet_id, author_id, created_at, text, data, fetched_at) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (tweet_id) DO UPDATE SET
+    author_id = COALESCE(excluded.author_id, author_id),
+    created_at = COALESCE(excluded.created_at, created_at),
+    text = COALESCE(excluded.text, text),
+    data = json_patch(data, excluded.data),
+    fetched_at = excluded.fetched_at
+"""
+
+UPSERT_USER = """
+INSERT INTO users (user_id, username, data, fetched_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id) DO UPDATE SET
+    username = COALESCE(excluded.username, username),
+    data = json_patch(data, excluded.data),
+    fetched_at = excluded.fetched_at
+"""
+
+
+class TweetStore:
+    """A SQLite database of the tweets the jobs have fetched, keyed by tweet ID.
+
+    Airtable only holds the IDs of a collection's tweets. Every tweet and author that a search,
+    quote tweet or lookup response contains is upserted here with all the fields that were
+    requested, so classifying or rendering a collection does not need any API call.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Location of the SQLite file. Use ":memory:" for a throwaway store.
+        """
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def record_tweets(self, tweets: Iterable[Dict], users: Iterable[Dict] = ()) -> None:
+        """Upsert tweets and their authors, as the dictionaries the API returns them as."""
+        now = _now()
+        tweet_rows = [
+            (int(tweet["id"]), _int_or_none(tweet.get("author_id")), tweet.get("created_at"), tweet.get("text"),
+             json.dumps(tweet), now)
+            for tweet in tweets
+        ]
+        user_rows = [
+            (int(user["id"]), user.get("username"), json.dumps(user), now)
+            for user in users
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(UPSERT_TWEET, tweet_rows)
+            self._connection.executemany(UPSERT_USER, user_rows)
+
+    def get_tweets(self, tweet_ids: Iterable) -> Dict[str, Dict]:
+        """Every given tweet that is in the store, keyed by tweet ID as a string. Each tweet is
+        the dictionary the API returned, with its author's user under "author" if known."""
+        tweet_ids = [int(tweet_id) for tweet_id in tweet_ids]
+        tweets = {}
+        # Stay well under SQLite's limit on the number of query parameters
+        for start in range(0, len(tweet_ids), 500):
+            chunk = tweet_ids[start:start + 500]
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT tweets.tweet_id, tweets.data, users.data AS author FROM tweets "
+                    f"LEFT JOIN users ON users.user_id = tweets.author_id "
+                    f"WHERE tweets.tweet_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            for row in rows:
+                tweet = json.loads(row["data"])
+                if row["author"] is not None:
+                    tweet["author"] = json.loads(row["author"])
+                tweets[str(row["tweet_id"])] = tweet
+        return tweets
+
+
+def _int_or_none(value) -> Optional[int]:
+    return int(value) if value is not None else None
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
@@ -0,0 +1,89 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tweets_table_rows (
+    row_id TEXT PRIMARY KEY,
+    fields TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tweets_table_sync (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    synced_at TEXT NOT NULL,
+    full_synced_at TEXT NOT NULL
+);
+"""
+
+
+class TweetsTableMirror:
+    """A SQLite copy of the records of the tweets table, kept between runs, so a run only has
+    to read the records created or changed since the last one instead of the whole table.
+
+    Records deleted in Airtable by anyone but the jobs are only noticed by a full read, which
+    replaces the copy. The jobs' own deletes are applied to it as they are made.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Location of the SQLite file. Use ":memory:" for a throwaway mirror.
+        """
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def sync_times(self) -> Optional[Tuple[datetime, datetime]]:
+        """When the copy was last brought up to date, and when it was last replaced by a full
+        read, or None if it has never been filled."""
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM tweets_table_sync WHERE id = 1").fetchone()
+        if row is None:
+            return None
+        return datetime.fromisoformat(row["synced_at"]), datetime.fromisoformat(row["full_synced_at"])
+
+    def get_rows(self) -> List[Dict]:
+        """Every record of the copy, as the dictionaries Airtable returns."""
+        with self._lock:
+            rows = self._connection.execute("SELECT row_id, fields FROM tweets_table_rows").fetchall()
+        return [{"id": row["row_id"], "fields": json.loads(row["fields"])} for row in rows]
+
+    def replace(self, rows: Iterable[Dict], synced_at: datetime) -> None:
+        """Replace the copy with the records of a full read that started at synced_at."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM tweets_table_rows")
+            self._insert(rows)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO tweets_table_sync (id, synced_at, full_synced_at) VALUES (1, ?, ?)",
+                (synced_at.isoformat(), synced_at.isoformat()),
+            )
+
+    def upsert(self, rows: Iterable[Dict], synced_at: Optional[datetime] = None) -> None:
+        """Add or replace records. With synced_at, they are every record created or changed since
+        the last sync, read by a read that started at synced_at."""
+        with self._lock, self._connection:
+            self._insert(rows)
+            if synced_at is not None:
+                self._connection.execute(
+                    "UPDATE tweets_table_sync SET synced_at = ? WHERE id = 1", (synced_at.isoformat(),)
+                )
+
+    def delete(self, row_ids: Iterable[str]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM tweets_table_rows WHERE row_id = ?",
+                                         [(row_id,) for row_id in row_ids])
+
+    def _insert(self, rows: Iterable[Dict]) -> None:
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO tweets_table_rows (row_id, fields) VALUES (?, ?)",
+            [(row["id"], json.dumps(row.get("fields", {}))) for row in rows],
+        )
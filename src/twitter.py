@@ -1,53 +1,530 @@
+import contextvars
+import hashlib
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
 import requests_cache
 import tweepy
 
+from metrics import RunMetrics
+from transport import RETRYABLE_STATUSES, build_retry, mount_transport
+from utils import run_concurrently
+
+SEARCH_ENDPOINT = "search_recent_tweets"
+ARCHIVE_SEARCH_ENDPOINT = "search_all_tweets"
+QUOTES_ENDPOINT = "get_quote_tweets"
+LOOKUP_ENDPOINT = "get_tweets"
+
+# The tweet lookup endpoint accepts at most 100 IDs per request
+MAX_LOOKUP_IDS = 100
+
+# Requested with every tweet, so that the tweet store has everything classifying and rendering
+# a collection needs, and the tweets do not have to be looked up again
+TWEET_FIELDS = ["author_id", "conversation_id", "created_at", "entities", "lang", "public_metrics",
+                "referenced_tweets"]
+EXPANSIONS = ["author_id"]
+USER_FIELDS = ["name", "profile_image_url", "username", "verified"]
+
+# The search endpoints that iter_search_pages can page through, by backend name. Recent search
+# reaches back 7 days; full-archive search needs a plan that includes it.
+SEARCH_BACKENDS = {
+    "recent": SEARCH_ENDPOINT,
+    "archive": ARCHIVE_SEARCH_ENDPOINT,
+}
+
+# The length of a rate-limit window, assumed when a 429 response does not say when it resets
+RATE_LIMIT_WINDOW = 15 * 60
+
+ENDPOINT_PATTERNS = [
+    (re.compile(r"/2/tweets/search/recent(?:\?|$)"), SEARCH_ENDPOINT),
+    (re.compile(r"/2/tweets/search/all(?:\?|$)"), ARCHIVE_SEARCH_ENDPOINT),
+    (re.compile(r"/2/tweets/\d+/quote_tweets(?:\?|$)"), QUOTES_ENDPOINT),
+    (re.compile(r"/2/tweets(?:\?|$)"), LOOKUP_ENDPOINT),
+]
+
+# How long responses of each endpoint may be served from the cache, in seconds. Search results
+# change all the time, quote tweets less so, and a looked-up tweet hardly ever changes. An
+# archive search is only made for time windows that are over.
+DEFAULT_CACHE_TTLS = {
+    SEARCH_ENDPOINT: 60,
+    ARCHIVE_SEARCH_ENDPOINT: 24 * 60 * 60,
+    QUOTES_ENDPOINT: 600,
+    LOOKUP_ENDPOINT: 7 * 24 * 60 * 60,
+}
+DEFAULT_CACHE_PATH = "tweepy_cache"
+
+
+# Set while requests should skip reading the response cache, see TwitterAPI.get_tweets
+_refresh_cache = contextvars.ContextVar("refresh_cache", default=False)
+
+
+class RefreshableCachedSession(requests_cache.CachedSession):
+    """A CachedSession that sends requests made with _refresh_cache set to the API even if they
+    are cached, and caches the fresh responses."""
+
+    def request(self, method, url, *args, **kwargs):
+        if _refresh_cache.get():
+            kwargs["force_refresh"] = True
+        return super().request(method, url, *args, **kwargs)
+
+
+@dataclass
+class Page:
+    """One page of results. next_token is None on the last page."""
+    tweets: list
+    next_token: Optional[str] = None
+
+
+class BudgetExhausted(Exception):
+    """Raised instead of making a request the run has no budget left for."""
+
+
+class RateLimitExhausted(BudgetExhausted):
+    """Raised instead of sleeping when an endpoint has no requests left in its rate-limit window."""
+
+
+class DeadlineReached(BudgetExhausted):
+    """Raised instead of making a request, or sleeping on a rate limit, past the run's deadline."""
+
+
+class Credential:
+    """One bearer token of a TwitterAPI, with its own client and rate-limit buckets per endpoint.
+    The client is only created when the token is first used."""
+
+    def __init__(self, bearer_token, name, primary=False):
+        self.bearer_token = bearer_token
+        # What the state store and the logs know the token as, never the token itself
+        self.name = name
+        # The first token's buckets are stored under the bare endpoint names, so the rate limits
+        # saved by runs with a single token carry over
+        self.primary = primary
+        self.client = None
+        self.rate_limits = {}
+        # Set once the token is rejected (401). Endpoints the token may not call (403) are
+        # disabled one by one.
+        self.revoked = False
+        self.disabled_endpoints = set()
+
+    def usable(self, endpoint):
+        return not self.revoked and endpoint not in self.disabled_endpoints
+
+    def remaining_calls(self, endpoint):
+        """The calls left in the endpoint's current window, or None if they are not known: no
+        headers were seen, or the window of a 429 without headers has passed."""
+        rate_limit = self.rate_limits.get(endpoint)
+        if rate_limit is None:
+            return None
+        if rate_limit["reset"] <= time.time():
+            return rate_limit["limit"]
+        return rate_limit["remaining"]
+
 
 class TwitterAPI:
-    def __init__(self, bearer_token, cache=False):
-        self.client = tweepy.Client(bearer_token=bearer_token, wait_on_rate_limit=True)
+    def __init__(self, bearer_token, cache=False, max_concurrency=1, wait_on_rate_limit=True, state=None,
+                 cache_path=DEFAULT_CACHE_PATH, cache_ttls=None, cache_max_entries=None, metrics=None,
+                 deadline=None, tweet_store=None):
+        """
+        Args:
+            bearer_token: Twitter API bearer token, or several, as a list or separated by commas.
+                Each request is sent with the token that has the most calls left for its endpoint,
+                so the rate limits of all tokens add up. Tokens that are rejected are not used again.
+            cache: Whether to cache responses in a SQLite file, so repeated requests within
+                an endpoint's TTL do not use any quota
+            max_concurrency: Maximum number of requests in flight at once
+            wait_on_rate_limit: Sleep until the rate limit resets instead of raising RateLimitExhausted.
+                With False, the client never sleeps.
+            state: StateStore that keeps the latest rate limits between runs
+            cache_path: Location of the cache. Jobs that point at the same file share their responses.
+            cache_ttls: Seconds to cache each endpoint's responses for, overriding DEFAULT_CACHE_TTLS.
+                A TTL of 0 disables caching for that endpoint.
+            cache_max_entries: Maximum number of cached responses. The ones that expire
+                soonest are evicted when the cache is opened.
+            metrics: RunMetrics that requests, pages and rate-limit sleeps are recorded in
+            deadline: Time, as a time.time() timestamp, after which no request is started. Requests
+                and rate-limit sleeps that would run past it raise DeadlineReached instead.
+            tweet_store: TweetStore that every tweet and author in a response is upserted into
+        """
+        if isinstance(bearer_token, str):
+            bearer_token = bearer_token.split(",")
+        tokens = [token.strip() for token in bearer_token if token and token.strip()] or [""]
+        self.credentials = [
+            Credential(token, _credential_name(token), primary=index == 0) for index, token in enumerate(tokens)
+        ]
+        self._credentials_lock = threading.Lock()
+        self._rejection = None
+
+        self.wait_on_rate_limit = wait_on_rate_limit
+        self.deadline = deadline
+
+        # Bounds the number of requests in flight when the API is shared between threads
+        self.max_concurrency = max_concurrency
+        self._request_slots = threading.BoundedSemaphore(max_concurrency)
+
+        # The latest x-rate-limit-* headers seen per token and endpoint, kept in the state store between runs
+        self.state = state
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.tweet_store = tweet_store
+        if state is not None:
+            saved = state.get_rate_limits()
+            for credential in self.credentials:
+                credential.rate_limits = {
+                    endpoint: saved[_bucket_key(credential, endpoint)]
+                    for endpoint in DEFAULT_CACHE_TTLS if _bucket_key(credential, endpoint) in saved
+                }
 
+        # Cache hits and misses per endpoint
+        self.cache_stats = {}
+        self._stats_lock = threading.Lock()
+        self.cache = cache
+        self.cache_path = cache_path
+        self.cache_ttls = {**DEFAULT_CACHE_TTLS, **(cache_ttls or {})}
+        self.cache_max_entries = cache_max_entries
         if cache:
-            cached_session = requests_cache.CachedSession(
-                "tweepy_cache", expire_after=600
-            )  # Cache expires after 600 seconds
-            self.client.session = cached_session
+            self.trim_cache()
 
-    def get_tweets(self, tweet_ids):
-        return self.client.get_tweets(ids=tweet_ids)
+    @property
+    def client(self):
+        """The tweepy client of the first token."""
+        return self._client(self.credentials[0])
 
-    def search_tweets(self, query, last_tweet_id=None, max_results=100):
-        params = {"max_results": max_results}
+    @property
+    def rate_limits(self):
+        """The rate-limit buckets of the first token, by endpoint."""
+        return self.credentials[0].rate_limits
+
+    def get_tweets(self, tweet_ids, tweet_fields=None, refresh=False):
+        """Look tweets up by ID. The IDs are split into chunks of 100 that are fetched in parallel,
+        and the data and errors of all chunks are returned in a single Response.
+        With refresh, cached lookups are not used, e.g. to read current public metrics."""
+        tweet_ids = list(tweet_ids)
+        chunks = [tweet_ids[i:i + MAX_LOOKUP_IDS] for i in range(0, len(tweet_ids), MAX_LOOKUP_IDS)]
+        params = hydration_params(tweet_fields)
+
+        token = _refresh_cache.set(refresh)
+        try:
+            results = run_concurrently(
+                lambda chunk: self._request(LOOKUP_ENDPOINT, ids=chunk, **params),
+                chunks,
+                max_workers=self.max_concurrency,
+            )
+        finally:
+            _refresh_cache.reset(token)
+
+        data, errors = [], []
+        for _, response, error in results:
+            if error is not None:
+                raise error
+            data.extend(response.data or [])
+            errors.extend(response.errors or [])
+        return tweepy.Response(data=data or None, includes={}, errors=errors, meta={})
+
+    def search_tweets(self, query, last_tweet_id=None, max_results=100, max_pages=None, tweet_fields=None):
+        tweets = []
+        for page in self.iter_search_pages(query, last_tweet_id, max_results, max_pages, tweet_fields):
+            tweets.extend(page.tweets)
+        return tweets
+
+    def iter_search_pages(self, query, last_tweet_id=None, max_results=100, max_pages=None,
+                          tweet_fields=None, next_token=None, start_time=None, end_time=None,
+                          endpoint=SEARCH_ENDPOINT):
+        """Search tweets one page at a time, newest first. A search that stopped early can
+        be continued from the next_token of its last page, with the same query and last_tweet_id.
+
+        start_time and end_time (datetimes) limit the search to tweets created in that window.
+        endpoint is one of SEARCH_BACKENDS: recent search by default, or full-archive search."""
+        params = {"max_results": max_results, **hydration_params(tweet_fields)}
+        if next_token:
+            params["next_token"] = next_token
 
         if last_tweet_id:
             params["since_id"] = last_tweet_id
+        if start_time is not None:
+            params["start_time"] = start_time
+        if end_time is not None:
+            params["end_time"] = end_time
 
-        tweets = []
-        while True:
-            fetched = self.client.search_recent_tweets(query=query, **params)
+        pages = 0
+        while max_pages is None or pages < max_pages:
+            fetched = self._request(endpoint, query=query, **params)
+            pages += 1
+            self.metrics.record_page("twitter", endpoint, len(fetched.data or []))
             if fetched.data is None:
                 break
 
-            tweets.extend(fetched.data)
             params["next_token"] = fetched.meta.get("next_token", None)
+            yield Page(fetched.data, params["next_token"])
 
             if params["next_token"] is None:
                 break
 
+    def get_quote_tweets_for_tweet(self, tweet_id, max_results=100, max_pages=None, stop_at_id=None):
+        tweets = []
+        for page in self.iter_quote_tweet_pages(tweet_id, max_results, max_pages, stop_at_id):
+            tweets.extend(page.tweets)
         return tweets
 
-    def get_quote_tweets_for_tweet(self, tweet_id, max_results=100):
-        params = {"max_results": max_results, "exclude": "retweets"}
+    def iter_quote_tweet_pages(self, tweet_id, max_results=100, max_pages=None, stop_at_id=None,
+                               pagination_token=None):
+        """Fetch the quote tweets of a tweet one page at a time, newest first.
 
-        tweets = []
-        while True:
-            fetched = self.client.get_quote_tweets(tweet_id, **params)
+        If stop_at_id is given, only quote tweets newer than it are returned and pagination stops at
+        the first page that reaches it. The quotes endpoint has no since_id, but it returns results
+        newest-first, so everything after that point has been seen before. Pagination that stopped
+        early can be continued from the next_token of its last page.
+        """
+        params = {"max_results": max_results, "exclude": "retweets", **hydration_params()}
+        if pagination_token:
+            params["pagination_token"] = pagination_token
+
+        pages = 0
+        while max_pages is None or pages < max_pages:
+            fetched = self._request(QUOTES_ENDPOINT, tweet_id, **params)
+            pages += 1
+            self.metrics.record_page("twitter", QUOTES_ENDPOINT, len(fetched.data or []))
             if fetched.data is None:
                 break
 
-            tweets.extend(fetched.data)
             params["pagination_token"] = fetched.meta.get("next_token", None)
+            if stop_at_id is not None:
+                new_tweets = [tweet for tweet in fetched.data if int(tweet["id"]) > int(stop_at_id)]
+                if len(new_tweets) < len(fetched.data):
+                    params["pagination_token"] = None
+                yield Page(new_tweets, params["pagination_token"])
+            else:
+                yield Page(fetched.data, params["pagination_token"])
 
             if params["pagination_token"] is None:
                 break
 
-        return tweets
+    def remaining_calls(self, endpoint):
+        """The number of calls left in the endpoint's current rate-limit window across all usable
+        tokens, or None if they are not known. A token whose calls left are not known counts as
+        having the largest limit seen for another token."""
+        credentials = [credential for credential in self.credentials if credential.usable(endpoint)]
+        remaining = [credential.remaining_calls(endpoint) for credential in credentials]
+        limits = [
+            credential.rate_limits[endpoint]["limit"] for credential in credentials
+            if credential.rate_limits.get(endpoint, {}).get("limit") is not None
+        ]
+        if None in remaining and not limits:
+            return None
+        return (sum(calls for calls in remaining if calls is not None)
+                + remaining.count(None) * max(limits, default=0))
+
+    def trim_cache(self):
+        """Drop expired responses, then the ones that expire soonest until the cache fits in
+        cache_max_entries."""
+        cache = getattr(self.client.session, "cache", None)
+        if cache is None:
+            return
+
+        cache.delete(expired=True)
+        if self.cache_max_entries is not None:
+            responses = cache.responses
+            excess = len(responses) - self.cache_max_entries
+            if excess > 0:
+                with responses.connection(commit=True) as connection:
+                    connection.execute(
+                        f"DELETE FROM {responses.table_name} WHERE key IN "
+                        f"(SELECT key FROM {responses.table_name} ORDER BY expires LIMIT ?)",
+                        (excess,),
+                    )
+
+    def cache_summary(self):
+        """A one-line summary of the cache hits and misses of every endpoint."""
+        with self._stats_lock:
+            return ", ".join(
+                f"{endpoint}: {stats['hits']} hits, {stats['misses']} misses"
+                for endpoint, stats in sorted(self.cache_stats.items())
+            ) or "no requests"
+
+    def _request(self, endpoint, *args, **kwargs):
+        while True:
+            if self.deadline is not None and time.time() >= self.deadline:
+                raise DeadlineReached(f"The run's deadline has passed, not calling {endpoint}")
+            credential = self._pick_credential(endpoint)
+            if credential is None:
+                # Every usable token is out of calls, so wait for the first one to reset
+                self._wait_for_reset(endpoint, self._first_reset(endpoint))
+                continue
+
+            try:
+                with self._request_slots:
+                    response = getattr(self._client(credential), endpoint)(*args, **kwargs)
+            except tweepy.TooManyRequests as e:
+                reset = e.response.headers.get("x-rate-limit-reset")
+                with self._credentials_lock:
+                    # Without headers the limit stays unknown, so the token is tried again after the reset
+                    credential.rate_limits[endpoint] = {
+                        "limit": credential.rate_limits.get(endpoint, {}).get("limit"),
+                        "remaining": 0,
+                        "reset": int(reset) if reset else int(time.time()) + RATE_LIMIT_WINDOW,
+                    }
+                continue
+            except (tweepy.Unauthorized, tweepy.Forbidden) as e:
+                self._disable_credential(credential, endpoint, e)
+                continue
+
+            if self.tweet_store is not None:
+                self._store_tweets(response)
+            return response
+
+    def _client(self, credential):
+        """The tweepy client of a token, created on first use. All tokens share the cache file."""
+        with self._credentials_lock:
+            if credential.client is not None:
+                return credential.client
+
+            # Rate limits are waited for in _request, where the deadline is known, never inside tweepy
+            client = tweepy.Client(bearer_token=credential.bearer_token, wait_on_rate_limit=False)
+            if self.cache:
+                if os.path.dirname(self.cache_path):
+                    os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                # The Authorization header is not part of the cache key, so a response fetched
+                # with one token is served to requests made with the others
+                client.session = RefreshableCachedSession(
+                    self.cache_path,
+                    expire_after=0,
+                    urls_expire_after={
+                        pattern: self.cache_ttls.get(endpoint, 0) for pattern, endpoint in ENDPOINT_PATTERNS
+                    },
+                )
+
+            # Keep a connection alive per concurrent request and retry transient server errors.
+            # Rate limits are not retried here: _request moves on to another token or waits.
+            mount_transport(
+                client.session,
+                pool_size=self.max_concurrency,
+                retry=build_retry(statuses=RETRYABLE_STATUSES - {429}),
+            )
+            client.session.hooks["response"].append(
+                lambda response, *args, **kwargs: self._record_response(credential, response)
+            )
+            credential.client = client
+            return client
+
+    def _pick_credential(self, endpoint):
+        """The usable token with the most calls left for the endpoint, trying tokens whose rate
+        limit is not known yet first. None if no token has calls left."""
+        with self._credentials_lock:
+            credentials = [credential for credential in self.credentials if credential.usable(endpoint)]
+            if not credentials:
+                raise self._rejection
+            for credential in credentials:
+                if credential.remaining_calls(endpoint) is None:
+                    return credential
+
+            credential = max(credentials, key=lambda credential: credential.remaining_calls(endpoint))
+            if credential.remaining_calls(endpoint) == 0:
+                return None
+
+            # Take the call from the bucket now, so that concurrent requests spread out
+            rate_limit = credential.rate_limits[endpoint]
+            if rate_limit["reset"] <= time.time():
+                rate_limit.update(remaining=rate_limit["limit"], reset=int(time.time()) + RATE_LIMIT_WINDOW)
+            rate_limit["remaining"] -= 1
+            return credential
+
+    def _first_reset(self, endpoint):
+        with self._credentials_lock:
+            return min(
+                credential.rate_limits[endpoint]["reset"]
+                for credential in self.credentials if credential.usable(endpoint)
+            )
+
+    def _disable_credential(self, credential, endpoint, error):
+        """Stop using a token that was rejected: entirely on a 401, for the endpoint on a 403.
+        The error is raised once no usable token is left."""
+        with self._credentials_lock:
+            if isinstance(error, tweepy.Unauthorized):
+                credential.revoked = True
+                print(f"Twitter token {credential.name} was rejected, not using it again")
+            else:
+                credential.disabled_endpoints.add(endpoint)
+                print(f"Twitter token {credential.name} may not call {endpoint}, not using it for it again")
+            self._rejection = error
+
+    def _store_tweets(self, response):
+        includes = response.includes if isinstance(response.includes, dict) else {}
+        tweets = [_raw(tweet) for tweet in (response.data or []) + includes.get("tweets", [])]
+        users = [_raw(user) for user in includes.get("users", [])]
+        if tweets or users:
+            self.tweet_store.record_tweets(tweets, users)
+
+    def _wait_for_reset(self, endpoint, reset):
+        """Sleep until a rate limit resets, or raise if the client may not sleep that long."""
+        if not self.wait_on_rate_limit:
+            raise RateLimitExhausted(f"No {endpoint} calls left until the rate limit resets")
+        sleep_time = max(reset - time.time() + 1, 1)
+        if self.deadline is not None and time.time() + sleep_time > self.deadline:
+            raise DeadlineReached(f"The {endpoint} rate limit resets after the run's deadline")
+
+        print(f"Rate limit of {endpoint} exceeded. Sleeping for {sleep_time:.0f} seconds.")
+        self.metrics.record_sleep("twitter", endpoint, sleep_time, "rate_limit")
+        time.sleep(sleep_time)
+
+    def _record_response(self, credential, response):
+        # The cached session dispatches hooks a second time for responses it just stored
+        if getattr(response, "_recorded", False):
+            return
+        response._recorded = True
+
+        endpoint = endpoint_for_url(response.url)
+        from_cache = getattr(response, "from_cache", False)
+        self.metrics.record_request("twitter", endpoint or "other", response.elapsed.total_seconds(),
+                                    len(response.content or b""), response.status_code, from_cache)
+        if endpoint is not None:
+            with self._stats_lock:
+                stats = self.cache_stats.setdefault(endpoint, {"hits": 0, "misses": 0})
+                stats["hits" if from_cache else "misses"] += 1
+
+        if from_cache or "x-rate-limit-remaining" not in response.headers:
+            return
+
+        if endpoint is not None:
+            rate_limit = {
+                "limit": int(response.headers["x-rate-limit-limit"]),
+                "remaining": int(response.headers["x-rate-limit-remaining"]),
+                "reset": int(response.headers["x-rate-limit-reset"]),
+            }
+            with self._credentials_lock:
+                credential.rate_limits[endpoint] = rate_limit
+            if self.state is not None:
+                self.state.record_rate_limit(_bucket_key(credential, endpoint), rate_limit)
+
+
+def _credential_name(bearer_token):
+    """A name for a token that can be logged and stored: the start of its SHA-256 hash."""
+    return hashlib.sha256(bearer_token.encode()).hexdigest()[:8]
+
+
+def _bucket_key(credential, endpoint):
+    """The state store key of a token's rate-limit bucket for an endpoint."""
+    return endpoint if credential.primary else f"{endpoint}@{credential.name}"
+
+
+def hydration_params(tweet_fields=None):
+    """The fields and expansions to request tweets with: TWEET_FIELDS and any extra tweet_fields."""
+    return {
+        "tweet_fields": sorted(set(TWEET_FIELDS) | set(tweet_fields or [])),
+        "expansions": EXPANSIONS,
+        "user_fields": USER_FIELDS,
+    }
+
+
+def _raw(item):
+    """The dictionary the API returned for a tweepy Tweet or User."""
+    return getattr(item, "data", item)
+
+
+def endpoint_for_url(url):
+    """Map a Twitter API v2 request URL to the name of the TwitterAPI endpoint it belongs to."""
+    path = url.split("?", 1)[0]
+    for pattern, endpoint in ENDPOINT_PATTERNS:
+        if pattern.search(path):
+            return endpoint
+    return None
@@ -1,14 +1,21 @@
+import contextvars
 import math
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Union
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 from urllib.parse import urlparse
 
 from field_constants import Fields
+from tweet_ids import TweetIdSet
 
 ID_LENGTH = 18
 RETWEET_STRING = "RT @"
 
+# Tweet IDs are Snowflake IDs: the bits above the lowest 22 hold milliseconds since the Twitter epoch.
+TWITTER_EPOCH_MS = 1288834974657
+
 
 def is_valid_http_url(text: str) -> bool:
     """Check if a string is a valid HTTP URL."""
@@ -43,6 +50,26 @@ def calculate_priority(timestamp_str: str, decay_rate: float = 0.005) -> float:
     return math.exp(-decay_rate * (now - timestamp).days)
 
 
+def tweet_id_to_datetime(tweet_id: Union[str, int]) -> datetime:
+    """Recover the creation time of a tweet from its Snowflake ID."""
+    timestamp_ms = (int(tweet_id) >> 22) + TWITTER_EPOCH_MS
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
+
+
+def datetime_to_tweet_id(timestamp: datetime) -> int:
+    """The smallest tweet ID that can have been created at or after a given time."""
+    return (int(timestamp.timestamp() * 1000) - TWITTER_EPOCH_MS) << 22
+
+
+def calculate_arrival_rate(tweet_ids: Iterable[Union[str, int]], days: int = 7) -> float:
+    """The average number of tweets per day that a collection gained over the last `days` days,
+    based on the creation times encoded in the tweet IDs."""
+    since_id = datetime_to_tweet_id(datetime.now(timezone.utc) - timedelta(days=days))
+    if not isinstance(tweet_ids, TweetIdSet):
+        tweet_ids = TweetIdSet(tweet_ids)
+    return tweet_ids.count_at_least(since_id) / days
+
+
 def parse_query_params(text: str) -> str:
     """Parse search parameters into Twitter query format."""
     if is_valid_http_url(text):
@@ -95,20 +122,18 @@ def filter_out_retweets(tweets: List[Dict]) -> List[Dict]:
     return [tweet for tweet in tweets if not tweet["text"].startswith(RETWEET_STRING)]
 
 
-def update_entry_tweets(airtable, entry: Dict, og_tweets: List[str], new_tweets=None) -> None:
+def update_entry_tweets(airtable, entry: Dict, og_tweets: TweetIdSet, new_tweets=None) -> None:
     """Update the tweets field for an entry."""
     if new_tweets is None:
         new_tweets = []
     tweets_without_retweets = filter_out_retweets(new_tweets)
 
     if tweets_without_retweets:
-        all_tweets = list(
-            set(og_tweets + [str(tweet["id"]) for tweet in tweets_without_retweets])
-        )
+        all_tweets = og_tweets.union(tweet["id"] for tweet in tweets_without_retweets)
 
-        if sorted(og_tweets) != sorted(all_tweets):
-            tweets_string = ",".join(all_tweets)
-            airtable.update_page(entry["id"], {Fields.TWEETS: tweets_string})
+        # The merged set contains the original, so it changed if and only if it grew
+        if len(all_tweets) != len(og_tweets):
+            airtable.update_page(entry["id"], {Fields.TWEETS: all_tweets.to_field()})
             print("Updated tweets for:", get_field_value(entry, Fields.DESCRIPTION))
 
 
@@ -121,23 +146,77 @@ def update_entry_collection_metadata(airtable, entry: Dict, collection_id: str,
     })
 
 
+class TweetCommitter:
+    """Merges tweets that arrive page by page into a collection. Pending tweets are committed every
+    `pages_per_commit` pages, so partial progress reaches Airtable even if the run stops halfway
+    and memory does not grow with the size of the result. With pages_per_commit=None, everything
+    is committed at once when commit() is called.
+
+    State that must not get ahead of the tweets in Airtable, like watermarks and cursors, is saved
+    through commit's `then`, which only runs once the tweets have reached Airtable."""
+
+    def __init__(self, airtable, collection_id: str, pages_per_commit: Optional[int] = None):
+        self.airtable = airtable
+        self.collection_id = collection_id
+        self.pages_per_commit = pages_per_commit
+        self._pending = []
+        self._pending_pages = 0
+        self._lock = threading.Lock()
+
+    def add_page(self, tweets: List) -> None:
+        with self._lock:
+            self._pending.extend(tweets)
+            self._pending_pages += 1
+            if self.pages_per_commit and self._pending_pages >= self.pages_per_commit:
+                self._commit()
+
+    def commit(self, then: Optional[Callable[[], None]] = None) -> None:
+        """Commit the pending tweets, then call `then`, if given, once they are written to Airtable.
+        With a batching AirtableAPI that is after the next flush, and never if the update fails."""
+        with self._lock:
+            self._commit()
+        if then is not None:
+            after_write(self.airtable, [self.collection_id], then)
+
+    def _commit(self) -> None:
+        if self._pending:
+            entry = get_entry(self.airtable, self.collection_id)
+            if entry is not None:
+                update_entry_tweets(self.airtable, entry, get_entry_tweets(entry), self._pending)
+        self._pending = []
+        self._pending_pages = 0
+
+
+def after_write(airtable, collection_ids: Iterable[str], callback: Callable[[], None]) -> None:
+    """Call callback once the updates of the given collections have been written to Airtable."""
+    entries = [get_entry(airtable, collection_id) for collection_id in collection_ids]
+    airtable.after_write([entry["id"] for entry in entries if entry is not None], callback)
+
+
 def get_entry(airtable, collection_id: str) -> Union[Dict, None]:
-    """Get an entry by its collection ID."""
-    entries = airtable.get_database_entries()
-    return next(
-        (
-            entry
-            for entry in entries
-            if get_field_value(entry, Fields.ID) == collection_id
-        ),
-        None,
-    )
-
-
-def get_entry_tweets(entry: Dict) -> List[str]:
-    """Get list of tweet IDs from an entry."""
-    return [
-        tweet.strip()
-        for tweet in get_field_value(entry, Fields.TWEETS).split(",")
-        if tweet.strip()
-    ]
+    """Get an entry by its collection ID from the run's Airtable snapshot."""
+    return airtable.get_entry_by_collection_id(collection_id)
+
+
+def get_entry_tweets(entry: Dict) -> TweetIdSet:
+    """Get the set of tweet IDs of an entry."""
+    return TweetIdSet.from_field(get_field_value(entry, Fields.TWEETS))
+
+
+def run_concurrently(fn: Callable, items: Iterable, max_workers: int = 1) -> List[Tuple]:
+    """Call fn on every item using up to max_workers threads.
+    Returns (item, result, error) tuples in the order of the items; error is None on success.
+    Each call runs in a copy of the caller's context, so context variables carry over to the threads."""
+    def call(item):
+        try:
+            return item, fn(item), None
+        except Exception as e:
+            return item, None, e
+
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, call, item) for item in items]
+        return [future.result() for future in futures]
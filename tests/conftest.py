@@ -44,6 +44,7 @@ def pytest_sessionfinish(session: pytest.Session) -> None:
 @pytest.fixture
 def mock_apis():
     from field_constants import Fields
+    from metrics import RunMetrics
 
     entry = {
         'id': 'rec123',
@@ -57,8 +58,16 @@ def mock_apis():
 
     twitter = Mock()
     airtable = Mock()
+    twitter.metrics = airtable.metrics = RunMetrics("test")
 
     airtable.get_database_entries = Mock(return_value=[entry])
+    airtable.iter_database_entries = Mock(
+        side_effect=lambda *args, **kwargs: iter([airtable.get_database_entries(*args, **kwargs)])
+    )
+    airtable.get_entry_by_collection_id = Mock(
+        side_effect=lambda collection_id: entry if collection_id == entry['fields'][Fields.ID] else None
+    )
     airtable.update_page = Mock()
+    airtable.after_write = Mock(side_effect=lambda record_ids, callback: callback())
 
     return twitter, airtable, entry
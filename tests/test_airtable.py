@@ -0,0 +1,353 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+from field_constants import Fields
+
+
+def _record(record_id, collection_id, tweets=''):
+    return {'id': record_id, 'fields': {Fields.ID: collection_id, Fields.TWEETS: tweets}}
+
+
+def _pages(*pages):
+    """Stands in for pyairtable's list records iteration, answering each read with the next pages."""
+    return Mock(side_effect=[iter([{'records': records} for records in read]) for read in pages])
+
+
+def _make_api(records):
+    from airtable import AirtableAPI
+
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        table.api.iterate_requests = _pages([records])
+        api = AirtableAPI(api_key='key', base_id='base', table_name='table')
+    return api, table
+
+
+def test_snapshot_is_loaded_once():
+    api, table = _make_api([_record('rec1', 'c1'), _record('rec2', 'c2')])
+
+    assert len(api.get_database_entries()) == 2
+    assert api.get_entry_by_collection_id('c2')['id'] == 'rec2'
+    assert api.get_entry_by_record_id('rec1')['fields'][Fields.ID] == 'c1'
+    assert api.get_entry_by_collection_id('missing') is None
+    assert table.api.iterate_requests.call_count == 1
+
+
+def test_snapshot_is_updated_after_writes():
+    api, table = _make_api([_record('rec1', '')])
+    api.get_database_entries()
+
+    table.update = Mock(return_value=_record('rec1', 'c1', '1,2'))
+    api.update_page('rec1', {Fields.ID: 'c1', Fields.TWEETS: '1,2'})
+
+    entry = api.get_entry_by_collection_id('c1')
+    assert entry['fields'][Fields.TWEETS] == '1,2'
+    assert table.api.iterate_requests.call_count == 1
+
+
+def test_refresh_entry_replaces_snapshot_record():
+    api, table = _make_api([_record('rec1', 'c1', '1')])
+    api.get_database_entries()
+
+    table.get = Mock(return_value=_record('rec1', 'c1-renamed', '1,2'))
+    api.refresh_entry('rec1')
+
+    assert api.get_entry_by_collection_id('c1') is None
+    assert api.get_entry_by_collection_id('c1-renamed')['fields'][Fields.TWEETS] == '1,2'
+
+
+def test_batched_updates_are_merged_and_chunked():
+    from airtable import AirtableAPI
+
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        table.api.iterate_requests = _pages([[_record(f'rec{i}', f'c{i}') for i in range(12)]])
+        api = AirtableAPI(api_key='key', base_id='base', table_name='table', batch_writes=True)
+    table.batch_update = Mock(side_effect=lambda records, **kwargs: records)
+    api.get_database_entries()
+
+    for i in range(12):
+        api.update_page(f'rec{i}', {Fields.TWEETS: '1'})
+    api.update_page('rec0', {Fields.TWEETS: '1,2'})
+
+    # Pending updates are visible in the snapshot before they are flushed
+    assert api.get_entry_by_collection_id('c0')['fields'][Fields.TWEETS] == '1,2'
+    assert table.batch_update.call_count == 0
+
+    assert api.flush() == {}
+    batch_sizes = [len(call[0][0]) for call in table.batch_update.call_args_list]
+    assert batch_sizes == [10, 2]
+    sent = {record['id']: record['fields'] for call in table.batch_update.call_args_list
+            for record in call[0][0]}
+    assert sent['rec0'] == {Fields.TWEETS: '1,2'}
+
+
+def test_batched_update_failures_are_reported_per_record():
+    from airtable import AirtableAPI
+
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        api = AirtableAPI(api_key='key', base_id='base', table_name='table', batch_writes=True)
+    table.batch_update = Mock(side_effect=Exception("422 Unprocessable Entity"))
+
+    def update(record_id, fields, **kwargs):
+        if record_id == 'bad':
+            raise Exception("422 Unprocessable Entity")
+        return {'id': record_id, 'fields': fields}
+
+    table.update = Mock(side_effect=update)
+    api.update_page('good', {Fields.TWEETS: '1'})
+    api.update_page('bad', {Fields.TWEETS: 'x'})
+
+    failures = api.flush()
+    assert list(failures) == ['bad']
+    assert table.update.call_count == 2
+
+
+def test_after_write_callbacks_wait_for_the_flush_and_are_dropped_on_failure():
+    from airtable import AirtableAPI
+
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        api = AirtableAPI(api_key='key', base_id='base', table_name='table', batch_writes=True)
+    table.batch_update = Mock(side_effect=Exception("422 Unprocessable Entity"))
+
+    def update(record_id, fields, **kwargs):
+        if record_id == 'bad':
+            raise Exception("422 Unprocessable Entity")
+        return {'id': record_id, 'fields': fields}
+
+    table.update = Mock(side_effect=update)
+    called = []
+    api.update_page('good', {Fields.TWEETS: '1'})
+    api.update_page('bad', {Fields.TWEETS: '2'})
+    api.after_write(['good'], lambda: called.append('good'))
+    api.after_write(['good', 'bad'], lambda: called.append('both'))
+    api.after_write(['unchanged'], lambda: called.append('unchanged'))
+    assert called == ['unchanged']
+
+    api.flush()
+    assert called == ['unchanged', 'good']
+    # A record that failed to update holds back anything that depends on it for the rest of the run
+    api.after_write(['bad'], lambda: called.append('bad'))
+    assert called == ['unchanged', 'good']
+
+
+def test_transient_failures_keep_updates_pending():
+    import requests
+    from airtable import AirtableAPI
+
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        api = AirtableAPI(api_key='key', base_id='base', table_name='table', batch_writes=True)
+    unavailable = requests.HTTPError("503 Service Unavailable", response=Mock(status_code=503))
+    table.batch_update = Mock(side_effect=unavailable)
+    api.update_page('rec1', {Fields.TWEETS: '1'})
+
+    with pytest.raises(requests.HTTPError):
+        api.flush()
+    # The records are not retried one by one, and the update is sent with the next flush
+    assert table.update.call_count == 0
+    table.batch_update = Mock(side_effect=lambda records, **kwargs: records)
+    assert api.flush() == {}
+    assert table.batch_update.call_args[0][0] == [{'id': 'rec1', 'fields': {Fields.TWEETS: '1'}}]
+
+
+def test_failed_reads_raise_instead_of_returning_no_entries(monkeypatch):
+    import time
+    import requests
+    from airtable import AirtableAPI
+
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        table.api.iterate_requests = Mock(side_effect=requests.ConnectionError("Connection reset"))
+        api = AirtableAPI(api_key='key', base_id='base', table_name='table')
+
+    with pytest.raises(requests.ConnectionError):
+        api.get_database_entries()
+
+
+def test_projected_reads_are_filtered_by_airtable_and_merged_into_the_snapshot():
+    api, table = _make_api([])
+    table.api.iterate_requests = _pages(
+        [[{'id': 'rec1', 'fields': {Fields.ID: 'c1', Fields.TWEETS: '1,2'}}]],
+        [[{'id': 'rec1', 'fields': {Fields.ID: 'c1', Fields.SEARCH: 'https://example.com'}},
+          {'id': 'rec2', 'fields': {Fields.ID: 'c2'}}]],
+    )
+
+    entries = api.get_database_entries(fields=[Fields.ID, Fields.TWEETS], formula='{tweets-field-id}')
+    assert [entry['id'] for entry in entries] == ['rec1']
+    assert table.api.iterate_requests.call_args[1]['options'] == {
+        'use_field_ids': True, 'fields': [Fields.ID, Fields.TWEETS], 'formula': '{tweets-field-id}'
+    }
+
+    # A second read adds its fields, and a requested field that is missing is now empty
+    api.get_database_entries(fields=[Fields.ID, Fields.SEARCH, Fields.TWEETS])
+    assert api.get_entry_by_collection_id('c1')['fields'] == {
+        Fields.ID: 'c1', Fields.SEARCH: 'https://example.com'
+    }
+    assert api.get_entry_by_collection_id('c2')['id'] == 'rec2'
+
+    # Repeating a read returns the snapshot
+    assert [entry['id'] for entry in api.get_database_entries(fields=[Fields.ID, Fields.TWEETS],
+                                                              formula='{tweets-field-id}')] == ['rec1']
+    assert table.api.iterate_requests.call_count == 2
+
+
+def test_pages_are_yielded_while_later_pages_load_and_failed_pages_are_read_again(monkeypatch):
+    import threading
+    import time
+    import requests
+
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    api, table = _make_api([])
+    first_page_handled = threading.Event()
+
+    def first_read(**kwargs):
+        yield {'records': [_record('rec1', 'c1')], 'offset': 'page-2'}
+        # The job is working on the first page before the second one has arrived
+        assert first_page_handled.wait(timeout=5)
+        raise requests.ConnectionError("Connection reset")
+
+    def continued_read(**kwargs):
+        yield {'records': [_record('rec2', 'c2')]}
+
+    table.api.iterate_requests = Mock(side_effect=[first_read(), continued_read()])
+
+    pages = []
+    for page in api.iter_database_entries(fields=[Fields.ID]):
+        pages.append([entry['id'] for entry in page])
+        first_page_handled.set()
+
+    assert pages == [['rec1'], ['rec2']]
+    assert table.api.iterate_requests.call_args[1]['options']['offset'] == 'page-2'
+    assert [entry['id'] for entry in api.get_database_entries(fields=[Fields.ID])] == ['rec1', 'rec2']
+    assert table.api.iterate_requests.call_count == 2
+
+
+def _tweet_rows(rows):
+    from field_constants import TweetsFields
+
+    return [
+        {'id': f'row{tweet_id}', 'fields': {TweetsFields.TWEET_ID: tweet_id, TweetsFields.COLLECTION: [record_id]}}
+        for record_id, tweet_id in rows
+    ]
+
+
+def _make_api_with_tweets_table(records, rows, **kwargs):
+    from airtable import AirtableAPI
+    from field_constants import TweetsFields
+
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        table.api.iterate_requests = _pages([records])
+        tweets = table.api.table.return_value
+        tweets.api.iterate_requests = _pages([_tweet_rows(rows)])
+        tweets.batch_create = Mock(side_effect=lambda rows, **kwargs: [
+            {'id': f'row{fields[TweetsFields.TWEET_ID]}', 'fields': fields} for fields in rows
+        ])
+        api = AirtableAPI(api_key='key', base_id='base', table_name='table', tweets_table='tweets', **kwargs)
+    return api, table, tweets
+
+
+def test_tweets_table_is_read_with_the_field_and_only_new_tweets_are_written():
+    from field_constants import TweetsFields
+
+    api, table, tweets = _make_api_with_tweets_table([_record('rec1', 'c1', '1,2')], [('rec1', '3'), ('rec1', '5')])
+    assert api.get_entry_by_collection_id('c1')['fields'][Fields.TWEETS] == '1,2,3,5'
+
+    table.update = Mock()
+    api.update_page('rec1', {Fields.TWEETS: '1,2,3,5,6,7'})
+    created, = tweets.batch_create.call_args_list
+    assert created[0][0] == [
+        {TweetsFields.TWEET_ID: '6', TweetsFields.COLLECTION: ['rec1']},
+        {TweetsFields.TWEET_ID: '7', TweetsFields.COLLECTION: ['rec1']},
+    ]
+    table.update.assert_not_called()
+    assert api.get_entry_by_collection_id('c1')['fields'][Fields.TWEETS] == '1,2,3,5,6,7'
+
+    # Dropped tweets are deleted from the table, and the field is shortened for those still in it
+    table.update = Mock(return_value=_record('rec1', 'c1', '2'))
+    api.update_page('rec1', {Fields.TWEETS: '2,5,6,7'})
+    tweets.batch_delete.assert_called_once_with(['row3'])
+    table.update.assert_called_once_with('rec1', {Fields.TWEETS: '2'}, use_field_ids=True)
+    assert api.get_entry_by_collection_id('c1')['fields'][Fields.TWEETS] == '2,5,6,7'
+    assert tweets.api.iterate_requests.call_count == 1
+
+
+def test_migration_copies_the_tweets_field_to_the_tweets_table():
+    import migrate_tweet_storage
+    from field_constants import TweetsFields
+
+    api, table, tweets = _make_api_with_tweets_table([_record('rec1', 'c1', '1,2,3')], [('rec1', '2')])
+    table.update = Mock(return_value=_record('rec1', 'c1'))
+
+    assert migrate_tweet_storage.run(api, clear_field=True) == 2
+    assert [row[TweetsFields.TWEET_ID] for row in tweets.batch_create.call_args[0][0]] == ['1', '3']
+    table.update.assert_called_once_with('rec1', {Fields.TWEETS: ''}, use_field_ids=True)
+    assert api.get_entry_by_collection_id('c1')['fields'][Fields.TWEETS] == '1,2,3'
+
+    # Running it again copies nothing
+    assert migrate_tweet_storage.run(api) == 0
+
+
+def test_tweets_table_mirror_only_reads_the_records_changed_since_the_last_run(tmp_path):
+    from datetime import timedelta
+
+    mirror = str(tmp_path / 'tweets_table.sqlite3')
+    api, table, tweets = _make_api_with_tweets_table(
+        [_record('rec1', 'c1')], [('rec1', '3'), ('rec1', '5')], tweets_table_mirror=mirror,
+    )
+    assert api.get_entry_by_collection_id('c1')['fields'][Fields.TWEETS] == '3,5'
+    api.update_page('rec1', {Fields.TWEETS: '5,6'})
+    assert 'formula' not in tweets.api.iterate_requests.call_args[1]['options']
+
+    # The next run reads only what changed, and keeps its own writes and deletes from the last one
+    api, table, tweets = _make_api_with_tweets_table(
+        [_record('rec1', 'c1')], [('rec1', '7')], tweets_table_mirror=mirror,
+    )
+    assert api.get_entry_by_collection_id('c1')['fields'][Fields.TWEETS] == '5,6,7'
+    assert 'LAST_MODIFIED_TIME()' in tweets.api.iterate_requests.call_args[1]['options']['formula']
+
+    # Once a full sync is due the whole table is read again, dropping records deleted by hand
+    api, table, tweets = _make_api_with_tweets_table(
+        [_record('rec1', 'c1')], [('rec1', '6')], tweets_table_mirror=mirror, tweets_table_full_sync=timedelta(0),
+    )
+    assert api.get_entry_by_collection_id('c1')['fields'][Fields.TWEETS] == '6'
+    assert 'formula' not in tweets.api.iterate_requests.call_args[1]['options']
+
+
+def test_tweets_deleted_by_hand_are_deleted_one_by_one():
+    import requests
+
+    api, table, tweets = _make_api_with_tweets_table([_record('rec1', 'c1')], [('rec1', '3'), ('rec1', '5')])
+    api.get_entry_by_collection_id('c1')
+    gone = requests.HTTPError("404 Client Error", response=Mock(status_code=404))
+    tweets.batch_delete = Mock(side_effect=gone)
+    tweets.delete = Mock(side_effect=[gone, None])
+
+    api.update_page('rec1', {Fields.TWEETS: ''})
+
+    assert [call[0][0] for call in tweets.delete.call_args_list] == ['row3', 'row5']
+    assert api.get_entry_by_collection_id('c1')['fields'][Fields.TWEETS] == ''
+
+
+def test_updates_of_other_fields_never_read_the_tweets_table():
+    from airtable import AirtableAPI
+
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        table.api.iterate_requests = _pages([[{'id': 'rec1', 'fields': {Fields.NAME: 'A pub'}}]])
+        tweets = table.api.table.return_value
+        api = AirtableAPI(api_key='key', base_id='base', table_name='table', tweets_table='tweets', batch_writes=True)
+    api.get_database_entries(fields=[Fields.NAME])
+    # Airtable answers an update with every field of the record, the tweets field included
+    table.batch_update = Mock(return_value=[_record('rec1', 'c1', '1,2')])
+
+    api.update_page('rec1', {Fields.ID: 'c1', Fields.URL: 'https://example.com/c1'})
+    api.flush()
+
+    tweets.api.iterate_requests.assert_not_called()
+    assert Fields.TWEETS not in api.get_entry_by_record_id('rec1')['fields']
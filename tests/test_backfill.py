@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import pytest
+
+from field_constants import Fields
+from twitter import Page
+
+NOW = datetime(2026, 3, 10, tzinfo=timezone.utc)
+
+
+def test_time_windows_cover_the_range_newest_first():
+    from backfill import time_windows
+
+    windows = time_windows(NOW - timedelta(hours=60), NOW, timedelta(hours=24))
+
+    assert windows == [
+        (NOW - timedelta(hours=24), NOW),
+        (NOW - timedelta(hours=48), NOW - timedelta(hours=24)),
+        (NOW - timedelta(hours=60), NOW - timedelta(hours=48)),
+    ]
+
+
+def test_backfill_resumes_from_the_windows_left_and_restarts_when_the_search_changes(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from backfill import backfill_window, pending_windows, plan_backfill
+    from state_store import StateStore
+    from twitter import DeadlineReached
+    from utils import TweetCommitter
+
+    state = StateStore(':memory:')
+    backfill = plan_backfill(state, 'test_collection_id', 'https://example.com/a,#arcadia', NOW, days=3)
+    window = timedelta(days=1)
+    first, second, third = pending_windows(state, 'test_collection_id', backfill, window)
+
+    def search(query, start_time=None, end_time=None, endpoint=None):
+        if start_time == third[0]:
+            raise DeadlineReached("The run's deadline has passed")
+        return [Page([{'id': '1634567890123456789', 'text': 'Older tweet'}])]
+
+    twitter.iter_search_pages = Mock(side_effect=search)
+    committer = TweetCommitter(airtable, 'test_collection_id')
+    for start, end in (first, second):
+        backfill_window(twitter, committer, state, 'test_collection_id', 'query', start, end)
+    with pytest.raises(DeadlineReached):
+        backfill_window(twitter, committer, state, 'test_collection_id', 'query', *third)
+
+    assert pending_windows(state, 'test_collection_id', backfill, window) == [third]
+    assert '1634567890123456789' in airtable.update_page.call_args[0][1][Fields.TWEETS]
+    # Reordering the terms is not a change, editing them is
+    assert plan_backfill(state, 'test_collection_id', '#arcadia, https://example.com/a', NOW + window) == backfill
+    backfill = plan_backfill(state, 'test_collection_id', 'https://example.com/b', NOW + window, days=3)
+    assert len(pending_windows(state, 'test_collection_id', backfill, window)) == 3
+
+
+def test_recent_search_backfill_skips_windows_it_cannot_reach(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from backfill import backfill_window, pending_windows, plan_backfill
+    from state_store import StateStore
+    from utils import TweetCommitter
+
+    state = StateStore(':memory:')
+    backfill = plan_backfill(state, 'test_collection_id', 'https://example.com/a', NOW, days=10)
+    reach = NOW - timedelta(days=7, hours=-1)
+
+    windows = pending_windows(state, 'test_collection_id', backfill, timedelta(days=1), reach=reach)
+    twitter.iter_search_pages = Mock(return_value=[])
+    backfill_window(twitter, TweetCommitter(airtable, 'test_collection_id'), state, 'test_collection_id',
+                    'query', *windows[-1], reach=reach)
+
+    assert len(windows) == 7
+    assert twitter.iter_search_pages.call_args[1]['start_time'] == reach
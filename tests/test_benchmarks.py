@@ -0,0 +1,31 @@
+import pytest
+
+from stand_ins import ServerConfig, _evaluate
+
+
+@pytest.mark.parametrize('scenario', ['fetch_tweets', 'fetch_quote_tweets', 'clean_old_collections'])
+def test_jobs_run_against_the_stand_ins(scenario):
+    from bench import run_scenario
+
+    result = run_scenario(scenario, collections=3, tweets=10, concurrency=2)
+
+    assert result.calls['airtable.list_records'] == 1
+    assert result.calls['airtable.update_records'] >= 1
+    assert sum(count for endpoint, count in result.calls.items() if endpoint.startswith('twitter.')) > 0
+    assert result.peak_memory_bytes > 0
+
+
+def test_exhausted_rate_limits_are_answered_with_429():
+    from bench import run_scenario
+
+    config = ServerConfig(rate_limits={'search_recent_tweets': 2})
+    result = run_scenario('fetch_tweets', collections=4, tweets=10, twitter_config=config, concurrency=1)
+
+    # The first two searches use up the window. The job sees the headers and stops searching.
+    assert result.calls['twitter.search_recent_tweets'] == 2
+
+
+def test_formulas_the_jobs_send_are_understood():
+    fields = {'fldA': 'x', 'fldB': ''}
+    assert _evaluate('AND({fldA}, NOT({fldB}))', fields)
+    assert not _evaluate('AND({fldA}, {fldB})', fields)
@@ -0,0 +1,87 @@
+from unittest.mock import Mock
+
+import tweepy
+
+from field_constants import Fields
+
+
+def _lookup_response(tweets, errors=()):
+    data = [tweepy.Tweet({'id': tweet_id, 'text': text, 'edit_history_tweet_ids': [tweet_id]})
+            for tweet_id, text in tweets]
+    return tweepy.Response(data=data or None, includes={}, errors=list(errors), meta={})
+
+
+def test_clean_entry_removes_retweets_and_unavailable_tweets(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from clean_old_collections import clean_entry
+    from state_store import StateStore
+
+    entry['fields'][Fields.TWEETS] = '1,2,3,4'
+    twitter.get_tweets.return_value = _lookup_response(
+        [('1', 'A tweet'), ('2', 'RT @someone: A retweet')],
+        errors=[
+            {'resource_id': '3', 'type': 'https://api.twitter.com/2/problems/resource-not-found'},
+            {'resource_id': '4', 'type': 'https://api.twitter.com/2/problems/not-authorized-for-resource'},
+        ],
+    )
+    state = StateStore(':memory:')
+
+    clean_entry(twitter, airtable, entry, state=state)
+
+    airtable.update_page.assert_called_once_with('rec123', {Fields.TWEETS: '1'})
+    assert state.get_tweet_classifications(['1', '2', '3', '4']) == {
+        '1': 'ok', '2': 'retweet', '3': 'deleted', '4': 'unavailable'
+    }
+
+
+def test_clean_entry_only_looks_up_unclassified_tweets(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from clean_old_collections import clean_entry
+    from state_store import StateStore
+
+    entry['fields'][Fields.TWEETS] = '1,2,3'
+    state = StateStore(':memory:')
+    state.record_tweet_classifications({'1': 'ok', '2': 'retweet'})
+    twitter.get_tweets.return_value = _lookup_response([('3', 'A new tweet')])
+
+    clean_entry(twitter, airtable, entry, state=state)
+
+    twitter.get_tweets.assert_called_once_with(['3'])
+    airtable.update_page.assert_called_once_with('rec123', {Fields.TWEETS: '1,3'})
+
+    # Everything is classified now, so the next pass makes no lookups at all
+    twitter.get_tweets.reset_mock()
+    clean_entry(twitter, airtable, entry, state=state)
+    assert twitter.get_tweets.call_count == 0
+
+
+def test_get_tweets_looks_up_100_ids_per_request():
+    from twitter import TwitterAPI
+
+    twitter = TwitterAPI('bearer-token', max_concurrency=4)
+    twitter.client.get_tweets = Mock(side_effect=lambda ids, **params: _lookup_response([(i, 'A tweet') for i in ids]))
+
+    response = twitter.get_tweets([str(i) for i in range(250)])
+
+    chunk_sizes = sorted(len(call[1]['ids']) for call in twitter.client.get_tweets.call_args_list)
+    assert chunk_sizes == [50, 100, 100]
+    assert sorted(int(tweet.id) for tweet in response.data) == list(range(250))
+
+
+def test_clean_entry_classifies_stored_tweets_without_looking_them_up(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from clean_old_collections import clean_entry
+    from tweet_store import TweetStore
+
+    entry['fields'][Fields.TWEETS] = '1,2,3'
+    tweet_store = TweetStore(':memory:')
+    tweet_store.record_tweets([
+        {'id': '1', 'text': 'A tweet'},
+        {'id': '2', 'text': 'Shared', 'referenced_tweets': [{'type': 'retweeted', 'id': '9'}]},
+    ])
+    twitter.get_tweets.return_value = _lookup_response([('3', 'RT @someone: A retweet')])
+
+    clean_entry(twitter, airtable, entry, tweet_store=tweet_store)
+
+    assert twitter.get_tweets.call_args[0][0] == ['3']
+    airtable.update_page.assert_called_once_with('rec123', {Fields.TWEETS: '1'})
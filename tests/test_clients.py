@@ -0,0 +1,61 @@
+from unittest.mock import Mock
+
+from metrics import RunMetrics
+from state_store import StateStore
+
+
+def test_clean_job_builds_its_twitter_client_with_the_state_store(monkeypatch, tmp_path):
+    import clean_old_collections
+    import clients
+    import config
+
+    built = []
+    monkeypatch.setattr(clients, 'make_twitter', lambda *args, **kwargs: built.append((args, kwargs)) or Mock())
+    monkeypatch.setattr(clients, 'make_airtable', lambda metrics: Mock())
+    monkeypatch.setattr(config, 'STATE_PATH', ':memory:')
+    monkeypatch.setattr(config, 'TWEET_STORE_PATH', ':memory:')
+    monkeypatch.setattr(config, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(clean_old_collections, 'run', lambda twitter, airtable, state: None)
+
+    clean_old_collections.main()
+
+    [((metrics, state, tweet_store), kwargs)] = built
+    assert isinstance(state, StateStore)
+    assert kwargs == {'wait_on_rate_limit': True}
+
+
+def test_twitter_client_never_sleeps_if_told_not_to(monkeypatch):
+    import clients
+    import config
+
+    state = StateStore(':memory:')
+    twitter = clients.make_twitter(RunMetrics(), state, None, wait_on_rate_limit=True)
+    assert twitter.wait_on_rate_limit and twitter.state is state
+
+    monkeypatch.setattr(config, 'TWITTER_NEVER_SLEEP', True)
+    assert not clients.make_twitter(RunMetrics(), state, None, wait_on_rate_limit=True).wait_on_rate_limit
+
+
+def test_stores_are_closed_and_metrics_written_when_a_job_fails(monkeypatch, tmp_path):
+    import pytest
+
+    import clients
+    import config
+
+    closed = []
+    monkeypatch.setattr(clients, 'make_twitter', lambda *args, **kwargs: Mock())
+    monkeypatch.setattr(clients, 'make_airtable', lambda metrics: Mock())
+    monkeypatch.setattr(clients.StateStore, 'close', lambda self: closed.append('state'))
+    monkeypatch.setattr(clients.TweetStore, 'close', lambda self: closed.append('tweets'))
+    monkeypatch.setattr(config, 'STATE_PATH', ':memory:')
+    monkeypatch.setattr(config, 'TWEET_STORE_PATH', ':memory:')
+    monkeypatch.setattr(config, 'METRICS_DIR', str(tmp_path))
+
+    def run(twitter, airtable, state):
+        raise RuntimeError("Search failed")
+
+    with pytest.raises(RuntimeError):
+        clients.run_twitter_job('fetch_tweets', run)
+
+    assert closed == ['state', 'tweets']
+    assert (tmp_path / 'fetch_tweets.json').exists()
@@ -0,0 +1,39 @@
+import json
+
+from field_constants import Fields
+
+
+def test_dispatched_records_are_read_and_created_on_their_own(mock_apis, monkeypatch, tmp_path):
+    twitter, airtable, entry = mock_apis
+    import create_collections
+
+    event_path = tmp_path / 'event.json'
+    event_path.write_text(json.dumps({'action': 'create_new_twitter_collection',
+                                      'client_payload': {'record_ids': ['rec123'], 'record_id': 'rec456'}}))
+    monkeypatch.setenv('GITHUB_EVENT_PATH', str(event_path))
+    monkeypatch.setattr(create_collections, 'COLLECTION_URL_PREFIX', 'https://example.com/collections/')
+    new_entry = {'id': 'rec123', 'fields': {Fields.NAME: 'Pub', Fields.DESCRIPTION: 'Test pub',
+                                            Fields.SEARCH: 'https://example.com/pub'}}
+    airtable.get_database_entries.return_value = [new_entry]
+
+    record_ids = create_collections.dispatch_record_ids()
+    create_collections.run(airtable, record_ids)
+
+    assert record_ids == ['rec123', 'rec456']
+    formula = airtable.get_database_entries.call_args[1]['formula']
+    assert "RECORD_ID()='rec123'" in formula and "RECORD_ID()='rec456'" in formula
+    record_id, fields = airtable.update_page.call_args[0]
+    assert record_id == 'rec123'
+    assert fields[Fields.URL] == 'https://example.com/collections/' + fields[Fields.ID].replace('custom-', '')
+
+
+def test_without_record_ids_the_whole_table_is_scanned(mock_apis, monkeypatch):
+    twitter, airtable, entry = mock_apis
+    import create_collections
+
+    monkeypatch.delenv('GITHUB_EVENT_PATH', raising=False)
+    airtable.get_database_entries.return_value = []
+
+    create_collections.run(airtable, create_collections.dispatch_record_ids())
+
+    assert airtable.get_database_entries.call_args[1]['formula'] == create_collections.ENTRY_FORMULA
@@ -1,5 +1,9 @@
 from unittest.mock import Mock
+
+import pytest
+
 from field_constants import Fields
+from twitter import Page
 
 
 def test_get_quote_tweets(mock_apis):
@@ -18,15 +22,15 @@ def test_get_quote_tweets(mock_apis):
     }
 
     def mock_get_quote_tweets(tweet_id):
-        return quote_tweets_by_id.get(tweet_id, [])
+        return [Page(quote_tweets_by_id.get(tweet_id, []))]
 
-    twitter.get_quote_tweets_for_tweet = Mock(side_effect=mock_get_quote_tweets)
+    twitter.iter_quote_tweet_pages = Mock(side_effect=mock_get_quote_tweets)
 
     # Run the function
     get_quote_tweets(twitter, airtable, 'test_collection_id')
 
     # Check that quote tweets were fetched for both original tweets
-    assert twitter.get_quote_tweets_for_tweet.call_count == 2
+    assert twitter.iter_quote_tweet_pages.call_count == 2
 
     # Check that Airtable was updated with all tweets (original + quotes)
     update_calls = airtable.update_page.call_args_list
@@ -53,15 +57,15 @@ def test_get_quote_tweets_error_handling(mock_apis):
     def mock_get_quote_tweets(tweet_id):
         if tweet_id == '1734567890123456789':
             raise Exception("API Error")
-        return [{'id': '1734567890123457111', 'text': 'Quote tweet 3'}]
+        return [Page([{'id': '1734567890123457111', 'text': 'Quote tweet 3'}])]
 
-    twitter.get_quote_tweets_for_tweet = Mock(side_effect=mock_get_quote_tweets)
+    twitter.iter_quote_tweet_pages = Mock(side_effect=mock_get_quote_tweets)
 
     # Run the function
     get_quote_tweets(twitter, airtable, 'test_collection_id')
 
     # Check that it tried both tweets despite the first error
-    assert twitter.get_quote_tweets_for_tweet.call_count == 2
+    assert twitter.iter_quote_tweet_pages.call_count == 2
 
     # Check that Airtable was updated with the successful quote tweet
     update_calls = airtable.update_page.call_args_list
@@ -83,13 +87,188 @@ def test_get_quote_tweets_no_quote_tweets_found(mock_apis):
     from fetch_quote_tweets import get_quote_tweets
 
     # Mock finding no quote tweets
-    twitter.get_quote_tweets_for_tweet.return_value = []
+    twitter.iter_quote_tweet_pages.return_value = []
 
     # Run the function
     get_quote_tweets(twitter, airtable, 'test_collection_id')
 
     # Check that it tried both tweets
-    assert twitter.get_quote_tweets_for_tweet.call_count == 2
+    assert twitter.iter_quote_tweet_pages.call_count == 2
 
     # Check that Airtable was not updated since no new tweets were found
     assert airtable.update_page.call_count == 0
+
+
+def test_get_quote_tweets_concurrently(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_quote_tweets import get_quote_tweets
+
+    def mock_get_quote_tweets(tweet_id):
+        return [Page([{'id': str(int(tweet_id) + 1000), 'text': f'Quote of {tweet_id}'}])]
+
+    twitter.iter_quote_tweet_pages = Mock(side_effect=mock_get_quote_tweets)
+
+    get_quote_tweets(twitter, airtable, 'test_collection_id', max_workers=4)
+
+    assert twitter.iter_quote_tweet_pages.call_count == 2
+    assert airtable.update_page.call_count == 1
+    actual_tweets = set(airtable.update_page.call_args[0][1][Fields.TWEETS].split(','))
+    assert actual_tweets == {
+        '1734567890123456789',
+        '1734567890123456790',
+        '1734567890123457789',
+        '1734567890123457790',
+    }
+
+
+def test_get_quote_tweets_stops_at_known_quote_tweets(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_quote_tweets import get_quote_tweets
+    from state_store import StateStore
+
+    state = StateStore(':memory:')
+    state.record_quote_watermark('test_collection_id', '1734567890123456789', 1734567890123456888)
+
+    def mock_get_quote_tweets(tweet_id, stop_at_id=None):
+        return [Page([{'id': '1734567890123457000', 'text': 'Newer quote'}])] if stop_at_id else []
+
+    twitter.iter_quote_tweet_pages = Mock(side_effect=mock_get_quote_tweets)
+
+    get_quote_tweets(twitter, airtable, 'test_collection_id', state=state)
+
+    stop_ids = {call[0][0]: call[1]['stop_at_id'] for call in twitter.iter_quote_tweet_pages.call_args_list}
+    assert stop_ids == {'1734567890123456789': 1734567890123456888, '1734567890123456790': None}
+    assert state.get_quote_watermark('test_collection_id', '1734567890123456789') == 1734567890123457000
+    assert state.get_collection_state('test_collection_id')['last_quote_check_at'] is not None
+
+
+def test_quote_state_of_a_tweet_is_kept_per_collection(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_quote_tweets import get_quote_tweets
+    from state_store import StateStore
+    from twitter import QUOTES_ENDPOINT
+
+    # Another collection shares the tweets and has fetched their quotes before
+    airtable.get_entry_by_collection_id = Mock(return_value=entry)
+    state = StateStore(':memory:')
+    state.record_quote_watermark('other_collection_id', '1734567890123456789', 1734567890123456888)
+    other_cursor = {
+        'next_token': 'page-2', 'since_id': None, 'newest_id': 1734567890123457500,
+        'collection_ids': ['other_collection_id'],
+    }
+    state.save_cursor(QUOTES_ENDPOINT, 'other_collection_id:1734567890123456790', other_cursor)
+    twitter.iter_quote_tweet_pages = Mock(return_value=[])
+
+    get_quote_tweets(twitter, airtable, 'test_collection_id', state=state)
+
+    options = {call[0][0]: call[1] for call in twitter.iter_quote_tweet_pages.call_args_list}
+    assert options == {'1734567890123456789': {'stop_at_id': None}, '1734567890123456790': {'stop_at_id': None}}
+    assert state.get_cursors(QUOTES_ENDPOINT) == {'other_collection_id:1734567890123456790': other_cursor}
+    assert state.get_quote_watermark('other_collection_id', '1734567890123456789') == 1734567890123456888
+
+
+def test_a_small_budget_gets_round_to_every_tweet(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_quote_tweets import get_quote_tweets
+    from state_store import StateStore
+
+    state = StateStore(':memory:')
+    twitter.iter_quote_tweet_pages = Mock(return_value=[])
+
+    get_quote_tweets(twitter, airtable, 'test_collection_id', max_calls=1, state=state)
+    get_quote_tweets(twitter, airtable, 'test_collection_id', max_calls=1, state=state)
+    get_quote_tweets(twitter, airtable, 'test_collection_id', max_calls=1, state=state)
+
+    checked = [call[0][0] for call in twitter.iter_quote_tweet_pages.call_args_list]
+    assert checked == ['1734567890123456790', '1734567890123456789', '1734567890123456790']
+
+
+def test_get_quote_tweets_for_tweet_stops_paginating_at_watermark():
+    from twitter import TwitterAPI
+
+    pages = [
+        Mock(data=[{'id': '30'}, {'id': '29'}], meta={'next_token': 'page-2'}),
+        Mock(data=[{'id': '28'}, {'id': '20'}], meta={'next_token': 'page-3'}),
+        Mock(data=[{'id': '19'}], meta={}),
+    ]
+    twitter = TwitterAPI('bearer-token')
+    twitter.client.get_quote_tweets = Mock(side_effect=pages)
+
+    tweets = twitter.get_quote_tweets_for_tweet('1', stop_at_id=20)
+
+    assert [tweet['id'] for tweet in tweets] == ['30', '29', '28']
+    assert twitter.client.get_quote_tweets.call_count == 2
+
+
+def test_get_quote_tweets_continues_unfinished_pagination_first(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_quote_tweets import get_quote_tweets
+    from state_store import StateStore
+    from twitter import QUOTES_ENDPOINT, RateLimitExhausted
+
+    state = StateStore(':memory:')
+    state.save_cursor(QUOTES_ENDPOINT, 'test_collection_id:1734567890123456789', {
+        'next_token': 'page-2', 'since_id': None, 'newest_id': 1734567890123457500,
+        'collection_ids': ['test_collection_id'],
+    })
+
+    def mock_get_quote_tweets(tweet_id, pagination_token=None, stop_at_id=None):
+        if pagination_token:
+            return [Page([{'id': '1734567890123457400', 'text': 'Older quote'}])]
+        raise RateLimitExhausted("No get_quote_tweets calls left until the rate limit resets")
+
+    twitter.iter_quote_tweet_pages = Mock(side_effect=mock_get_quote_tweets)
+
+    with pytest.raises(RateLimitExhausted):
+        get_quote_tweets(twitter, airtable, 'test_collection_id', state=state)
+
+    first_call = twitter.iter_quote_tweet_pages.call_args_list[0]
+    assert first_call[0][0] == '1734567890123456789'
+    assert first_call[1]['pagination_token'] == 'page-2'
+    # The finished tweet takes the newest quote ID seen across both runs as its watermark
+    assert state.get_quote_watermark('test_collection_id', '1734567890123456789') == 1734567890123457500
+    assert state.get_quote_watermark('test_collection_id', '1734567890123456790') is None
+    assert state.get_cursors(QUOTES_ENDPOINT) == {}
+    assert '1734567890123457400' in airtable.update_page.call_args[0][1][Fields.TWEETS]
+
+
+def test_only_tweets_quoted_since_the_last_check_are_fetched(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_quote_tweets import find_tweets_with_new_quotes, get_quote_tweets
+    from state_store import StateStore
+
+    state = StateStore(':memory:')
+    state.record_quote_counts('test_collection_id', {'1734567890123456789': 3, '1734567890123456790': 1})
+    twitter.get_tweets = Mock(return_value=Mock(data=[
+        Mock(id=1734567890123456789, data={'public_metrics': {'quote_count': 3}}),
+        Mock(id=1734567890123456790, data={'public_metrics': {'quote_count': 2}}),
+    ]))
+    twitter.iter_quote_tweet_pages = Mock(return_value=[Page([{'id': '1734567890123457111', 'text': 'Quote tweet'}])])
+
+    tweets_to_check, quote_counts = find_tweets_with_new_quotes(twitter, [entry], state=state)
+    get_quote_tweets(twitter, airtable, 'test_collection_id', state=state,
+                     tweet_ids=tweets_to_check['test_collection_id'], quote_counts=quote_counts)
+
+    assert twitter.get_tweets.call_args[1]['refresh'] is True
+    assert tweets_to_check == {'test_collection_id': ['1734567890123456790']}
+    assert [call[0][0] for call in twitter.iter_quote_tweet_pages.call_args_list] == ['1734567890123456790']
+    assert state.get_quote_counts('test_collection_id', quote_counts) == {'1734567890123456789': 3, '1734567890123456790': 2}
+
+
+def test_quotes_of_quotes_are_skipped_past_the_max_depth(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_quote_tweets import find_tweets_with_new_quotes, quote_depths
+
+    quote = {'public_metrics': {'quote_count': 1},
+             'referenced_tweets': [{'type': 'quoted', 'id': '1734567890123456789'}]}
+    twitter.get_tweets = Mock(return_value=Mock(data=[
+        Mock(id=1734567890123456789, data={'public_metrics': {'quote_count': 1}}),
+        Mock(id=1734567890123456790, data=quote),
+    ]))
+
+    tweets_to_check, _ = find_tweets_with_new_quotes(twitter, [entry], max_depth=1)
+
+    assert tweets_to_check == {'test_collection_id': ['1734567890123456789']}
+    assert quote_depths({'a': {'referenced_tweets': [{'type': 'quoted', 'id': 'b'}]},
+                         'b': {'referenced_tweets': [{'type': 'quoted', 'id': 'a'}]},
+                         'c': {'referenced_tweets': [{'type': 'quoted', 'id': 'a'}]}}) == {'a': 1, 'b': 0, 'c': 2}
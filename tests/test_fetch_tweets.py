@@ -1,4 +1,10 @@
+from unittest.mock import Mock
+
+import pytest
+import tweepy
+
 from field_constants import Fields
+from twitter import Page
 
 
 def test_get_tweets_for_entry(mock_apis):
@@ -10,12 +16,12 @@ def test_get_tweets_for_entry(mock_apis):
         'text': 'New tweet! https://research.arcadiascience.com/pub/test-pub'
     }
 
-    twitter.search_tweets.return_value = [new_tweet]
+    twitter.iter_search_pages.return_value = [Page([new_tweet])]
     get_tweets_for_entry(twitter, airtable, 'test_collection_id')
 
     expected_query = 'url:"https://research.arcadiascience.com/pub/test-pub" -is:retweet'
     expected_last_id = '1734567890123456790'
-    search_calls = twitter.search_tweets.call_args_list
+    search_calls = twitter.iter_search_pages.call_args_list
     assert len(search_calls) > 0
     actual_args = search_calls[0][1]
     assert actual_args['query'] == expected_query
@@ -35,16 +41,16 @@ def test_get_tweets_for_entry_error_handling(mock_apis):
     twitter, airtable, entry = mock_apis
     from fetch_tweets import get_tweets_for_entry
 
-    twitter.search_tweets.side_effect = [
+    twitter.iter_search_pages.side_effect = [
         Exception("Search failed"),
-        [{'id': '1734567890123456792', 'text': 'Fallback tweet'}]
+        [Page([{'id': '1734567890123456792', 'text': 'Fallback tweet'}])]
     ]
 
     get_tweets_for_entry(twitter, airtable, 'test_collection_id')
 
-    assert twitter.search_tweets.call_count == 2
+    assert twitter.iter_search_pages.call_count == 2
 
-    last_call_args = twitter.search_tweets.call_args_list[1][1]
+    last_call_args = twitter.iter_search_pages.call_args_list[1][1]
     assert last_call_args.get('last_tweet_id') is None
 
     update_calls = airtable.update_page.call_args_list
@@ -55,3 +61,210 @@ def test_get_tweets_for_entry_error_handling(mock_apis):
     expected_tweets = {'1734567890123456789', '1734567890123456790', '1734567890123456792'}
     assert actual_id == 'rec123'
     assert actual_tweets == expected_tweets
+
+
+def test_get_tweets_for_entry_compares_tweet_ids_numerically(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_tweets import get_tweets_for_entry
+
+    entry['fields'][Fields.TWEETS] = '999999999999999999,1000000000000000000'
+    twitter.iter_search_pages.return_value = []
+
+    get_tweets_for_entry(twitter, airtable, 'test_collection_id')
+
+    assert twitter.iter_search_pages.call_args[1]['last_tweet_id'] == '1000000000000000000'
+
+
+def test_get_tweets_for_entry_uses_state_watermark(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_tweets import get_tweets_for_entry
+    from state_store import StateStore
+
+    state = StateStore(':memory:')
+    state.record_fetch('test_collection_id', 1734567890123456800)
+    twitter.iter_search_pages.return_value = [Page([{'id': '1734567890123456801', 'text': 'Newer tweet'}])]
+
+    get_tweets_for_entry(twitter, airtable, 'test_collection_id', state=state)
+
+    assert twitter.iter_search_pages.call_args[1]['last_tweet_id'] == '1734567890123456800'
+    assert state.get_newest_tweet_id('test_collection_id') == 1734567890123456801
+    assert state.get_collection_state('test_collection_id')['last_fetch_at'] is not None
+
+
+def test_get_tweets_for_batch_routes_tweets_to_collections(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_tweets import get_tweets_for_batch
+    from search_planner import build_url_prefix_index, plan_batches
+
+    other_entry = {
+        'id': 'rec456',
+        'fields': {
+            Fields.SEARCH: 'https://research.arcadiascience.com/pub/other-pub',
+            Fields.TWEETS: '',
+            Fields.ID: 'other_collection_id',
+        },
+    }
+    entries = {'test_collection_id': entry, 'other_collection_id': other_entry}
+    airtable.get_entry_by_collection_id = Mock(side_effect=entries.get)
+
+    twitter.iter_search_pages.return_value = [Page([
+        {'id': '1734567890123456791', 'text': 'Test pub!', 'entities': {'urls': [
+            {'expanded_url': 'https://research.arcadiascience.com/pub/test-pub/release/1'}]}},
+        {'id': '1734567890123456792', 'text': 'Other pub!', 'entities': {'urls': [
+            {'expanded_url': 'https://research.arcadiascience.com/pub/other-pub'}]}},
+    ])]
+
+    [batch] = plan_batches([entry, other_entry])
+    get_tweets_for_batch(twitter, airtable, batch, build_url_prefix_index([entry, other_entry]))
+
+    assert twitter.iter_search_pages.call_count == 1
+    assert 'other-pub' in twitter.iter_search_pages.call_args[1]['query']
+    assert twitter.iter_search_pages.call_args[1]['tweet_fields'] == ['entities']
+    updates = {call[0][0]: set(call[0][1][Fields.TWEETS].split(',')) for call in airtable.update_page.call_args_list}
+    assert updates == {
+        'rec123': {'1734567890123456789', '1734567890123456790', '1734567890123456791'},
+        'rec456': {'1734567890123456792'},
+    }
+
+
+def test_get_tweets_for_entry_commits_pages_as_they_arrive(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_tweets import get_tweets_for_entry
+    from state_store import StateStore
+
+    state = StateStore(':memory:')
+    state.record_fetch('test_collection_id', 1734567890123456790)
+    committed = []
+
+    def pages(**kwargs):
+        yield Page([{'id': '1734567890123456800', 'text': 'Page 1'}], next_token='page-2')
+        # The first page is committed before the second one is requested
+        committed.append(airtable.update_page.call_count)
+        yield Page([{'id': '1734567890123456799', 'text': 'Page 2'}], next_token='page-3')
+
+    twitter.iter_search_pages = Mock(side_effect=pages)
+
+    get_tweets_for_entry(twitter, airtable, 'test_collection_id', max_pages=2, state=state,
+                         pages_per_commit=1)
+
+    assert committed == [1]
+    assert airtable.update_page.call_count == 2
+    # The search stopped before its last page, so the watermark stays put for the next run
+    assert state.get_newest_tweet_id('test_collection_id') == 1734567890123456790
+
+
+def test_iter_search_pages_respects_max_pages():
+    from twitter import TwitterAPI
+
+    twitter = TwitterAPI('bearer-token')
+    twitter.client.search_recent_tweets = Mock(side_effect=[
+        Mock(data=[{'id': '3'}], meta={'next_token': 'a'}),
+        Mock(data=[{'id': '2'}], meta={'next_token': 'b'}),
+    ])
+
+    pages = list(twitter.iter_search_pages('query', last_tweet_id='1', max_pages=2))
+
+    assert [page.next_token for page in pages] == ['a', 'b']
+    assert twitter.client.search_recent_tweets.call_count == 2
+    assert twitter.client.search_recent_tweets.call_args[1]['next_token'] == 'a'
+    assert twitter.client.search_recent_tweets.call_args[1]['since_id'] == '1'
+
+
+def test_unfinished_search_is_continued_by_the_next_run(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_tweets import get_tweets_for_entry
+    from state_store import StateStore
+    from twitter import DeadlineReached, SEARCH_ENDPOINT
+
+    state = StateStore(':memory:')
+    state.record_fetch('test_collection_id', 1734567890123456790)
+
+    def stopped_search(**kwargs):
+        yield Page([{'id': '1734567890123456800', 'text': 'Page 1'}], next_token='page-2')
+        raise DeadlineReached("The run's deadline has passed")
+
+    twitter.iter_search_pages = Mock(side_effect=stopped_search)
+    with pytest.raises(DeadlineReached):
+        get_tweets_for_entry(twitter, airtable, 'test_collection_id', state=state)
+
+    # The page that arrived was committed, and the search's position saved instead of the watermark
+    assert '1734567890123456800' in airtable.update_page.call_args[0][1][Fields.TWEETS]
+    assert state.get_newest_tweet_id('test_collection_id') == 1734567890123456790
+    [(query, cursor)] = state.get_cursors(SEARCH_ENDPOINT).items()
+    assert cursor['next_token'] == 'page-2'
+
+    twitter.iter_search_pages = Mock(side_effect=[
+        [Page([{'id': '1734567890123456795', 'text': 'Page 2'}])],
+        [Page([{'id': '1734567890123456900', 'text': 'Newer tweet'}])],
+    ])
+    get_tweets_for_entry(twitter, airtable, 'test_collection_id', state=state)
+
+    resumed, new = [call[1] for call in twitter.iter_search_pages.call_args_list]
+    assert (resumed['next_token'], resumed['last_tweet_id']) == ('page-2', '1734567890123456790')
+    assert 'next_token' not in new and new['last_tweet_id'] == '1734567890123456800'
+    assert state.get_newest_tweet_id('test_collection_id') == 1734567890123456900
+    assert state.get_cursors(SEARCH_ENDPOINT) == {}
+
+
+def test_watermark_only_moves_once_the_tweets_are_written(mock_apis):
+    twitter, airtable, entry = mock_apis
+    from fetch_tweets import get_tweets_for_entry
+    from state_store import StateStore
+
+    state = StateStore(':memory:')
+    state.record_fetch('test_collection_id', 1734567890123456790)
+    # Stands in for a batching client, which writes on the next flush
+    written = []
+    airtable.after_write = Mock(side_effect=lambda record_ids, callback: written.append(callback))
+    twitter.iter_search_pages = Mock(return_value=[Page([{'id': '1734567890123456900', 'text': 'New tweet'}])])
+
+    get_tweets_for_entry(twitter, airtable, 'test_collection_id', state=state)
+    assert airtable.after_write.call_args[0][0] == ['rec123']
+    assert state.get_newest_tweet_id('test_collection_id') == 1734567890123456790
+
+    for callback in written:
+        callback()
+    assert state.get_newest_tweet_id('test_collection_id') == 1734567890123456900
+
+
+def test_requests_stop_at_the_deadline(monkeypatch):
+    import time
+    from twitter import DeadlineReached, RateLimitExhausted, SEARCH_ENDPOINT, TwitterAPI
+
+    monkeypatch.setattr(time, 'sleep', Mock(side_effect=AssertionError("slept")))
+
+    twitter = TwitterAPI('bearer-token', deadline=time.time() - 1)
+    twitter.client.search_recent_tweets = Mock()
+    with pytest.raises(DeadlineReached):
+        twitter.search_tweets('query')
+    assert twitter.client.search_recent_tweets.call_count == 0
+
+    # A rate limit that resets after the deadline is not waited for
+    twitter = TwitterAPI('bearer-token', deadline=time.time() + 60)
+    twitter.rate_limits[SEARCH_ENDPOINT] = {'limit': 60, 'remaining': 0, 'reset': int(time.time()) + 600}
+    with pytest.raises(DeadlineReached):
+        twitter.search_tweets('query')
+
+    # Without waiting, a 429 is raised as RateLimitExhausted instead of slept on
+    twitter = TwitterAPI('bearer-token', wait_on_rate_limit=False)
+    response = Mock(status_code=429, reason='Too Many Requests', headers={}, json=Mock(return_value={}))
+    twitter.client.search_recent_tweets = Mock(side_effect=tweepy.TooManyRequests(response))
+    with pytest.raises(RateLimitExhausted):
+        twitter.search_tweets('query')
+
+
+def test_saved_searches_with_a_changed_query_are_dropped():
+    from fetch_tweets import drop_unplanned_cursors
+    from state_store import StateStore
+    from twitter import SEARCH_ENDPOINT
+
+    state = StateStore(':memory:')
+    for query, collection_ids in [('(a OR b) -is:retweet', ['a', 'b']), ('(c OR d) -is:retweet', ['c', 'd']),
+                                  ('e -is:retweet', ['e'])]:
+        cursor = {'next_token': 'page-2', 'since_id': None, 'newest_id': None, 'collection_ids': collection_ids}
+        state.save_cursor(SEARCH_ENDPOINT, query, cursor)
+
+    # a is now batched with c, so neither saved batch can be resumed; e is not searched this run
+    drop_unplanned_cursors(state, {'a': '(a OR c) -is:retweet', 'c': '(a OR c) -is:retweet', 'b': 'b -is:retweet'})
+
+    assert list(state.get_cursors(SEARCH_ENDPOINT)) == ['e -is:retweet']
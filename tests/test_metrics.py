@@ -0,0 +1,93 @@
+import json
+import time
+from unittest.mock import Mock
+
+from metrics import RunMetrics
+from utils import run_concurrently
+
+
+def test_requests_are_counted_per_endpoint_and_collection_across_threads():
+    metrics = RunMetrics("test")
+
+    def fetch(collection_id):
+        with metrics.collection(collection_id):
+            run_concurrently(
+                lambda _: metrics.record_request("twitter", "get_tweets", 0.2, 100, 200),
+                range(3),
+                max_workers=3,
+            )
+
+    run_concurrently(fetch, ["c1", "c2"], max_workers=2)
+    metrics.record_request("twitter", "get_tweets", 20.0, 10, 503)
+    metrics.record_request("twitter", "get_tweets", 0.0, 100, 200, from_cache=True)
+    with metrics.collection("c1"):
+        metrics.record_sleep("twitter", "get_tweets", 1.5, "rate_limit")
+
+    endpoint, = metrics.summary()["endpoints"]
+    assert (endpoint["calls"], endpoint["errors"], endpoint["cache_hits"], endpoint["bytes"]) == (7, 1, 1, 610)
+    assert endpoint["latency_buckets"]["0.25"] == 6
+    assert endpoint["latency_buckets"]["inf"] == 1
+    collection = metrics.summary()["collections"]["c1"]
+    assert collection["calls"] == {"twitter.get_tweets": 3}
+    assert (collection["bytes"], round(collection["latency_seconds_sum"], 6)) == (300, 0.6)
+    assert collection["sleep_seconds"] == {"rate_limit": 1.5}
+    assert metrics.summary()["collections"]["c2"]["sleep_seconds"] == {}
+    # The collections run in parallel, so their spans end in any order
+    assert sorted(span["collection_id"] for span in metrics.spans) == ["c1", "c1", "c2"]
+
+
+def test_rate_limit_sleeps_are_recorded(monkeypatch):
+    from twitter import SEARCH_ENDPOINT, TwitterAPI
+
+    metrics = RunMetrics("test")
+    twitter = TwitterAPI('bearer-token', metrics=metrics)
+    twitter.client.search_recent_tweets = Mock(return_value=Mock(data=None, meta={}))
+    twitter.rate_limits[SEARCH_ENDPOINT] = {'limit': 60, 'remaining': 0, 'reset': int(time.time()) + 30}
+    # Sleeping until the reset makes the whole window available again
+    monkeypatch.setattr(time, 'sleep', lambda seconds: twitter.rate_limits.pop(SEARCH_ENDPOINT))
+
+    twitter.search_tweets('query')
+
+    endpoint, = metrics.summary()["endpoints"]
+    assert 29 <= endpoint["sleep_seconds"]["rate_limit"] <= 32
+
+
+def test_summary_and_textfile_are_written(tmp_path):
+    metrics = RunMetrics("fetch_tweets")
+    metrics.record_request("twitter", "search_recent_tweets", 0.07, 2048, 200)
+    metrics.record_request("twitter", "search_recent_tweets", 0.3, 1024, 200)
+    metrics.record_page("twitter", "search_recent_tweets", 100)
+    metrics.record_writes("airtable", "update_records", 10)
+
+    metrics.write(str(tmp_path))
+
+    summary = json.loads((tmp_path / "fetch_tweets.json").read_text())
+    assert [e["endpoint"] for e in summary["endpoints"]] == ["update_records", "search_recent_tweets"]
+    lines = (tmp_path / "fetch_tweets.prom").read_text().splitlines()
+    labels = 'job="fetch_tweets",service="twitter",endpoint="search_recent_tweets"'
+    assert f"twitter_collections_api_calls_total{{{labels}}} 2" in lines
+    assert f"twitter_collections_api_items_total{{{labels}}} 100" in lines
+    assert f'twitter_collections_api_latency_seconds_bucket{{{labels},le="0.1"}} 1' in lines
+    assert f'twitter_collections_api_latency_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert f"twitter_collections_api_latency_seconds_count{{{labels}}} 2" in lines
+    assert not (tmp_path / "fetch_tweets.prom.tmp").exists()
+
+
+def test_twitter_client_records_its_requests(monkeypatch):
+    from stand_ins import TwitterStandIn, generate_dataset
+    from twitter import TwitterAPI
+
+    dataset = generate_dataset(1, 10, seed=0)
+    url = next(iter(dataset.tweets_by_url))
+    metrics = RunMetrics("test")
+    with TwitterStandIn(dataset) as server:
+        monkeypatch.setenv("API_HOST_OVERRIDES", f"api.twitter.com={server.url}")
+        twitter = TwitterAPI("token", metrics=metrics)
+        with metrics.collection("c1"):
+            tweets = twitter.search_tweets(f'url:"{url}"', max_results=10)
+
+    endpoint, = metrics.summary()["endpoints"]
+    assert endpoint["calls"] == 1 and endpoint["pages"] == 1
+    assert endpoint["items"] == len(tweets) > 0
+    assert endpoint["bytes"] > 0
+    assert metrics.summary()["collections"]["c1"]["calls"] == {"twitter.search_recent_tweets": 1}
@@ -0,0 +1,54 @@
+import gzip
+import json
+from datetime import timedelta
+
+from field_constants import Fields
+
+
+def test_only_changed_artifacts_are_written(mock_apis, tmp_path):
+    twitter, airtable, entry = mock_apis
+    from publish_collections import write_artifacts
+    from tweet_store import TweetStore
+
+    tweet_store = TweetStore(':memory:')
+    tweet_store.record_tweets([{'id': '1734567890123456790', 'text': 'Newest', 'author_id': '7'}],
+                              users=[{'id': '7', 'username': 'arcadia'}])
+    entry['fields'][Fields.TWEETS] = '1734567890123456790,1734567890123456789,1734567890123456790'
+
+    assert write_artifacts([entry], str(tmp_path), tweet_store=tweet_store) == 1
+    manifest = json.loads((tmp_path / 'index.json').read_text())
+    first = manifest['collections']['test_collection_id']
+    artifact = json.loads((tmp_path / first['path']).read_text())
+    assert artifact['tweet_ids'] == ['1734567890123456790', '1734567890123456789']
+    assert [tweet['text'] for tweet in artifact['tweets']] == ['Newest']
+    assert artifact['tweets'][0]['author']['username'] == 'arcadia'
+
+    manifest_written_at = (tmp_path / 'index.json').stat().st_mtime_ns
+    assert write_artifacts([entry], str(tmp_path), tweet_store=tweet_store) == 0
+    assert (tmp_path / 'index.json').stat().st_mtime_ns == manifest_written_at
+
+    entry['fields'][Fields.TWEETS] += ',1734567890123456791'
+    assert write_artifacts([entry], str(tmp_path), tweet_store=tweet_store) == 1
+    manifest = json.loads((tmp_path / 'index.json').read_text())
+    second = manifest['collections']['test_collection_id']
+    assert second['hash'] != first['hash'] and second['tweet_count'] == 3
+    # Clients holding the old manifest can still load the file it points to
+    assert (tmp_path / first['path']).exists()
+    assert list(manifest['superseded']) == [first['path']]
+
+    assert write_artifacts([entry], str(tmp_path), tweet_store=tweet_store, retention=timedelta(0)) == 0
+    assert not (tmp_path / first['path']).exists()
+    assert json.loads((tmp_path / 'index.json').read_text())['superseded'] == {}
+
+
+def test_gzipped_artifacts_are_the_same_bytes_for_the_same_content(mock_apis, tmp_path):
+    twitter, airtable, entry = mock_apis
+    from publish_collections import write_artifacts
+
+    write_artifacts([entry], str(tmp_path / 'a'), compress=True)
+    write_artifacts([entry], str(tmp_path / 'b'), compress=True)
+
+    path = json.loads((tmp_path / 'a' / 'index.json').read_text())['collections']['test_collection_id']['path']
+    assert path.endswith('.json.gz')
+    assert (tmp_path / 'a' / path).read_bytes() == (tmp_path / 'b' / path).read_bytes()
+    assert json.loads(gzip.decompress((tmp_path / 'a' / path).read_bytes()))['collection_id'] == 'test_collection_id'
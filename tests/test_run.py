@@ -0,0 +1,63 @@
+import pathlib
+import subprocess
+import sys
+from unittest.mock import Mock
+
+
+def test_jobs_run_in_order_against_shared_clients(mock_apis, monkeypatch):
+    twitter, airtable, entry = mock_apis
+    import clean_old_collections
+    import create_collections
+    import fetch_tweets
+    from run import run_jobs
+
+    calls = []
+    monkeypatch.setattr(create_collections, 'run', lambda airtable: calls.append(('create', airtable)))
+    monkeypatch.setattr(fetch_tweets, 'run', Mock(side_effect=Exception("Search failed")))
+    monkeypatch.setattr(
+        clean_old_collections, 'run',
+        lambda twitter, airtable, state: calls.append(('clean', twitter.wait_on_rate_limit)),
+    )
+
+    failed = run_jobs(['clean', 'fetch-tweets', 'create'], airtable, twitter, state=None)
+
+    assert calls == [('create', airtable), ('clean', True)]
+    assert failed == ['fetch-tweets']
+    assert airtable.flush.call_count == 2
+
+
+def test_create_only_run_does_not_load_tweepy():
+    script = (
+        "import importlib, sys\n"
+        "import run, airtable\n"
+        "importlib.import_module(run.JOBS['create'].module)\n"
+        "assert 'tweepy' not in sys.modules, 'tweepy was imported'\n"
+    )
+    result = subprocess.run([sys.executable, '-c', script], cwd=pathlib.Path(__file__).parents[1] / 'src', capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_each_job_reads_the_table_once(monkeypatch):
+    from unittest.mock import patch
+
+    import create_collections
+    import publish_collections
+    from airtable import AirtableAPI
+    from run import run_jobs
+
+    def read_twice(module):
+        def run(airtable, *args):
+            for _ in range(2):
+                airtable.get_database_entries(fields=module.ENTRY_FIELDS, formula=module.ENTRY_FORMULA)
+        return run
+
+    monkeypatch.setattr(create_collections, 'run', read_twice(create_collections))
+    monkeypatch.setattr(publish_collections, 'run', read_twice(publish_collections))
+    with patch('airtable.Table') as table_cls:
+        table = table_cls.return_value
+        table.api.iterate_requests = Mock(side_effect=lambda **kwargs: iter([{'records': []}]))
+        airtable = AirtableAPI(api_key='key', base_id='base', table_name='table')
+
+    assert run_jobs(['create', 'publish'], airtable) == []
+    # The jobs filter the table differently, so each makes one read of its own
+    assert table.api.iterate_requests.call_count == 2
@@ -0,0 +1,77 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from field_constants import Fields
+from scheduler import CallBudgetScheduler
+
+
+def _entry(collection_id, days_old, tweets=''):
+    created = (datetime.now(timezone.utc) - timedelta(days=days_old)).isoformat()
+    return {
+        'id': f'rec-{collection_id}',
+        'fields': {Fields.ID: collection_id, Fields.CREATED_DATE: created, Fields.TWEETS: tweets},
+    }
+
+
+def test_allocate_serves_highest_weight_first_and_carries_over_the_rest():
+    scheduler = CallBudgetScheduler('search_recent_tweets')
+    entries = [_entry('old', 700), _entry('new', 1), _entry('middle', 100)]
+
+    allocations = scheduler.allocate(entries, available_calls=2)
+
+    assert list(allocations) == ['new', 'middle']
+    assert set(scheduler.carry_over) == {'old'}
+
+    # The skipped collection outranks a collection of the same age in the next run
+    allocations = scheduler.allocate([_entry('old', 700), _entry('other-old', 700)], available_calls=1)
+    assert list(allocations) == ['old']
+    assert 'old' not in scheduler.carry_over
+
+
+def test_allocate_serves_unfinished_collections_first():
+    scheduler = CallBudgetScheduler('search_recent_tweets')
+    entries = [_entry('new', 1), _entry('old', 700)]
+
+    allocations = scheduler.allocate(entries, available_calls=1, first={'old'})
+
+    assert list(allocations) == ['old']
+
+
+def test_allocate_spends_the_whole_budget():
+    scheduler = CallBudgetScheduler('search_recent_tweets')
+    entries = [_entry('a', 1), _entry('b', 400), _entry('c', 800)]
+
+    allocations = scheduler.allocate(entries, available_calls=10)
+
+    assert sum(allocations.values()) == 10
+    assert allocations['a'] > allocations['b'] > allocations['c'] >= 1
+
+
+def test_allocate_partially_serves_expensive_collections():
+    scheduler = CallBudgetScheduler('get_quote_tweets')
+    entries = [_entry('big', 1, '1,2,3,4')]
+
+    allocations = scheduler.allocate(entries, available_calls=3, cost=lambda entry: 4)
+
+    assert allocations == {'big': 3}
+    assert scheduler.carry_over['big'] > 0
+
+
+def test_state_is_saved_between_runs():
+    from state_store import StateStore
+    from twitter import TwitterAPI
+
+    state = StateStore(':memory:')
+    state.record_rate_limit(
+        'search_recent_tweets', {'limit': 60, 'remaining': 7, 'reset': int(time.time()) + 600}
+    )
+
+    scheduler = CallBudgetScheduler('search_recent_tweets', state=state)
+    scheduler.allocate([_entry('a', 1), _entry('b', 2)], available_calls=1)
+    scheduler.save()
+
+    twitter = TwitterAPI('bearer-token', wait_on_rate_limit=False, state=state)
+    restored = CallBudgetScheduler('search_recent_tweets', quota=20, state=state)
+
+    assert set(restored.carry_over) == {'b'}
+    assert restored.available_calls(twitter) == 7
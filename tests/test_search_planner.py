@@ -0,0 +1,64 @@
+from field_constants import Fields
+from search_planner import (
+    build_url_prefix_index,
+    is_batchable,
+    normalize_url,
+    plan_batches,
+    route_tweet,
+)
+
+
+def _entry(collection_id, search):
+    return {'id': f'rec-{collection_id}', 'fields': {Fields.ID: collection_id, Fields.SEARCH: search}}
+
+
+def _tweet(*urls):
+    return {'id': '1', 'text': 'A tweet', 'entities': {'urls': [{'expanded_url': url} for url in urls]}}
+
+
+def test_normalize_url():
+    assert normalize_url('https://www.Research.ArcadiaScience.com/pub/test-pub/?utm=x#top') == \
+        'research.arcadiascience.com/pub/test-pub'
+
+
+def test_is_batchable():
+    assert is_batchable(_entry('a', 'https://research.arcadiascience.com/pub/a, https://doi.org/10.1/a'))
+    assert not is_batchable(_entry('b', 'https://research.arcadiascience.com/pub/b, #arcadia'))
+    assert not is_batchable(_entry('c', ''))
+
+
+def test_route_tweet_matches_url_prefixes_at_path_boundaries():
+    index = build_url_prefix_index([
+        _entry('a', 'https://research.arcadiascience.com/pub/a,https://doi.org/10.57844/arcadia-a'),
+        _entry('ab', 'https://research.arcadiascience.com/pub/ab'),
+    ])
+
+    assert route_tweet(_tweet('http://research.arcadiascience.com/pub/a/release/2'), index) == {'a'}
+    assert route_tweet(_tweet('https://doi.org/10.57844/arcadia-a'), index) == {'a'}
+    assert route_tweet(_tweet('https://research.arcadiascience.com/pub/ab'), index) == {'ab'}
+    assert route_tweet(_tweet('https://example.com/pub/a'), index) == set()
+    assert route_tweet({'id': '2', 'text': 'No links'}, index) == set()
+
+
+def test_plan_batches_respects_query_length_and_covers_every_collection():
+    entries = [_entry(f'c{i}', f'https://research.arcadiascience.com/pub/collection-{i}') for i in range(20)]
+
+    batches = plan_batches(entries, since_ids={'c0': 100, 'c1': 200}, max_query_length=200)
+
+    assert len(batches) > 1
+    assert all(len(batch.query) <= 200 for batch in batches)
+    assert sorted(cid for batch in batches for cid in batch.collection_ids) == sorted(f'c{i}' for i in range(20))
+    assert all(batch.query.endswith(' -is:retweet') for batch in batches)
+    # Collections without a watermark search without since_id; c0 and c1 are packed last
+    assert batches[0].since_id is None
+    assert batches[-1].since_id == 100
+
+
+def test_plan_batches_leaves_out_collections_too_long_for_one_query():
+    long_terms = ','.join(f'https://research.arcadiascience.com/pub/long-{i}' for i in range(10))
+    entries = [_entry('long', long_terms), _entry('short', 'https://research.arcadiascience.com/pub/short')]
+
+    batches = plan_batches(entries, max_query_length=200)
+
+    assert [batch.collection_ids for batch in batches] == [['short']]
+    assert all(len(batch.query) <= 200 for batch in batches)
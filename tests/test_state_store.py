@@ -0,0 +1,53 @@
+from state_store import StateStore
+
+
+def test_watermarks_never_move_backwards(tmp_path):
+    state = StateStore(str(tmp_path / 'state.sqlite3'))
+
+    state.record_fetch('c1', 200)
+    state.record_fetch('c1', 100)
+    state.record_fetch('c1', None)
+    assert state.get_newest_tweet_id('c1') == 200
+
+    state.record_quote_watermark('c1', 42, None)
+    assert state.get_quote_watermark('c1', 42) is None
+    state.record_quote_watermark('c1', 42, 300)
+    state.record_quote_watermark('c1', 42, 250)
+    assert state.get_quote_watermark('c1', '42') == 300
+    assert state.get_quote_watermark('c1', 43) is None
+    # The same tweet in another collection has a watermark of its own
+    assert state.get_quote_watermark('c2', 42) is None
+
+
+def test_state_survives_reopening(tmp_path):
+    path = str(tmp_path / 'state.sqlite3')
+    state = StateStore(path)
+    state.record_fetch('c1', 123)
+    state.record_quote_check('c1')
+    state.set_carry_over('search_recent_tweets', {'c2': 1.5})
+    state.close()
+
+    reopened = StateStore(path)
+    collection_state = reopened.get_collection_state('c1')
+    assert collection_state['newest_tweet_id'] == 123
+    assert collection_state['last_quote_check_at'] is not None
+    assert reopened.get_carry_over('search_recent_tweets') == {'c2': 1.5}
+    assert reopened.get_collection_state('missing') is None
+
+
+def test_cursors_keep_the_time_they_were_first_saved(tmp_path):
+    from datetime import datetime, timedelta, timezone
+
+    state = StateStore(str(tmp_path / 'state.sqlite3'))
+    cursor = {'next_token': 'page-2', 'since_id': 100, 'newest_id': 150, 'collection_ids': ['c1', 'c2']}
+    state.save_cursor('search_recent_tweets', 'query', cursor)
+    state.save_cursor('search_recent_tweets', 'query', {**cursor, 'next_token': 'page-3'})
+
+    assert state.get_cursor('search_recent_tweets', 'query') == {**cursor, 'next_token': 'page-3'}
+    assert list(state.get_cursors('search_recent_tweets')) == ['query']
+    assert state.get_cursor('get_quote_tweets', 'query') is None
+
+    state.delete_cursors_saved_before('search_recent_tweets', datetime.now(timezone.utc) - timedelta(days=1))
+    assert state.get_cursor('search_recent_tweets', 'query') is not None
+    state.delete_cursors_saved_before('search_recent_tweets', datetime.now(timezone.utc) + timedelta(seconds=1))
+    assert state.get_cursor('search_recent_tweets', 'query') is None
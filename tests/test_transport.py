@@ -0,0 +1,69 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+from transport import build_retry, is_retryable, mount_transport
+
+
+@pytest.fixture
+def flaky_server():
+    """A local server that answers with the given statuses in turn, then with 200."""
+    statuses = []
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            received.append(self.path)
+            status = statuses.pop(0) if statuses else 200
+            self.send_response(status)
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}', statuses, received
+    server.shutdown()
+
+
+def test_transient_errors_are_retried(flaky_server):
+    url, statuses, received = flaky_server
+    statuses.extend([503, 429, 502])
+    session = mount_transport(requests.Session(), retry=build_retry(backoff_factor=0.01))
+
+    response = session.get(url)
+
+    assert response.status_code == 200
+    assert len(received) == 4
+
+
+def test_fatal_errors_are_not_retried(flaky_server):
+    url, statuses, received = flaky_server
+    statuses.append(404)
+    session = mount_transport(requests.Session(), retry=build_retry(backoff_factor=0.01))
+
+    response = session.get(url)
+
+    assert response.status_code == 404
+    assert len(received) == 1
+
+
+def test_last_response_is_returned_once_retries_run_out(flaky_server):
+    url, statuses, received = flaky_server
+    statuses.extend([503] * 5)
+    session = mount_transport(requests.Session(), retry=build_retry(total=2, backoff_factor=0.01))
+
+    response = session.get(url)
+
+    assert response.status_code == 503
+    assert len(received) == 3
+    assert is_retryable(requests.HTTPError(response=response))
+    assert not is_retryable(ValueError("bad field"))
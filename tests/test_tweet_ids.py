@@ -0,0 +1,38 @@
+from tweet_ids import TweetIdSet
+
+
+def test_round_trips_the_airtable_field():
+    tweet_ids = TweetIdSet.from_field(' 1734567890123456790, 1734567890123456789,,1734567890123456790 ')
+
+    assert len(tweet_ids) == 2
+    assert tweet_ids.to_field() == '1734567890123456789,1734567890123456790'
+    assert TweetIdSet.from_field('') == TweetIdSet()
+    assert TweetIdSet.from_field(None).to_field() == ''
+    # Items edited in by hand that are not tweet IDs do not fail the whole collection
+    assert list(TweetIdSet.from_field('1734567890123456789, n/a,https://x.com/1,-5')) == [1734567890123456789]
+
+
+def test_set_operations():
+    tweet_ids = TweetIdSet(['30', '10', '20'])
+
+    assert list(tweet_ids | TweetIdSet([20, 40])) == [10, 20, 30, 40]
+    assert list(tweet_ids.union(['5'])) == [5, 10, 20, 30]
+    assert list(tweet_ids - TweetIdSet([20])) == [10, 30]
+    assert list(tweet_ids.difference(['10', '99'])) == [20, 30]
+    assert '20' in tweet_ids and 25 not in tweet_ids
+    assert list(TweetIdSet([1, 5, 9]) | TweetIdSet(range(0, 12, 2))) == [0, 1, 2, 4, 5, 6, 8, 9, 10]
+    assert list(TweetIdSet(range(10)) - TweetIdSet([0, 3, 9, 12])) == [1, 2, 4, 5, 6, 7, 8]
+    assert list(TweetIdSet([3, 4]) - TweetIdSet(range(4))) == [4]
+    # The operations return new sets
+    assert list(tweet_ids) == [10, 20, 30]
+
+
+def test_newest_ids():
+    tweet_ids = TweetIdSet([10, 30, 20])
+
+    assert tweet_ids.max() == 30
+    assert TweetIdSet().max() is None
+    assert tweet_ids.newest(2) == [30, 20]
+    assert tweet_ids.newest(0) == []
+    assert tweet_ids.count_at_least(20) == 2
+    assert tweet_ids.count_at_least(31) == 0
@@ -0,0 +1,40 @@
+from unittest.mock import Mock
+
+import tweepy
+
+from tweet_store import TweetStore
+
+
+def test_tweets_are_upserted_and_keep_earlier_fields(tmp_path):
+    store = TweetStore(str(tmp_path / 'tweets.sqlite3'))
+    store.record_tweets(
+        [{'id': '1', 'text': 'A tweet', 'author_id': '7', 'public_metrics': {'quote_count': 1}}],
+        users=[{'id': '7', 'username': 'someone'}],
+    )
+    store.record_tweets([{'id': '1', 'text': 'A tweet', 'public_metrics': {'quote_count': 3}}])
+
+    tweets = store.get_tweets(['1', '2'])
+
+    assert list(tweets) == ['1']
+    assert tweets['1']['public_metrics'] == {'quote_count': 3}
+    assert tweets['1']['author_id'] == '7'
+    assert tweets['1']['author']['username'] == 'someone'
+
+
+def test_twitter_client_stores_the_tweets_it_fetches():
+    from twitter import TwitterAPI
+
+    store = TweetStore(':memory:')
+    twitter = TwitterAPI('bearer-token', tweet_store=store)
+    twitter.client.search_recent_tweets = Mock(return_value=tweepy.Response(
+        data=[tweepy.Tweet({'id': '5', 'text': 'Found', 'author_id': '7', 'edit_history_tweet_ids': ['5']})],
+        includes={'users': [tweepy.User({'id': '7', 'name': 'Someone', 'username': 'someone'})]},
+        errors=[],
+        meta={},
+    ))
+
+    twitter.search_tweets('query')
+
+    assert 'entities' in twitter.client.search_recent_tweets.call_args[1]['tweet_fields']
+    assert twitter.client.search_recent_tweets.call_args[1]['expansions'] == ['author_id']
+    assert store.get_tweets(['5'])['5']['author']['name'] == 'Someone'
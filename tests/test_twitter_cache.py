@@ -0,0 +1,68 @@
+import json
+
+import requests
+from requests.adapters import BaseAdapter
+from urllib3 import HTTPResponse
+
+from twitter import LOOKUP_ENDPOINT, SEARCH_ENDPOINT, TwitterAPI
+
+
+class FakeTwitterAdapter(BaseAdapter):
+    """Answers every request with a single tweet and counts the requests that reach it."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = 0
+
+    def send(self, request, **kwargs):
+        self.sent += 1
+        body = json.dumps({'data': [{'id': '1', 'text': 'A tweet', 'edit_history_tweet_ids': ['1']}], 'meta': {}})
+        response = requests.Response()
+        response.status_code = 200
+        response.url = request.url
+        response.request = request
+        response.headers['Content-Type'] = 'application/json'
+        response.raw = HTTPResponse(body=body.encode(), status=200, request_url=request.url, preload_content=False)
+        response._content = body.encode()
+        return response
+
+    def close(self):
+        pass
+
+
+def _cached_twitter(tmp_path, **kwargs):
+    twitter = TwitterAPI('bearer-token', cache=True, cache_path=str(tmp_path / 'twitter_cache'), **kwargs)
+    adapter = FakeTwitterAdapter()
+    twitter.client.session.mount('https://', adapter)
+    return twitter, adapter
+
+
+def test_lookups_are_served_from_the_shared_cache(tmp_path):
+    twitter, adapter = _cached_twitter(tmp_path)
+    twitter.get_tweets(['1'])
+    twitter.get_tweets(['1'])
+    assert adapter.sent == 1
+    assert twitter.cache_stats[LOOKUP_ENDPOINT] == {'hits': 1, 'misses': 1}
+
+    # Another job that points at the same file reuses the response
+    other_twitter, other_adapter = _cached_twitter(tmp_path)
+    other_twitter.get_tweets(['1'])
+    assert other_adapter.sent == 0
+
+
+def test_endpoints_with_a_zero_ttl_are_not_cached(tmp_path):
+    twitter, adapter = _cached_twitter(tmp_path, cache_ttls={SEARCH_ENDPOINT: 0})
+    twitter.search_tweets('query')
+    twitter.search_tweets('query')
+    assert adapter.sent == 2
+    assert twitter.cache_stats[SEARCH_ENDPOINT] == {'hits': 0, 'misses': 2}
+
+
+def test_cache_is_trimmed_to_max_entries(tmp_path):
+    twitter, _ = _cached_twitter(tmp_path)
+    for tweet_id in range(5):
+        twitter.get_tweets([str(tweet_id)])
+    assert len(twitter.client.session.cache.responses) == 5
+
+    trimmed, _ = _cached_twitter(tmp_path, cache_max_entries=2)
+    assert len(trimmed.client.session.cache.responses) == 2
@@ -0,0 +1,101 @@
+import time
+from unittest.mock import Mock
+
+import pytest
+import tweepy
+
+from twitter import QUOTES_ENDPOINT, RateLimitExhausted, SEARCH_ENDPOINT, TwitterAPI
+
+
+def _error(error_class, status_code):
+    response = Mock(status_code=status_code, reason='', headers={}, json=Mock(return_value={}))
+    return error_class(response)
+
+
+def _bucket(remaining, limit=60):
+    return {'limit': limit, 'remaining': remaining, 'reset': int(time.time()) + 600}
+
+
+def test_requests_go_to_the_token_with_the_most_calls_left():
+    twitter = TwitterAPI('token-a,token-b,token-c', wait_on_rate_limit=False)
+    a, b, c = twitter.credentials
+    a.rate_limits[SEARCH_ENDPOINT] = _bucket(1)
+    b.rate_limits[SEARCH_ENDPOINT] = _bucket(2)
+    c.rate_limits[SEARCH_ENDPOINT] = _bucket(0)
+    for credential in (a, b):
+        credential.client = Mock(search_recent_tweets=Mock(return_value=Mock(data=None, meta={})))
+
+    assert twitter.remaining_calls(SEARCH_ENDPOINT) == 3
+    for _ in range(3):
+        twitter.search_tweets('query')
+
+    assert (a.client.search_recent_tweets.call_count, b.client.search_recent_tweets.call_count) == (1, 2)
+    # The exhausted token's client was never needed
+    assert c.client is None
+    assert twitter.remaining_calls(SEARCH_ENDPOINT) == 0
+    with pytest.raises(RateLimitExhausted):
+        twitter.search_tweets('query')
+
+
+def test_rejected_tokens_are_not_used_again():
+    twitter = TwitterAPI(['token-a', 'token-b'], wait_on_rate_limit=False)
+    a, b = twitter.credentials
+    a.client = Mock(
+        search_recent_tweets=Mock(side_effect=_error(tweepy.Unauthorized, 401)),
+        get_quote_tweets=Mock(return_value=Mock(data=None, meta={})),
+    )
+    b.client = Mock(
+        search_recent_tweets=Mock(return_value=Mock(data=None, meta={})),
+        get_quote_tweets=Mock(side_effect=_error(tweepy.Forbidden, 403)),
+    )
+
+    twitter.search_tweets('query')
+    twitter.search_tweets('query')
+    assert (a.client.search_recent_tweets.call_count, b.client.search_recent_tweets.call_count) == (1, 2)
+
+    # A 403 only rules the token out for that endpoint, and once no token is left it is raised
+    with pytest.raises(tweepy.Forbidden):
+        twitter.get_quote_tweets_for_tweet('1')
+    assert twitter.credentials[1].disabled_endpoints == {QUOTES_ENDPOINT}
+
+
+def test_rate_limits_are_saved_per_token():
+    from state_store import StateStore
+
+    state = StateStore(':memory:')
+    state.record_rate_limit(SEARCH_ENDPOINT, _bucket(7))
+    twitter = TwitterAPI('token-a,token-b', state=state)
+    b = twitter.credentials[1]
+    response = Mock(
+        url='https://api.twitter.com/2/tweets/search/recent?query=x', content=b'{}', status_code=200,
+        elapsed=Mock(total_seconds=Mock(return_value=0.1)), from_cache=False, _recorded=False,
+        headers={'x-rate-limit-limit': '60', 'x-rate-limit-remaining': '5', 'x-rate-limit-reset': str(int(time.time()) + 600)},
+    )
+    twitter._record_response(b, response)
+
+    restored = TwitterAPI('token-a,token-b', state=state)
+    assert [credential.remaining_calls(SEARCH_ENDPOINT) for credential in restored.credentials] == [7, 5]
+    assert 'token-b' not in str(state.get_rate_limits())
+
+
+def test_a_429_without_headers_is_retried_after_the_window(monkeypatch):
+    clock = [time.time()]
+    sleeps = []
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        # Stands in for a hang: the request is never sent again
+        assert len(sleeps) < 5
+        clock[0] += seconds
+    monkeypatch.setattr(time, 'sleep', sleep)
+
+    twitter = TwitterAPI('token', wait_on_rate_limit=True)
+    response = Mock(data=None, meta={})
+    twitter.client.search_recent_tweets = Mock(side_effect=[_error(tweepy.TooManyRequests, 429), response])
+
+    twitter.search_tweets('query')
+
+    assert twitter.client.search_recent_tweets.call_count == 2
+    assert len(sleeps) == 1
+    assert twitter.remaining_calls(SEARCH_ENDPOINT) is None